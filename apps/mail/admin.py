@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import MailMessage, MailAttachment, PGPKey
+from .models import MailMessage, MailAttachment, AttachmentBlob, AttachmentUpload, MailboxCounters, MailChange, PGPKey, PGPKeyJob, PregeneratedKey, OutboundEmail, PostfixDelivery
 
 
 @admin.register(MailAttachment)
@@ -13,22 +13,101 @@ class MailAttachmentAdmin(admin.ModelAdmin):
     ordering = ('-created_at',)
 
 
+@admin.register(AttachmentBlob)
+class AttachmentBlobAdmin(admin.ModelAdmin):
+    """
+    Админка содержимого вложений (только просмотр, удаление - mail_blob_gc)
+    """
+    list_display = ['sha256', 'size', 'ref_count', 'unreferenced_at', 'created_at']
+    search_fields = ['sha256']
+    readonly_fields = ['sha256', 'file', 'size', 'ref_count', 'unreferenced_at', 'created_at']
+
+
+@admin.register(AttachmentUpload)
+class AttachmentUploadAdmin(admin.ModelAdmin):
+    """
+    Админка загрузок вложений по частям
+    """
+    list_display = ['id', 'user', 'filename', 'size', 'received', 'status', 'updated_at']
+    list_filter = ['status']
+    search_fields = ['filename', 'user__email']
+    readonly_fields = ['id', 'file_name', 'received', 'sha256', 'attachment', 'created_at', 'updated_at']
+    raw_id_fields = ('user',)
+
+
 @admin.register(MailMessage)
 class MailMessageAdmin(admin.ModelAdmin):
     """
     Админка для модели сообщений
     """
     list_display = ['id', 'from_user', 'to_user', 'subject', 'is_encrypted', 'is_draft', 'created_at']
-    list_filter = ['is_encrypted', 'is_draft', 'is_deleted_by_sender', 'is_deleted_by_recipient']
+    list_filter = ['is_encrypted', 'is_draft', 'is_read', 'is_deleted_by_sender', 'is_deleted_by_recipient']
     search_fields = ['subject', 'from_user__email', 'to_user__email']
     readonly_fields = ['id', 'created_at']
     ordering = ('-created_at',)
     raw_id_fields = ('from_user', 'to_user')
 
 
+@admin.register(MailboxCounters)
+class MailboxCountersAdmin(admin.ModelAdmin):
+    """
+    Админка для счетчиков почтовых ящиков (только просмотр, пересчет - mail_rebuild_counters)
+    """
+    list_display = ['user', 'inbox_total', 'inbox_unread', 'sent_total', 'drafts_total', 'trash_total', 'updated_at']
+    search_fields = ['user__email']
+    readonly_fields = ['user', *MailboxCounters.COUNTER_FIELDS, 'updated_at']
+
+
+@admin.register(MailChange)
+class MailChangeAdmin(admin.ModelAdmin):
+    """
+    Админка журнала изменений почты (только просмотр)
+    """
+    list_display = ['seq', 'user', 'message_id', 'action', 'created_at']
+    list_filter = ['action']
+    search_fields = ['user__email', 'message_id']
+    readonly_fields = ['seq', 'user', 'message_id', 'action', 'created_at']
+    raw_id_fields = ('user',)
+
+
 @admin.register(PGPKey)
 class PGPKeyAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'created_at', 'updated_at')
     search_fields = ('user__email',)
     readonly_fields = ('id', 'created_at', 'updated_at')
     ordering = ('-created_at',)
+
+
+@admin.register(PGPKeyJob)
+class PGPKeyJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'status', 'from_pool', 'created_at', 'updated_at')
+    list_filter = ('status', 'from_pool')
+    search_fields = ('user__email',)
+    exclude = ('passphrase_encrypted',)
+    readonly_fields = ('id', 'user', 'status', 'from_pool', 'error', 'created_at', 'updated_at')
+    ordering = ('-created_at',)
+
+
+@admin.register(PregeneratedKey)
+class PregeneratedKeyAdmin(admin.ModelAdmin):
+    list_display = ('fingerprint', 'created_at')
+    exclude = ('private_key_encrypted',)
+    readonly_fields = ('id', 'fingerprint', 'public_key', 'created_at')
+    ordering = ('created_at',)
+
+
+@admin.register(OutboundEmail)
+class OutboundEmailAdmin(admin.ModelAdmin):
+    list_display = ('to_email', 'subject', 'status', 'attempts', 'queue_id', 'next_attempt_at', 'created_at')
+    list_filter = ('status',)
+    search_fields = ('to_email', 'from_email', 'queue_id')
+    readonly_fields = ('id', 'message', 'attempts', 'lease', 'last_error', 'queue_id', 'sent_at', 'created_at', 'updated_at')
+    ordering = ('-created_at',)
+
+
+@admin.register(PostfixDelivery)
+class PostfixDeliveryAdmin(admin.ModelAdmin):
+    list_display = ('queue_id', 'recipient', 'status', 'dsn', 'logged_at')
+    list_filter = ('status',)
+    search_fields = ('queue_id', 'recipient')
+    ordering = ('-logged_at',)
@@ -0,0 +1,72 @@
+"""
+ASCII-armor OpenPGP-сообщений (RFC 9580, 6.2)
+
+Тела зашифрованных писем хранятся в двоичном виде (MailMessage.content_binary):
+armor добавляет к данным около трети размера (base64 и строки заголовков).
+Клиент по-прежнему отправляет и получает armor-текст: dearmor() снимает его
+при сохранении, armor() восстанавливает только при выдаче письма клиенту.
+gpg расшифровывает двоичные данные напрямую, без armor.
+
+Контрольная сумма CRC24 не проверяется и не добавляется: по RFC 9580 она
+необязательна, и реализации не должны отклонять данные из-за ее отсутствия
+или несовпадения (ее не требуют ни gpg, ни openpgp.js).
+"""
+import base64
+import binascii
+
+BEGIN = '-----BEGIN PGP MESSAGE-----'
+END = '-----END PGP MESSAGE-----'
+# Длина строки base64 в armor, как у gpg и openpgp.js
+LINE_LENGTH = 64
+
+
+def is_armored(text):
+    """
+    Похож ли text на armor-блок одного OpenPGP-сообщения
+    """
+    text = text.strip()
+    return text.startswith(BEGIN) and text.endswith(END)
+
+
+def dearmor(text):
+    """
+    Двоичные данные из armor-блока; ValueError - текст не armor или поврежден
+    """
+    lines = text.strip().splitlines()
+    if len(lines) < 2 or lines[0].strip() != BEGIN or lines[-1].strip() != END:
+        raise ValueError('Текст не является armor-блоком PGP MESSAGE')
+    lines = [line.strip() for line in lines[1:-1]]
+    # Заголовки armor (Version:, Comment:) отделены от данных пустой строкой
+    if '' in lines:
+        lines = lines[lines.index('') + 1:]
+    elif lines and ':' in lines[0]:
+        raise ValueError('Нет пустой строки после заголовков armor')
+    data = [line for line in lines if line and not line.startswith('=')]
+    try:
+        return base64.b64decode(''.join(data), validate=True)
+    except binascii.Error as e:
+        raise ValueError(f'Поврежденные данные armor: {e}')
+
+
+def armor(data):
+    """
+    armor-блок PGP MESSAGE для двоичных данных
+    """
+    encoded = base64.b64encode(bytes(data)).decode('ascii')
+    body = '\n'.join(encoded[index:index + LINE_LENGTH] for index in range(0, len(encoded), LINE_LENGTH))
+    return f'{BEGIN}\n\n{body}\n{END}\n'
+
+
+def pack(content):
+    """
+    Тело зашифрованного письма для записи: (content_encrypted, content_binary)
+
+    armor-блок сохраняется двоично, прочий текст (в том числе поврежденный
+    armor) - как есть
+    """
+    if is_armored(content):
+        try:
+            return '', dearmor(content)
+        except ValueError:
+            pass
+    return content, None
@@ -0,0 +1,160 @@
+"""
+Хранилище содержимого вложений с адресацией по SHA-256
+
+Одинаковые файлы (например, один PDF, пересланный многим коллегам) хранятся
+один раз: вложение ссылается на AttachmentBlob, у которого ведется счетчик
+ссылок. Новый файл становится блобом при завершении загрузки; если блоб с таким
+хешем уже есть, загруженная копия удаляется и увеличивается только счетчик.
+
+Блобы без ссылок удаляются collect_garbage() (команда mail_blob_gc) не раньше
+чем через grace после того, как на них пропала последняя ссылка. Удаление строки
+и файла выполняется в одной транзакции с проверкой ref_count=0, поэтому блоб,
+на который в это время сослалось новое вложение, не будет удален.
+"""
+import hashlib
+import os
+from datetime import timedelta
+
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, models, transaction
+from django.utils import timezone
+
+from mail.models import AttachmentBlob, MailAttachment, get_blob_file_path
+
+# Размер блока при подсчете хеша загруженного файла
+CHUNK_SIZE = 64 * 1024
+
+
+def acquire(sha256):
+    """
+    Увеличивает счетчик ссылок существующего блоба; возвращает блоб или None
+    """
+    updated = AttachmentBlob.objects.filter(sha256=sha256).update(
+        ref_count=models.F('ref_count') + 1,
+        unreferenced_at=None
+    )
+    if not updated:
+        return None
+    return AttachmentBlob.objects.get(sha256=sha256)
+
+
+def release(sha256):
+    """
+    Уменьшает счетчик ссылок блоба; при обнулении запоминает время для GC
+    """
+    blobs = AttachmentBlob.objects.filter(sha256=sha256)
+    if not blobs.filter(ref_count__gt=1).update(ref_count=models.F('ref_count') - 1):
+        blobs.filter(ref_count=1).update(ref_count=0, unreferenced_at=timezone.now())
+
+
+def store_file(name, sha256, size):
+    """
+    Превращает файл хранилища name с известным хешем в ссылку на блоб
+
+    Если блоб уже есть, файл name удаляется как дубликат. Иначе файл
+    переносится на место блоба (rename в пределах хранилища, без копирования).
+    Возвращает блоб с уже учтенной ссылкой.
+    """
+    with transaction.atomic():
+        blob = acquire(sha256)
+        if blob is not None:
+            default_storage.delete(name)
+            return blob
+
+        blob_name = get_blob_file_path(sha256)
+        blob_path = default_storage.path(blob_name)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        os.replace(default_storage.path(name), blob_path)
+        try:
+            with transaction.atomic():
+                return AttachmentBlob.objects.create(sha256=sha256, file=blob_name, size=size, ref_count=1)
+        except IntegrityError:
+            # Тот же файл параллельно сохранил другой запрос; содержимое по хешу одинаковое
+            return acquire(sha256)
+
+
+def store_uploaded_file(file_obj):
+    """
+    Сохраняет файл из multipart-загрузки как блоб; возвращает блоб с учтенной ссылкой
+    """
+    hasher = hashlib.sha256()
+    for chunk in file_obj.chunks(CHUNK_SIZE):
+        hasher.update(chunk)
+    sha256 = hasher.hexdigest()
+
+    with transaction.atomic():
+        blob = acquire(sha256)
+        if blob is not None:
+            return blob
+
+        blob_name = get_blob_file_path(sha256)
+        # Файл без строки мог остаться после сбоя - содержимое то же самое
+        if default_storage.exists(blob_name):
+            default_storage.delete(blob_name)
+        file_obj.seek(0)
+        saved_name = default_storage.save(blob_name, file_obj)
+        try:
+            with transaction.atomic():
+                return AttachmentBlob.objects.create(sha256=sha256, file=saved_name, size=file_obj.size, ref_count=1)
+        except IntegrityError:
+            default_storage.delete(saved_name)
+            return acquire(sha256)
+
+
+def collect_garbage(grace=timedelta(hours=1), dry_run=False, batch_size=500):
+    """
+    Удаляет блобы без ссылок, у которых последняя ссылка пропала раньше now - grace
+
+    Возвращает (число блобов, освобождено байт)
+    """
+    threshold = timezone.now() - grace
+    candidates = AttachmentBlob.objects.filter(ref_count=0, unreferenced_at__lt=threshold)
+    removed, freed = 0, 0
+    last_key = ''
+    while True:
+        batch = list(
+            candidates.filter(sha256__gt=last_key).order_by('sha256').values_list('sha256', 'size')[:batch_size]
+        )
+        if not batch:
+            break
+        last_key = batch[-1][0]
+        for sha256, size in batch:
+            if dry_run:
+                removed += 1
+                freed += size
+                continue
+            with transaction.atomic():
+                # Повторная проверка под транзакцией: на блоб могли сослаться после выборки
+                blob = AttachmentBlob.objects.select_for_update().filter(sha256=sha256, ref_count=0).first()
+                if blob is None:
+                    continue
+                name = blob.file.name
+                blob.delete()
+                if name and default_storage.exists(name):
+                    default_storage.delete(name)
+            removed += 1
+            freed += size
+    return removed, freed
+
+
+def recount_references():
+    """
+    Пересчитывает ref_count всех блобов по таблице вложений
+
+    Нужна после ручных удалений вложений в обход MailAttachment.delete()
+    """
+    counts = dict(
+        MailAttachment.objects.filter(blob__isnull=False).order_by()
+        .values_list('blob_id').annotate(total=models.Count('id'))
+    )
+    fixed = 0
+    now = timezone.now()
+    for blob in AttachmentBlob.objects.only('sha256', 'ref_count', 'unreferenced_at').iterator():
+        actual = counts.get(blob.sha256, 0)
+        if blob.ref_count == actual:
+            continue
+        blob.ref_count = actual
+        blob.unreferenced_at = None if actual else (blob.unreferenced_at or now)
+        blob.save(update_fields=['ref_count', 'unreferenced_at'])
+        fixed += 1
+    return fixed
@@ -0,0 +1,132 @@
+"""
+Массовые операции с письмами: корзина, восстановление, полное удаление, прочтение
+
+Операция над набором писем (списком id или целой папкой) выполняется
+несколькими UPDATE/DELETE по условию, а не get_object() и save() на каждое
+письмо. Состояния писем читаются одним запросом values(); по ним в Python
+вычисляется новое состояние, и разница применяется к счетчикам и журналу
+изменений (mailbox.apply_snapshots) в той же транзакции.
+
+Правила совпадают с одиночными действиями MailViewSet: пользователь меняет
+только свою сторону письма (отправителя или получателя), отметка о прочтении
+доступна только получателю, а полностью удаляются только письма, удаленные
+в корзину обеими сторонами.
+"""
+from dataclasses import dataclass
+from datetime import timedelta
+
+from django.db import models, transaction
+from django.utils import timezone
+
+from mail import mailbox, threads
+from mail.cleanup import collect_orphan_attachments
+from mail.models import MailMessage
+
+ACTIONS = ('trash', 'restore', 'purge', 'read', 'unread')
+
+# Число id в одном UPDATE/DELETE ... WHERE id IN (...)
+CHUNK_SIZE = 500
+
+
+@dataclass
+class Rule:
+    """
+    Изменение одной стороны письма: условие для состояния из values(),
+    то же условие для UPDATE и новые значения полей (None - удалить письмо)
+    """
+    matches: object
+    condition: models.Q
+    values: dict = None
+
+
+def get_rules(action, user_id):
+    now = timezone.now()
+    if action in ('trash', 'restore'):
+        deleted = action == 'trash'
+        return [
+            Rule(
+                lambda state: state['from_user_id'] == user_id and state['is_deleted_by_sender'] != deleted,
+                models.Q(from_user_id=user_id) & ~models.Q(is_deleted_by_sender=deleted),
+                {'is_deleted_by_sender': deleted},
+            ),
+            # Письмо самому себе меняется только со стороны отправителя, как в destroy()
+            Rule(
+                lambda state: (
+                    state['to_user_id'] == user_id and state['from_user_id'] != user_id
+                    and state['is_deleted_by_recipient'] != deleted
+                ),
+                models.Q(to_user_id=user_id) & ~models.Q(from_user_id=user_id) & ~models.Q(is_deleted_by_recipient=deleted),
+                {'is_deleted_by_recipient': deleted},
+            ),
+        ]
+    if action in ('read', 'unread'):
+        is_read = action == 'read'
+        return [
+            Rule(
+                lambda state: state['to_user_id'] == user_id and state['is_read'] != is_read,
+                models.Q(to_user_id=user_id) & ~models.Q(is_read=is_read),
+                {'is_read': is_read, 'read_at': now if is_read else None},
+            ),
+        ]
+    if action == 'purge':
+        return [
+            Rule(
+                lambda state: state['is_deleted_by_sender'] and state['is_deleted_by_recipient'],
+                models.Q(is_deleted_by_sender=True, is_deleted_by_recipient=True),
+            ),
+        ]
+    raise ValueError(f'Неизвестное действие: {action}')
+
+
+def chunks(items, size=CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def apply(action, messages, user):
+    """
+    Выполняет действие над письмами messages (QuerySet) со стороны user
+
+    Вернет {"matched": найдено писем, "updated": изменено или удалено};
+    письма, для которых действие ничего не меняет, пропускаются. Вложения
+    удаленных писем, на которые больше нет ссылок, удаляются после коммита.
+    """
+    rules = get_rules(action, user.id)
+    if action == 'purge':
+        # Удалять можно только письма из корзины пользователя
+        messages = messages & MailMessage.objects.trash(user)
+
+    with transaction.atomic():
+        states = list(messages.order_by().select_for_update().values(*mailbox.STATE_FIELDS, 'thread_id'))
+        after = {state['id']: state for state in states}
+        changed = []
+        attachment_ids = []
+        thread_ids = set()
+        for rule in rules:
+            ids = [state['id'] for state in states if rule.matches(state)]
+            for chunk in chunks(ids):
+                targets = MailMessage.objects.filter(rule.condition, pk__in=chunk)
+                if rule.values is None:
+                    # Связи с вложениями удаляются вместе с письмами - запоминаем их заранее
+                    attachment_ids.extend(
+                        MailMessage.attachments.through.objects.filter(mailmessage_id__in=chunk)
+                        .values_list('mailattachment_id', flat=True)
+                    )
+                    thread_ids.update(after[message_id]['thread_id'] for message_id in chunk)
+                    targets.delete()
+                else:
+                    targets.update(**rule.values)
+            for message_id in ids:
+                if rule.values is None:
+                    after.pop(message_id)
+                else:
+                    after[message_id] = dict(after[message_id], **rule.values)
+            changed.extend(ids)
+
+        mailbox.apply_snapshots(mailbox.snapshot(states), mailbox.snapshot(after.values()))
+        # Удаление писем меняет агрегаты их переписок
+        threads.refresh(thread_id for thread_id in thread_ids if thread_id)
+
+    if attachment_ids:
+        collect_orphan_attachments(timedelta(0), ids=set(attachment_ids))
+    return {"matched": len(states), "updated": len(set(changed))}
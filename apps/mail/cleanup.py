@@ -0,0 +1,146 @@
+"""
+Сборка мусора вложений
+
+Вложение считается осиротевшим, если оно старше времени ожидания, не связано
+ни с одним письмом и его id не упоминается в attachments_meta писем (старые
+письма, у которых связь еще не восстановлена). Такие вложения выбираются
+пачками по первичному ключу (keyset, без OFFSET), строки пачки удаляются одним
+DELETE, файлы старых вложений удаляются с диска, а для вложений на блобах
+уменьшаются счетчики ссылок - сами блобы затем удаляет blobs.collect_garbage().
+"""
+import os
+from collections import Counter
+from dataclasses import dataclass
+
+from django.core.files.storage import default_storage
+from django.db import models, transaction
+from django.utils import timezone
+
+from mail.models import AttachmentBlob, AttachmentUpload, MailAttachment, MailMessage
+
+
+@dataclass
+class CleanupResult:
+    """
+    Итог очистки: число удаленных объектов и освобожденные байты
+    """
+    count: int = 0
+    bytes: int = 0
+
+
+def meta_referenced_ids():
+    """
+    id вложений, упомянутых в attachments_meta писем
+
+    Читается один раз перед очисткой потоком по письмам с непустыми метаданными
+    """
+    referenced = set()
+    messages = MailMessage.objects.exclude(attachments_meta=[]).order_by().values_list('attachments_meta', flat=True)
+    for meta in messages.iterator(chunk_size=2000):
+        for item in meta or ():
+            if isinstance(item, dict) and item.get('id'):
+                referenced.add(str(item['id']))
+    return referenced
+
+
+def orphan_attachments(threshold):
+    """
+    Вложения старше threshold без связей с письмами
+    """
+    linked = MailMessage.attachments.through.objects.filter(mailattachment_id=models.OuterRef('pk'))
+    return MailAttachment.objects.filter(created_at__lt=threshold).filter(~models.Exists(linked))
+
+
+def release_blobs(blob_counts):
+    """
+    Уменьшает счетчики ссылок блобов сразу на число удаленных вложений
+    """
+    now = timezone.now()
+    for blob_id, count in blob_counts.items():
+        AttachmentBlob.objects.filter(sha256=blob_id).update(ref_count=models.F('ref_count') - count)
+    AttachmentBlob.objects.filter(
+        sha256__in=list(blob_counts), ref_count=0, unreferenced_at__isnull=True
+    ).update(unreferenced_at=now)
+
+
+def unlink_files(names):
+    for name in names:
+        try:
+            os.unlink(default_storage.path(name))
+        except FileNotFoundError:
+            pass
+
+
+def collect_orphan_attachments(grace, batch_size=2000, dry_run=False, ids=None):
+    """
+    Удаляет осиротевшие вложения старше grace; возвращает CleanupResult
+
+    ids ограничивает проверку перечисленными вложениями (например, вложениями
+    только что удаленных писем). Освобожденные байты считаются по файлам
+    старых вложений; место блобов освобождается позже, когда на них не
+    остается ссылок.
+    """
+    threshold = timezone.now() - grace
+    candidates = orphan_attachments(threshold).order_by('pk')
+    if ids is not None:
+        candidates = candidates.filter(pk__in=list(ids))
+        if not candidates.exists():
+            return CleanupResult()
+    referenced = meta_referenced_ids()
+    result = CleanupResult()
+    last_pk = None
+
+    while True:
+        page = candidates.filter(pk__gt=last_pk) if last_pk else candidates
+        batch = list(page.values_list('pk', 'file', 'file_size', 'blob_id')[:batch_size])
+        if not batch:
+            break
+        last_pk = batch[-1][0]
+        batch = [row for row in batch if str(row[0]) not in referenced]
+        if not batch:
+            continue
+
+        if dry_run:
+            result.count += len(batch)
+            result.bytes += sum(size for _, _, size, blob_id in batch if not blob_id)
+            continue
+
+        with transaction.atomic():
+            # Повторная проверка в транзакции: вложение могли прикрепить к письму после выборки
+            rows = (
+                orphan_attachments(threshold)
+                .filter(pk__in=[row[0] for row in batch])
+                .select_for_update()
+                .values_list('pk', 'file', 'file_size', 'blob_id')
+            )
+            deleted = {pk: (name, size, blob_id) for pk, name, size, blob_id in rows}
+            if not deleted:
+                continue
+            # Один DELETE на пачку, в обход MailAttachment.delete() с поштучной работой с файлами
+            MailAttachment.objects.filter(pk__in=list(deleted)).delete()
+
+            blob_counts = Counter(blob_id for _, _, blob_id in deleted.values() if blob_id)
+            if blob_counts:
+                release_blobs(blob_counts)
+
+        legacy = [(name, size) for name, size, blob_id in deleted.values() if not blob_id and name]
+        unlink_files(name for name, _ in legacy)
+        result.count += len(deleted)
+        result.bytes += sum(size for _, size in legacy)
+
+    return result
+
+
+def collect_stale_uploads(ttl, dry_run=False):
+    """
+    Удаляет незавершенные загрузки по частям, которые не продолжались дольше ttl
+    """
+    stale = AttachmentUpload.objects.filter(status='uploading', updated_at__lt=timezone.now() - ttl)
+    result = CleanupResult()
+    for upload in stale.only('pk', 'file_name', 'received').iterator():
+        result.count += 1
+        result.bytes += upload.received
+        if not dry_run:
+            unlink_files([upload.file_name])
+            upload.delete()
+    return result
@@ -0,0 +1,155 @@
+"""
+Пул воркеров GnuPG для шифрования вне потока запроса
+
+Каждая операция python-gnupg - это отдельный процесс gpg, который запрос
+ждет синхронно. Пул ограничивает число одновременно работающих gpg (WORKERS)
+и длину очереди ожидающих операций (QUEUE_SIZE): когда пул занят, новая
+операция сразу получает CryptoBusy (HTTP 503 с Retry-After), а не занимает
+воркер WSGI в ожидании. Запрос ждет результат не дольше TIMEOUT секунд.
+
+Операции выполняются в потоках пула - сама работа идет в процессах gpg,
+поэтому потоков достаточно, и GIL их не сдерживает. Интерфейсы:
+    call()  - синхронный, для обычных view и команд
+    acall() - корутина для ASGI, ожидание не блокирует цикл событий
+    map()   - пачка операций параллельно, с результатом или ошибкой по каждой
+
+Настройки MAIL_CRYPTO: WORKERS, QUEUE_SIZE, TIMEOUT, RETRY_AFTER.
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from django.conf import settings
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+
+class CryptoBusy(APIException):
+    """
+    Очередь операций GnuPG заполнена
+    """
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Сервис шифрования перегружен, повторите запрос позже'
+    default_code = 'crypto_busy'
+
+    def __init__(self, wait, detail=None, code=None):
+        # По атрибуту wait обработчик исключений DRF выставляет Retry-After
+        self.wait = wait
+        super().__init__(detail, code)
+
+
+class CryptoTimeout(APIException):
+    """
+    Операция GnuPG не завершилась за отведенное время
+    """
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Сервис шифрования не ответил вовремя'
+    default_code = 'crypto_timeout'
+
+
+class GPGPool:
+    """
+    Ограниченный пул операций GnuPG с синхронным и асинхронным ожиданием
+
+    Операция - любая функция; она выполняется в потоке пула, место в очереди
+    освобождается, когда функция завершилась (даже если запрос уже не ждет).
+    """
+
+    def __init__(self, workers=4, queue_size=16, timeout=30, retry_after=5):
+        self.workers = workers
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='gpg')
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Ставит операцию в очередь; возвращает concurrent.futures.Future
+        """
+        if not self.slots.acquire(blocking=False):
+            raise CryptoBusy(self.retry_after)
+        try:
+            future = self.executor.submit(func, *args, **kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def call(self, func, *args, timeout=None, **kwargs):
+        future = self.submit(func, *args, **kwargs)
+        try:
+            return future.result(timeout or self.timeout)
+        except FutureTimeoutError:
+            # Еще не начатая операция снимается с очереди
+            future.cancel()
+            raise CryptoTimeout()
+
+    async def acall(self, func, *args, timeout=None, **kwargs):
+        future = self.submit(func, *args, **kwargs)
+        try:
+            # Отмена ожидания отменяет и еще не начатую операцию
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            raise CryptoTimeout()
+
+    def map(self, func, items, timeout=None):
+        """
+        Выполняет func для каждого элемента параллельно на воркерах пула
+
+        Если пул уже занят другими запросами, первая операция сразу получает
+        CryptoBusy. Остальные ждут места в очереди, пока не истек общий таймаут:
+        пачка не отказывает сама себе. Возвращает список пар (результат, исключение)
+        в порядке items.
+        """
+        deadline = time.monotonic() + (timeout or self.timeout)
+        futures = []
+        for item in items:
+            if not futures:
+                futures.append(self.submit(func, item))
+                continue
+            if not self.slots.acquire(timeout=max(deadline - time.monotonic(), 0)):
+                futures.append(None)
+                continue
+            future = self.executor.submit(func, item)
+            future.add_done_callback(lambda _: self.slots.release())
+            futures.append(future)
+
+        outcomes = []
+        for future in futures:
+            if future is None:
+                outcomes.append((None, CryptoTimeout()))
+                continue
+            try:
+                outcomes.append((future.result(max(deadline - time.monotonic(), 0)), None))
+            except FutureTimeoutError:
+                future.cancel()
+                outcomes.append((None, CryptoTimeout()))
+            except Exception as e:
+                outcomes.append((None, e))
+        return outcomes
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Пул процесса, создается по настройке MAIL_CRYPTO при первом обращении
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            config = getattr(settings, 'MAIL_CRYPTO', {})
+            _pool = GPGPool(
+                workers=config.get('WORKERS', 4),
+                queue_size=config.get('QUEUE_SIZE', 16),
+                timeout=config.get('TIMEOUT', 30),
+                retry_after=config.get('RETRY_AFTER', 5),
+            )
+        return _pool
@@ -0,0 +1,162 @@
+"""
+Отдача файлов вложений после проверки доступа
+
+Если перед Django стоит nginx или Apache, передача файла отдается им
+(X-Accel-Redirect / X-Sendfile): воркер только проверяет права и сразу
+освобождается. Иначе файл отдается потоком из Python с поддержкой Range
+и If-None-Match, блоками фиксированного размера, без чтения целиком в память.
+
+Настройки:
+    MAIL_ATTACHMENT_SENDFILE     - '' (отдавать из Python), 'nginx' или 'apache'
+    MAIL_ATTACHMENT_ACCEL_PREFIX - internal-location nginx, соответствующий MEDIA_ROOT
+"""
+import os
+import re
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils.http import content_disposition_header, quote_etag
+from django.utils.encoding import iri_to_uri
+
+# Размер блока при потоковой отдаче части файла
+CHUNK_SIZE = 64 * 1024
+
+range_pattern = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def get_etag(attachment, stat):
+    """
+    ETag вложения: SHA-256 содержимого блоба, для старых файлов - размер и время изменения
+    """
+    if attachment.blob_id:
+        return quote_etag(attachment.blob_id)
+    return quote_etag(f'{stat.st_size:x}-{int(stat.st_mtime):x}')
+
+
+def etag_matches(header, etag):
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    # Слабые валидаторы (W/"...") сравниваются по значению
+    candidates = [value.strip().removeprefix('W/') for value in header.split(',')]
+    return etag in candidates
+
+
+def parse_range(header, size):
+    """
+    Диапазон байт (start, end) включительно из заголовка Range
+
+    None - заголовок не задан или не поддерживается (несколько диапазонов):
+    отдается весь файл. ValueError - диапазон не пересекается с файлом (416).
+    """
+    if not header:
+        return None
+    match = range_pattern.match(header.strip())
+    if not match:
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        # bytes=-500: последние 500 байт
+        length = int(end)
+        if length == 0:
+            raise ValueError(header)
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+
+def iter_file_range(file, start, length):
+    try:
+        file.seek(start)
+        remaining = length
+        while remaining:
+            block = file.read(min(CHUNK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+    finally:
+        file.close()
+
+
+def offload_response(path, backend, content_type):
+    response = HttpResponse(content_type=content_type)
+    if backend == 'nginx':
+        relative = os.path.relpath(path, settings.MEDIA_ROOT)
+        prefix = settings.MAIL_ATTACHMENT_ACCEL_PREFIX.rstrip('/')
+        response['X-Accel-Redirect'] = iri_to_uri(f'{prefix}/{relative}')
+    else:
+        response['X-Sendfile'] = path
+    return response
+
+
+def attachment_response(request, attachment):
+    """
+    Ответ с файлом вложения; права доступа должны быть проверены заранее
+
+    Http404, если файла нет на диске (старое вложение или блоб, удаленный вручную)
+    """
+    path = default_storage.path(attachment.file.name)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        raise Http404('Файл вложения не найден')
+    disposition = content_disposition_header(True, attachment.filename)
+    etag = get_etag(attachment, stat)
+
+    backend = settings.MAIL_ATTACHMENT_SENDFILE
+    if backend:
+        # Range, If-None-Match и sendfile прокси обрабатывает сам
+        response = offload_response(path, backend, attachment.content_type)
+        response['Content-Disposition'] = disposition
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private'
+        return response
+
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        response = HttpResponse(status=304)
+        response['ETag'] = etag
+        return response
+
+    size = stat.st_size
+    byte_range = None
+    # If-Range: часть отдается, только если файл не изменился
+    if_range = request.headers.get('If-Range')
+    if not if_range or if_range.strip() == etag:
+        try:
+            byte_range = parse_range(request.headers.get('Range'), size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+    try:
+        file = open(path, 'rb')
+    except OSError:
+        # Файл удалили после os.stat()
+        raise Http404('Файл вложения не найден')
+    if byte_range is None:
+        response = FileResponse(file, content_type=attachment.content_type)
+    else:
+        start, end = byte_range
+        length = end - start + 1
+        response = StreamingHttpResponse(
+            iter_file_range(file, start, length),
+            status=206,
+            content_type=attachment.content_type
+        )
+        response['Content-Length'] = str(length)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+
+    response['Content-Disposition'] = disposition
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private'
+    return response
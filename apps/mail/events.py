@@ -0,0 +1,294 @@
+"""
+События почты для клиентов, подключенных к потоку /api/v1/mail/events/ (SSE)
+
+Изменения писем публикуются после коммита транзакции (mailbox.track) в бэкенд,
+а EventBroker каждого процесса раздает их asyncio-очередям подключенных
+пользователей. Ожидающее соединение - это корутина с очередью, а не поток,
+поэтому один воркер держит тысячи простаивающих подключений.
+
+Бэкенд задается настройкой MAIL_EVENTS:
+    LocalBackend  - только внутри процесса (один воркер, разработка)
+    SQLiteBackend - общий файл SQLite для нескольких процессов на одной машине
+    RedisBackend  - Redis pub/sub для нескольких машин
+"""
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+# Событие, которое получает клиент, если его очередь переполнилась:
+# часть событий потеряна, состояние нужно догнать через /mail/sync/
+RESYNC_EVENT = {'action': 'resync'}
+
+
+def make_event(change):
+    """
+    Событие для клиента из записи журнала MailChange
+    """
+    return {
+        'seq': change.seq,
+        'message_id': str(change.message_id),
+        'action': change.action,
+    }
+
+
+class Subscription:
+    """
+    Подписка одного подключения: очередь событий в цикле событий подключения
+    """
+
+    def __init__(self, user_id, maxsize):
+        self.user_id = str(user_id)
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.overflowed = False
+
+    def put(self, event):
+        # Вызывается только в цикле событий подписки
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Клиент не успевает читать: очищаем очередь и просим пересинхронизацию
+            self.overflowed = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC_EVENT)
+
+    async def get(self, timeout):
+        event = await asyncio.wait_for(self.queue.get(), timeout)
+        if event is RESYNC_EVENT:
+            self.overflowed = False
+        return event
+
+
+class EventBroker:
+    """
+    Pub/sub внутри процесса поверх бэкенда
+
+    publish() можно вызывать из любого потока (синхронные view, воркеры);
+    события доставляются в очереди подписок через call_soon_threadsafe.
+    """
+    queue_size = 100
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.subscriptions = defaultdict(set)
+        self.lock = threading.Lock()
+        self.listener = None
+        self.ready = None
+
+    def publish(self, user_id, event):
+        self.backend.publish(str(user_id), event)
+
+    async def subscribe(self, user_id):
+        """
+        Подписывает подключение на события пользователя
+
+        Возвращается после того, как бэкенд начал принимать события,
+        чтобы изменения сразу после подключения не терялись
+        """
+        subscription = Subscription(user_id, self.queue_size)
+        with self.lock:
+            self.subscriptions[subscription.user_id].add(subscription)
+        ready = self.ensure_listener(subscription.loop)
+        await ready.wait()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.subscriptions[subscription.user_id]
+
+    def dispatch(self, user_id, event):
+        """
+        Раздает событие всем подпискам пользователя в этом процессе
+        """
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(str(user_id), ()))
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.put, event)
+            except RuntimeError:
+                # Цикл событий подписки уже закрыт
+                self.unsubscribe(subscription)
+
+    def ensure_listener(self, loop):
+        """
+        Запускает чтение бэкенда в цикле событий, если оно еще не запущено
+        """
+        listener = self.listener
+        if listener is not None and not listener.done():
+            if listener.get_loop() is loop:
+                return self.ready
+            # Цикл событий сменился (например, между тестами) - слушаем в новом
+            if not listener.get_loop().is_closed():
+                listener.get_loop().call_soon_threadsafe(listener.cancel)
+        self.ready = asyncio.Event()
+        self.listener = loop.create_task(self.backend.listen(self.dispatch, self.ready))
+        return self.ready
+
+    def connection_count(self):
+        with self.lock:
+            return sum(len(subscriptions) for subscriptions in self.subscriptions.values())
+
+
+class LocalBackend:
+    """
+    Бэкенд без межпроцессной доставки: события видны только в текущем процессе
+    """
+
+    def __init__(self, location='', **options):
+        self.callback = None
+
+    def publish(self, user_id, event):
+        if self.callback is not None:
+            self.callback(user_id, event)
+
+    async def listen(self, callback, ready):
+        self.callback = callback
+        ready.set()
+        await asyncio.Event().wait()
+
+
+class SQLiteBackend:
+    """
+    Межпроцессный бэкенд на общем файле SQLite
+
+    Каждый процесс опрашивает таблицу событий с интервалом poll_interval
+    (в отдельном потоке, не блокируя цикл событий). Старые события удаляются
+    при публикации, поэтому файл не растет.
+    """
+
+    def __init__(self, location, poll_interval=0.2, retention=60, **options):
+        self.path = location
+        self.poll_interval = poll_interval
+        self.retention = retention
+        with self.connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS mail_events ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL, '
+                'payload TEXT NOT NULL, created REAL NOT NULL)'
+            )
+
+    @contextmanager
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=5)
+        try:
+            with connection:
+                connection.execute('PRAGMA journal_mode=WAL')
+                yield connection
+        finally:
+            connection.close()
+
+    def publish(self, user_id, event):
+        now = time.time()
+        with self.connect() as connection:
+            connection.execute(
+                'INSERT INTO mail_events (user_id, payload, created) VALUES (?, ?, ?)',
+                (user_id, json.dumps(event), now)
+            )
+            connection.execute('DELETE FROM mail_events WHERE created < ?', (now - self.retention,))
+
+    def fetch(self, after):
+        with self.connect() as connection:
+            if after is None:
+                row = connection.execute('SELECT COALESCE(MAX(id), 0) FROM mail_events').fetchone()
+                return row[0], []
+            rows = connection.execute(
+                'SELECT id, user_id, payload FROM mail_events WHERE id > ? ORDER BY id', (after,)
+            ).fetchall()
+        return (rows[-1][0] if rows else after), rows
+
+    async def listen(self, callback, ready):
+        # События, опубликованные до запуска слушателя, не доставляются
+        last_id, _ = await asyncio.to_thread(self.fetch, None)
+        ready.set()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                last_id, rows = await asyncio.to_thread(self.fetch, last_id)
+            except sqlite3.Error:
+                logger.exception('Ошибка чтения событий почты из %s', self.path)
+                continue
+            for _, user_id, payload in rows:
+                callback(user_id, json.loads(payload))
+
+
+class RedisBackend:
+    """
+    Межпроцессный бэкенд на Redis pub/sub (один канал на все события)
+    """
+
+    def __init__(self, location, channel='mail-events', **options):
+        import redis
+
+        self.url = location
+        self.channel = channel
+        self.client = redis.Redis.from_url(location)
+
+    def publish(self, user_id, event):
+        self.client.publish(self.channel, json.dumps({'user_id': user_id, 'event': event}))
+
+    async def listen(self, callback, ready):
+        from redis import asyncio as aioredis
+
+        client = aioredis.from_url(self.url)
+        pubsub = client.pubsub()
+        await pubsub.subscribe(self.channel)
+        ready.set()
+        try:
+            async for message in pubsub.listen():
+                if message['type'] != 'message':
+                    continue
+                data = json.loads(message['data'])
+                callback(data['user_id'], data['event'])
+        finally:
+            await pubsub.aclose()
+            await client.aclose()
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    """
+    Брокер событий процесса, создается по настройке MAIL_EVENTS при первом обращении
+    """
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            config = getattr(settings, 'MAIL_EVENTS', {})
+            backend_class = import_string(config.get('BACKEND', 'mail.events.LocalBackend'))
+            backend = backend_class(config.get('LOCATION', ''), **config.get('OPTIONS', {}))
+            _broker = EventBroker(backend)
+        return _broker
+
+
+def publish_changes(changes):
+    """
+    Публикует записи журнала MailChange их пользователям
+
+    Ошибка бэкенда не должна ломать запрос, изменивший письма: клиент
+    все равно догонит состояние через /mail/sync/
+    """
+    broker = get_broker()
+    for change in changes:
+        try:
+            broker.publish(change.user_id, make_event(change))
+        except Exception:
+            logger.exception('Не удалось опубликовать событие почты')
@@ -0,0 +1,185 @@
+"""
+Выгрузка писем пользователя в mbox или zip для архива
+
+Письма папки (или всех папок) за период читаются keyset-страницами по
+(created_at, id) - в памяти одновременно только одна страница писем с
+участниками и вложениями. Каждое письмо собирается потоком (mail.mime):
+тело - как хранится, зашифрованное письмо остается armor-блоком OpenPGP,
+вложения читаются с диска блоками и кодируются в base64 по мере отдачи.
+Генераторы iter_mbox и iter_zip отдают байты сразу, поэтому выгрузка
+десятков тысяч писем начинается без задержки и не растет в памяти.
+
+mbox - вариант mboxrd: строки, начинающиеся с "From " (с любым числом ">"
+перед ним), экранируются еще одним ">". zip - по файлу .eml на письмо в
+каталоге его папки; файлы пишутся без сжатия (зашифрованные тела и
+большинство вложений почти не сжимаются), размер каждого - после данных.
+"""
+import re
+import zipfile
+from email.utils import format_datetime, formataddr
+
+from django.db import models
+
+from mail.mime import iter_message
+from mail.models import MailMessage
+
+FORMATS = ('mbox', 'zip')
+# Писем в одной странице выборки
+BATCH_SIZE = 100
+# Сколько байтов копить перед отдачей куска ответа
+CHUNK_SIZE = 64 * 1024
+
+mbox_from_pattern = re.compile(rb'^(>*From )', re.MULTILINE)
+
+
+def iter_export_messages(user, folder=None, since=None, until=None, batch_size=None):
+    """
+    Письма пользователя от старых к новым, страницами по (created_at, id)
+
+    folder - имя папки (inbox, sent, drafts, trash) или None для всех писем;
+    since/until ограничивают дату создания (until не включается)
+    """
+    batch_size = batch_size or BATCH_SIZE
+    messages = MailMessage.objects.folder(folder, user)
+    if since is not None:
+        messages = messages.filter(created_at__gte=since)
+    if until is not None:
+        messages = messages.filter(created_at__lt=until)
+    messages = messages.select_related('from_user', 'to_user').prefetch_related('attachments').order_by('created_at', 'id')
+
+    position = None
+    while True:
+        page = messages
+        if position is not None:
+            created_at, pk = position
+            page = page.filter(
+                models.Q(created_at__gte=created_at)
+                & (models.Q(created_at__gt=created_at) | models.Q(id__gt=pk))
+            )
+        batch = list(page[:batch_size])
+        yield from batch
+        if len(batch) < batch_size:
+            return
+        position = batch[-1].created_at, batch[-1].id
+
+
+def ascii_email(email):
+    """
+    Адрес для заголовков: домен IDN (ivan@пример.рф) в punycode
+
+    Если адрес и после этого не ASCII (не-ASCII в локальной части у старых
+    записей), он возвращается как есть
+    """
+    local, at, domain = email.rpartition('@')
+    if at and not domain.isascii():
+        try:
+            domain = domain.encode('idna').decode('ascii')
+        except UnicodeError:
+            pass
+    return f'{local}{at}{domain}'
+
+
+def address(user):
+    name = ' '.join(part for part in (user.first_name, user.last_name) if part)
+    email = ascii_email(user.email)
+    if not email.isascii():
+        # formataddr с charset не принимает не-ASCII адрес: заголовок целиком кодирует mime.encode_header
+        return formataddr((name, email))
+    return formataddr((name, email), charset='utf-8')
+
+
+def folder_of(message, user):
+    """
+    Папка письма у пользователя для каталога в zip
+    """
+    if message.is_in_trash(user):
+        return 'trash'
+    if message.from_user_id == user.id:
+        return 'drafts' if message.is_draft else 'sent'
+    return 'inbox'
+
+
+def iter_eml(message, domain):
+    """
+    Письмо в формате RFC 5322 кусками байтов (строки с CRLF)
+    """
+    headers = {
+        'Date': format_datetime(message.created_at),
+        'Message-ID': f'<{message.id}@{domain}>',
+    }
+    if message.in_reply_to_id:
+        headers['In-Reply-To'] = f'<{message.in_reply_to_id}@{domain}>'
+    attachments = [
+        (attachment.file.path, attachment.filename, attachment.content_type)
+        for attachment in message.attachments.all()
+    ]
+    return iter_message(
+        address(message.from_user), address(message.to_user), message.subject, message.armored_content(),
+        attachments, extra_headers=headers,
+        body_type='text/plain' if message.is_encrypted else 'text/html'
+    )
+
+
+def iter_mbox(messages, domain):
+    """
+    Файл mboxrd кусками байтов не меньше CHUNK_SIZE (кроме последнего)
+    """
+    buffer = bytearray()
+    for message in messages:
+        sender = ascii_email(message.from_user.email)
+        buffer += f'From {sender} {message.created_at:%a %b %d %H:%M:%S %Y}\n'.encode('utf-8')
+        # Куски iter_message заканчиваются концом строки, поэтому строки "From " не разрезаются
+        for chunk in iter_eml(message, domain):
+            buffer += mbox_from_pattern.sub(rb'>\1', chunk.replace(b'\r\n', b'\n'))
+            if len(buffer) >= CHUNK_SIZE:
+                yield bytes(buffer)
+                buffer.clear()
+        buffer += b'\n'
+    yield bytes(buffer)
+
+
+class ZipBuffer:
+    """
+    Поток для ZipFile без seek(): записанные байты забираются через take()
+
+    Без seek() ZipFile пишет размеры файлов после их данных (data descriptor),
+    поэтому архив можно отдавать по мере записи
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def iter_zip(messages, user, domain):
+    """
+    zip-архив с файлом .eml на письмо кусками байтов
+    """
+    stream = ZipBuffer()
+    with zipfile.ZipFile(stream, mode='w', compression=zipfile.ZIP_STORED) as archive:
+        for message in messages:
+            name = f'{folder_of(message, user)}/{message.created_at:%Y-%m-%d_%H%M%S}_{message.id}.eml'
+            # Размер письма заранее неизвестен: force_zip64 допускает файлы больше 2 ГБ
+            with archive.open(name, mode='w', force_zip64=True) as entry:
+                for chunk in iter_eml(message, domain):
+                    entry.write(chunk)
+                    if len(stream.buffer) >= CHUNK_SIZE:
+                        yield stream.take()
+    # Остаток последнего письма и оглавление архива
+    yield stream.take()
@@ -0,0 +1,219 @@
+"""
+Фоновое создание пар PGP ключей
+
+Создание RSA-4096 занимает от секунд до минут, поэтому запрос только ставит
+задание PGPKeyJob, а ключи создает воркер (команда mail_keyworker). Клиент
+опрашивает статус задания.
+
+Если включен запас (MAIL_KEYGEN['POOL_SIZE'] > 0), воркер заранее создает
+пары ключей без пароля GnuPG и хранит приватный ключ зашифрованным ключом
+сервера. Тогда новый пользователь получает пару прямо в запросе, за
+миллисекунды: приватный ключ из запаса сразу шифруется паролем пользователя
+(AES-256). У ключей из запаса служебный адрес (MAIL_KEYGEN['POOL_EMAIL']):
+владельца ключа определяет запись PGPKey.
+
+Ключи создаются во временном каталоге GnuPG, а не в общем keyring почты.
+"""
+import base64
+import hashlib
+import logging
+import subprocess
+import tempfile
+from datetime import timedelta
+
+import gnupg
+from cryptography.fernet import Fernet
+from django.conf import settings
+from django.db import models, transaction
+from django.utils import timezone
+
+from mail.models import PGPKey, PGPKeyJob, PregeneratedKey
+
+logger = logging.getLogger('mail_service')
+
+
+def get_config():
+    config = getattr(settings, 'MAIL_KEYGEN', {})
+    return {
+        'KEY_LENGTH': config.get('KEY_LENGTH', 4096),
+        'POOL_SIZE': config.get('POOL_SIZE', 0),
+        'POOL_EMAIL': config.get('POOL_EMAIL', 'keys@localhost'),
+    }
+
+
+def server_cipher():
+    """
+    Fernet с ключом, производным от SECRET_KEY: для данных, которые ждут воркер или выдачи
+    """
+    digest = hashlib.sha256(f'mail-keygen:{settings.SECRET_KEY}'.encode('utf-8')).digest()
+    return Fernet(base64.urlsafe_b64encode(digest))
+
+
+def generate_key_material(name, email, passphrase=None):
+    """
+    Создает пару RSA-ключей во временном каталоге GnuPG
+
+    Без passphrase приватный ключ экспортируется без пароля GnuPG.
+    Возвращает (public_key, private_key, fingerprint) или None при ошибке.
+    """
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as home:
+        gpg = gnupg.GPG(gnupghome=home)
+        gpg.encoding = 'utf-8'
+        try:
+            input_data = gpg.gen_key_input(
+                name_real=name,
+                name_email=email,
+                key_type='RSA',
+                key_length=get_config()['KEY_LENGTH'],
+                expire_date=0,
+                passphrase=passphrase,
+                no_protection=passphrase is None
+            )
+            key = gpg.gen_key(input_data)
+            if not key:
+                logger.error(f"Не удалось создать ключи: {key.stderr}")
+                return None
+            public_key = gpg.export_keys(key.fingerprint)
+            if passphrase is None:
+                private_key = gpg.export_keys(key.fingerprint, True, expect_passphrase=False)
+            else:
+                private_key = gpg.export_keys(key.fingerprint, True, passphrase=passphrase)
+            return public_key, private_key, key.fingerprint
+        finally:
+            # gpg-agent временного каталога больше не нужен
+            subprocess.run(['gpgconf', '--homedir', home, '--kill', 'gpg-agent'], capture_output=True)
+
+
+def assign_key(user, public_key, private_key, passphrase, fingerprint=''):
+    """
+    Сохраняет пару ключей пользователю; приватный ключ шифруется паролем (AES-256)
+    """
+    from mail.utils import save_private_key_encrypted
+
+    pgp_key, _ = PGPKey.objects.update_or_create(
+        user=user,
+        defaults={
+            'public_key': public_key,
+            'private_key_encrypted': save_private_key_encrypted(private_key, passphrase),
+            'fingerprint': fingerprint,
+            'session_key': None,
+            'session_expires': None,
+        }
+    )
+    return pgp_key
+
+
+def take_pooled_key():
+    """
+    Забирает одну пару из запаса; None, если запас пуст
+
+    Строка удаляется условным DELETE: если ту же пару параллельно забрал
+    другой запрос, берется следующая.
+    """
+    for _ in range(5):
+        pooled = PregeneratedKey.objects.order_by('created_at').first()
+        if pooled is None:
+            return None
+        if PregeneratedKey.objects.filter(pk=pooled.pk).delete()[0]:
+            return pooled
+    return None
+
+
+def assign_pooled_key(user, passphrase):
+    """
+    Выдает пользователю пару из запаса; False, если запас пуст
+
+    Вызывается в транзакции: при ошибке пара возвращается в запас
+    """
+    pooled = take_pooled_key()
+    if pooled is None:
+        return False
+    private_key = server_cipher().decrypt(pooled.private_key_encrypted.encode('utf-8')).decode('utf-8')
+    assign_key(user, pooled.public_key, private_key, passphrase, pooled.fingerprint)
+    return True
+
+
+def start_generation(user, passphrase):
+    """
+    Создает задание на пару ключей; при наличии запаса выполняет его сразу
+    """
+    with transaction.atomic():
+        if assign_pooled_key(user, passphrase):
+            return PGPKeyJob.objects.create(user=user, status='done', from_pool=True)
+
+    return PGPKeyJob.objects.create(
+        user=user,
+        passphrase_encrypted=server_cipher().encrypt(passphrase.encode('utf-8')).decode('utf-8')
+    )
+
+
+def claim_job(stale_after=timedelta(minutes=30)):
+    """
+    Следующее ожидающее задание, помеченное как выполняемое этим воркером
+
+    Задание, которое выполняется дольше stale_after, считается брошенным
+    (воркер остановили) и берется снова
+    """
+    available = (
+        models.Q(status='pending')
+        | models.Q(status='running', updated_at__lt=timezone.now() - stale_after)
+    )
+    for job in PGPKeyJob.objects.filter(available).select_related('user').order_by('created_at')[:10]:
+        claimed = PGPKeyJob.objects.filter(pk=job.pk, status=job.status, updated_at=job.updated_at).update(
+            status='running', updated_at=timezone.now()
+        )
+        if claimed:
+            job.status = 'running'
+            return job
+    return None
+
+
+def run_job(job):
+    """
+    Создает ключи по заданию; пароль удаляется из задания в любом случае
+    """
+    passphrase = server_cipher().decrypt(job.passphrase_encrypted.encode('utf-8')).decode('utf-8')
+    job.passphrase_encrypted = ''
+    try:
+        # Запас мог пополниться, пока задание ждало в очереди
+        with transaction.atomic():
+            job.from_pool = assign_pooled_key(job.user, passphrase)
+        if not job.from_pool:
+            material = generate_key_material(job.user.get_full_name() or job.user.email, job.user.email, passphrase)
+            if material is None:
+                raise RuntimeError('GnuPG не создал ключи')
+            public_key, private_key, fingerprint = material
+            assign_key(job.user, public_key, private_key, passphrase, fingerprint)
+        job.status = 'done'
+    except Exception as e:
+        logger.exception(f"Ошибка создания ключей для {job.user_id}")
+        job.status = 'failed'
+        job.error = str(e)
+    job.save(update_fields=['status', 'passphrase_encrypted', 'from_pool', 'error', 'updated_at'])
+    return job
+
+
+def refill_pool(limit=None):
+    """
+    Создает пары в запас до MAIL_KEYGEN['POOL_SIZE'], не больше limit за вызов
+
+    Возвращает число созданных пар
+    """
+    config = get_config()
+    missing = config['POOL_SIZE'] - PregeneratedKey.objects.count()
+    if limit is not None:
+        missing = min(missing, limit)
+    created = 0
+    cipher = server_cipher()
+    for _ in range(max(missing, 0)):
+        material = generate_key_material('Mail key pool', config['POOL_EMAIL'])
+        if material is None:
+            break
+        public_key, private_key, fingerprint = material
+        PregeneratedKey.objects.create(
+            public_key=public_key,
+            private_key_encrypted=cipher.encrypt(private_key.encode('utf-8')).decode('utf-8'),
+            fingerprint=fingerprint
+        )
+        created += 1
+    return created
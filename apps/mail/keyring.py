@@ -0,0 +1,142 @@
+"""
+Публичные ключи получателей в общем keyring GnuPG
+
+Импорт ключа - это отдельный процесс gpg и запись в pubring.kbx, поэтому
+ключ импортируется один раз на процесс: PublicKeyCache запоминает отпечаток
+по SHA-256 текста ключа, и следующие шифрования сразу используют отпечаток.
+Новый текст ключа дает новый хеш, так что смена PGPKey.public_key в другом
+процессе не приводит к шифрованию старым ключом; в своем процессе запись
+удаляется сразу при сохранении PGPKey.
+
+Если ключа из кеша уже нет в keyring (его удалила compact_keyring), шифрование
+не проходит - ключ импортируется заново и шифрование повторяется один раз.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from mail.models import PGPKey
+
+
+def key_digest(public_key):
+    """
+    Хеш текста ключа: ключ для кеша, не зависящий от пробелов по краям
+    """
+    return hashlib.sha256(public_key.strip().encode('utf-8')).hexdigest()
+
+
+class PublicKeyCache:
+    """
+    Отпечатки импортированных ключей процесса: {хеш текста ключа: отпечаток}
+
+    Объем ограничен: вытесненный ключ при следующем шифровании импортируется заново
+    """
+
+    def __init__(self, gpg, max_size=1024):
+        self.gpg = gpg
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def fingerprint(self, public_key):
+        """
+        Отпечаток ключа; при первом обращении ключ импортируется в keyring
+
+        None - ключ не удалось импортировать
+        """
+        digest = key_digest(public_key)
+        with self.lock:
+            fingerprint = self.items.get(digest)
+            if fingerprint is not None:
+                self.items.move_to_end(digest)
+                return fingerprint
+
+        result = self.gpg.import_keys(public_key)
+        if not result or not result.fingerprints:
+            return None
+        fingerprint = result.fingerprints[0]
+        with self.lock:
+            self.items[digest] = fingerprint
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+        return fingerprint
+
+    def forget(self, public_key):
+        """
+        Удаляет ключ из кеша; True, если он там был
+        """
+        with self.lock:
+            return self.items.pop(key_digest(public_key), None) is not None
+
+    def forget_fingerprints(self, fingerprints):
+        fingerprints = set(fingerprints)
+        with self.lock:
+            for digest in [digest for digest, value in self.items.items() if value in fingerprints]:
+                del self.items[digest]
+
+    def encrypt(self, content, public_key, armor=True):
+        """
+        Шифрует content ключом получателя; возвращает результат gpg.encrypt или None
+
+        armor=False - двоичное сообщение в .data вместо armor-текста
+        """
+        fingerprint = self.fingerprint(public_key)
+        if fingerprint is None:
+            return None
+        encrypted = self.gpg.encrypt(content, fingerprint, always_trust=True, armor=armor)
+        if not encrypted.ok and self.forget(public_key):
+            # Ключ могли удалить из keyring после того, как он попал в кеш
+            fingerprint = self.fingerprint(public_key)
+            if fingerprint is not None:
+                encrypted = self.gpg.encrypt(content, fingerprint, always_trust=True, armor=armor)
+        return encrypted
+
+
+def owned_fingerprints(gpg):
+    """
+    Отпечатки ключей, у которых есть владелец (строка PGPKey)
+
+    Отпечатки, которых еще нет в PGPKey.fingerprint, вычисляются без записи
+    в keyring (scan_keys_mem) и сохраняются
+    """
+    owned = set()
+    keys = PGPKey.objects.order_by().values_list('pk', 'public_key', 'fingerprint')
+    for pk, public_key, fingerprint in keys.iterator(chunk_size=500):
+        if not fingerprint and public_key:
+            scanned = gpg.scan_keys_mem(public_key)
+            if not scanned:
+                continue
+            fingerprint = scanned[0]['fingerprint']
+            # Ключ мог смениться после выборки - тогда отпечаток не сохраняем
+            PGPKey.objects.filter(pk=pk, public_key=public_key).update(fingerprint=fingerprint)
+        if fingerprint:
+            owned.add(fingerprint)
+    return owned
+
+
+def compact_keyring(gpg, grace=timedelta(hours=1), dry_run=False):
+    """
+    Удаляет из keyring ключи, владельцев которых больше нет
+
+    Ключи, созданные позже now - grace, не трогаются: пара ключей, только что
+    сгенерированная generate_pgp_key_pair, еще может быть не сохранена в PGPKey.
+    Возвращает список отпечатков удаленных ключей.
+    """
+    owned = owned_fingerprints(gpg)
+    threshold = time.time() - grace.total_seconds()
+    secret = {key['fingerprint'] for key in gpg.list_keys(True)}
+    stale = [
+        key['fingerprint'] for key in gpg.list_keys()
+        if key['fingerprint'] not in owned and int(key['date'] or 0) < threshold
+    ]
+    if dry_run or not stale:
+        return stale
+
+    # Секретную часть нужно удалить раньше публичной, иначе gpg откажется
+    stale_secret = [fingerprint for fingerprint in stale if fingerprint in secret]
+    if stale_secret:
+        gpg.delete_keys(stale_secret, secret=True, expect_passphrase=False)
+    gpg.delete_keys(stale)
+    return stale
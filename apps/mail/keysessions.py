@@ -0,0 +1,214 @@
+"""
+Сессии расшифровки: разблокированные приватные ключи в памяти воркера
+
+При создании сессии (PGPKeyViewSet.create_session) приватный ключ
+расшифровывается паролем (AES-256), импортируется в отдельный каталог GnuPG
+и с него снимается пароль GnuPG - это и проверяет пароль. Каталог остается
+открытым до конца сессии: повторные расшифровки идут без производства ключа
+из пароля и без импорта, одним вызовом gpg.
+
+Разблокированные ключи хранятся только в памяти процесса (UnlockedKeyCache,
+TTL по PGPKey.session_expires и LRU по числу ключей), а каталоги GnuPG
+создаются в tmpfs (/dev/shm), если он есть. end_session, истечение сессии и
+вытеснение удаляют каталог. Другой воркер сессии не знает: если ключа в его
+памяти нет, запрос может передать пароль, и ключ разблокируется заново.
+
+Настройки MAIL_KEY_SESSIONS: MAX_SIZE, DIRECTORY.
+"""
+import atexit
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from collections import OrderedDict
+
+import gnupg
+from django.conf import settings
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from mail.crypto import get_pool
+
+
+class SessionLocked(APIException):
+    """
+    У пользователя нет разблокированного ключа в этом воркере
+    """
+    status_code = status.HTTP_403_FORBIDDEN
+    default_detail = 'Сессия PGP не активна: создайте сессию или передайте пароль от приватного ключа'
+    default_code = 'session_locked'
+
+
+class DecryptionFailed(Exception):
+    """
+    Сообщение не удалось расшифровать ключом сессии
+    """
+
+
+def get_config():
+    config = getattr(settings, 'MAIL_KEY_SESSIONS', {})
+    directory = config.get('DIRECTORY')
+    if directory is None and os.path.isdir('/dev/shm'):
+        directory = '/dev/shm'
+    return {'MAX_SIZE': config.get('MAX_SIZE', 64), 'DIRECTORY': directory}
+
+
+class UnlockedKey:
+    """
+    Каталог GnuPG с приватным ключом пользователя без пароля
+    """
+
+    def __init__(self, home, fingerprint, expires_at):
+        self.home = home
+        self.fingerprint = fingerprint
+        self.expires_at = expires_at
+        self.gpg = gnupg.GPG(gnupghome=home)
+        self.gpg.encoding = 'utf-8'
+
+    def is_expired(self):
+        return self.expires_at is not None and self.expires_at <= timezone.now()
+
+    def decrypt(self, encrypted_content):
+        decrypted = self.gpg.decrypt(encrypted_content)
+        if not decrypted.ok:
+            raise DecryptionFailed(decrypted.status or 'Ошибка расшифровки')
+        return str(decrypted)
+
+    def wipe(self):
+        subprocess.run(['gpgconf', '--homedir', self.home, '--kill', 'gpg-agent'], capture_output=True)
+        shutil.rmtree(self.home, ignore_errors=True)
+
+
+def is_protected(gpg, private_key):
+    """
+    Защищен ли экспортированный приватный ключ паролем GnuPG
+    """
+    result = subprocess.run(gpg.make_args(['--list-packets'], False), input=private_key.encode('utf-8'), capture_output=True)
+    return b'protected]' in result.stdout
+
+
+def remove_protection(gpg, fingerprint, passphrase):
+    """
+    Снимает пароль GnuPG с ключа в каталоге сессии; False - пароль неверный
+    """
+    args = gpg.make_args(['--pinentry-mode', 'loopback', '--command-fd', '0', '--passwd', fingerprint], False)
+    # Старый пароль, затем пустой новый пароль и его подтверждение
+    result = subprocess.run(args, input=f'{passphrase}\n\n\n'.encode('utf-8'), capture_output=True)
+    return b'SUCCESS keyedit.passwd' in result.stderr
+
+
+def unlock(pgp_key, passphrase, expires_at):
+    """
+    Разблокирует ключ пользователя; ValueError - неверный пароль или поврежденный ключ
+
+    Долгая операция (производство ключа из пароля в gpg) - вызывается в пуле crypto
+    """
+    from mail.utils import decrypt_private_key
+
+    private_key = decrypt_private_key(pgp_key.private_key_encrypted, passphrase)
+    if 'PRIVATE KEY BLOCK' not in private_key:
+        raise ValueError("Неверный пароль или поврежденный ключ")
+
+    home = tempfile.mkdtemp(prefix='mail-session-', dir=get_config()['DIRECTORY'])
+    unlocked = UnlockedKey(home, '', expires_at)
+    try:
+        result = unlocked.gpg.import_keys(private_key)
+        if not result or not result.fingerprints:
+            raise ValueError("Не удалось импортировать приватный ключ")
+        unlocked.fingerprint = result.fingerprints[0]
+        if is_protected(unlocked.gpg, private_key) and not remove_protection(unlocked.gpg, unlocked.fingerprint, passphrase):
+            raise ValueError("Неверный пароль от приватного ключа")
+    except BaseException:
+        unlocked.wipe()
+        raise
+    return unlocked
+
+
+class UnlockedKeyCache:
+    """
+    Разблокированные ключи процесса: {user_id: UnlockedKey}
+
+    Ключ живет до истечения сессии; при переполнении вытесняется давно не использованный
+    """
+
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, user_id, fingerprint=None):
+        """
+        Ключ пользователя или None; истекший или замененный ключ удаляется
+        """
+        with self.lock:
+            unlocked = self.items.get(user_id)
+            if unlocked is None:
+                return None
+            if unlocked.is_expired() or (fingerprint and unlocked.fingerprint != fingerprint):
+                del self.items[user_id]
+            else:
+                self.items.move_to_end(user_id)
+                return unlocked
+        unlocked.wipe()
+        return None
+
+    def put(self, user_id, unlocked):
+        evicted = []
+        with self.lock:
+            previous = self.items.pop(user_id, None)
+            if previous is not None and previous is not unlocked:
+                evicted.append(previous)
+            for expired in [user for user, key in self.items.items() if key.is_expired()]:
+                evicted.append(self.items.pop(expired))
+            self.items[user_id] = unlocked
+            while len(self.items) > self.max_size:
+                evicted.append(self.items.popitem(last=False)[1])
+        for key in evicted:
+            key.wipe()
+
+    def discard(self, user_id):
+        with self.lock:
+            unlocked = self.items.pop(user_id, None)
+        if unlocked is not None:
+            unlocked.wipe()
+
+    def clear(self):
+        with self.lock:
+            keys = list(self.items.values())
+            self.items.clear()
+        for key in keys:
+            key.wipe()
+
+
+unlocked_keys = UnlockedKeyCache(get_config()['MAX_SIZE'])
+# Каталоги с ключами без пароля не должны переживать процесс
+atexit.register(unlocked_keys.clear)
+
+
+def start_session(pgp_key, passphrase):
+    """
+    Разблокирует ключ в пуле crypto и кладет его в память воркера до pgp_key.session_expires
+    """
+    unlocked = get_pool().call(unlock, pgp_key, passphrase, pgp_key.session_expires)
+    unlocked_keys.put(pgp_key.user_id, unlocked)
+    return unlocked
+
+
+def get_unlocked_key(pgp_key, passphrase=None):
+    """
+    Разблокированный ключ активной сессии пользователя
+
+    Если в памяти этого воркера ключа нет, он разблокируется переданным
+    паролем; без пароля - SessionLocked
+    """
+    if not pgp_key.is_session_valid():
+        unlocked_keys.discard(pgp_key.user_id)
+        raise SessionLocked()
+    unlocked = unlocked_keys.get(pgp_key.user_id, pgp_key.fingerprint or None)
+    if unlocked is not None:
+        return unlocked
+    if not passphrase:
+        raise SessionLocked()
+    return start_session(pgp_key, passphrase)
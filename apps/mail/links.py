@@ -0,0 +1,84 @@
+"""
+Связи писем с вложениями (MailMessage.attachments)
+
+Клиент перечисляет вложения письма в attachments_meta ([{id, name, size, type}]).
+Связи M2M создаются при сохранении письма одной вставкой (link). Раньше
+связи старых писем восстанавливались при каждом чтении письма поштучными
+запросами; такие письма один раз переносит миграция 0025, письма,
+импортированные в обход API, - backfill (команда mail_attachment_backfill),
+и чтение писем больше ничего не пишет.
+"""
+import uuid
+
+from django.db import transaction
+
+from mail.models import MailAttachment, MailMessage
+
+
+def meta_attachment_ids(meta):
+    """
+    id вложений из attachments_meta; записи без id или с неверным id пропускаются
+    """
+    ids = set()
+    for item in meta or ():
+        if not isinstance(item, dict) or not item.get('id'):
+            continue
+        try:
+            ids.add(uuid.UUID(str(item['id'])))
+        except ValueError:
+            continue
+    return ids
+
+
+def link(messages, attachments=None):
+    """
+    Связывает письма с вложениями из их attachments_meta; вернет число новых связей
+
+    Один SELECT вложений, один INSERT связей на весь набор писем и COUNT
+    связей этих писем до и после него. Уже существующие связи (в том числе
+    созданные параллельно) INSERT пропускает, а bulk_create с ignore_conflicts
+    возвращает все переданные объекты - поэтому новые связи считаются по
+    числу строк. attachments - QuerySet вложений, которые можно связать
+    (например, доступные отправителю); по умолчанию любые
+    """
+    if attachments is None:
+        attachments = MailAttachment.objects.all()
+    wanted = {message.pk: meta_attachment_ids(message.attachments_meta) for message in messages}
+    ids = set().union(*wanted.values())
+    if not ids:
+        return 0
+
+    existing = set(attachments.filter(pk__in=ids).values_list('pk', flat=True))
+    through = MailMessage.attachments.through
+    rows = [
+        through(mailmessage_id=message_id, mailattachment_id=attachment_id)
+        for message_id, attachment_ids in wanted.items()
+        for attachment_id in attachment_ids & existing
+    ]
+    if not rows:
+        return 0
+    message_links = through.objects.filter(mailmessage_id__in=list(wanted))
+    with transaction.atomic():
+        before = message_links.count()
+        through.objects.bulk_create(rows, ignore_conflicts=True)
+        return message_links.count() - before
+
+
+def backfill(batch_size=1000):
+    """
+    Создает недостающие связи для всех писем с attachments_meta; вернет (писем, связей)
+
+    Письма читаются пачками по первичному ключу (keyset, без OFFSET), каждая
+    пачка связывается одним вызовом link()
+    """
+    messages = MailMessage.objects.exclude(attachments_meta=[]).order_by('pk').only('pk', 'attachments_meta')
+    count = linked = 0
+    last_pk = None
+    while True:
+        page = messages.filter(pk__gt=last_pk) if last_pk else messages
+        batch = list(page[:batch_size])
+        if not batch:
+            return count, linked
+        last_pk = batch[-1].pk
+        linked += link(batch)
+        count += len(batch)
@@ -0,0 +1,292 @@
+"""
+Учет состояния почтовых ящиков
+
+Каждое письмо вносит вклад в папки своих участников: входящее непрочитанное
+письмо добавляет получателю inbox_total и inbox_unread, удаленное отправителем -
+trash_total отправителю и т.д. Вклад считает одна функция message_contributions()
+по тем же правилам, что и условия папок в MailMessageQuerySet.
+
+Любое изменение писем выполняется внутри track(): до изменения запоминается вклад
+затронутых писем, после - вычисляется новый, и разница применяется к
+MailboxCounters в той же транзакции. Там же для каждого участника, у которого
+письмо сменило папку, пишется запись MailChange для дельта-синхронизации,
+а после коммита эти записи публикуются подключенным клиентам (mail.events).
+В той же транзакции новым письмам назначаются переписки и пересчитываются
+агрегаты затронутых переписок (mail.threads).
+"""
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from django.db import IntegrityError, models, transaction
+
+from mail import events, search, threads
+from mail.models import MailChange, MailMessage, MailboxCounters
+
+# Поля письма, от которых зависят папки
+STATE_FIELDS = (
+    'id', 'from_user_id', 'to_user_id', 'is_draft',
+    'is_deleted_by_sender', 'is_deleted_by_recipient', 'is_read',
+)
+
+
+def get_state(message):
+    """
+    Состояние письма, от которого зависят папки: из экземпляра модели или из словаря values()
+    """
+    if isinstance(message, dict):
+        return {field: message[field] for field in STATE_FIELDS}
+    return {field: getattr(message, field) for field in STATE_FIELDS}
+
+
+def message_contributions(state):
+    """
+    Возвращает {user_id: frozenset(имен счетчиков)}, в которые письмо входит для каждого участника
+    """
+    sender, recipient = state['from_user_id'], state['to_user_id']
+    unread = not state['is_read']
+    result = defaultdict(set)
+
+    if not state['is_deleted_by_sender']:
+        result[sender].add('drafts_total' if state['is_draft'] else 'sent_total')
+
+    if not state['is_draft'] and not state['is_deleted_by_recipient']:
+        result[recipient].add('inbox_total')
+        if unread:
+            result[recipient].add('inbox_unread')
+
+    # Письмо самому себе, удаленное с обеих сторон, лежит в корзине один раз
+    in_trash = set()
+    if state['is_deleted_by_sender']:
+        in_trash.add(sender)
+    if state['is_deleted_by_recipient']:
+        in_trash.add(recipient)
+    for user_id in in_trash:
+        result[user_id].add('trash_total')
+        if user_id == recipient and unread:
+            result[user_id].add('trash_unread')
+
+    return {user_id: frozenset(counters) for user_id, counters in result.items()}
+
+
+def snapshot(messages):
+    """
+    Вклад набора писем: {message_id: {user_id: frozenset(счетчиков)}}
+    """
+    snapshots = {}
+    for message in messages:
+        state = get_state(message)
+        snapshots[state['id']] = message_contributions(state)
+    return snapshots
+
+
+def counter_deltas(before, after):
+    """
+    Разница двух снимков: {user_id: Counter(счетчик -> изменение)}
+    """
+    deltas = defaultdict(Counter)
+    for message_id in before.keys() | after.keys():
+        old = before.get(message_id, {})
+        new = after.get(message_id, {})
+        for user_id in old.keys() | new.keys():
+            old_counters = old.get(user_id, frozenset())
+            new_counters = new.get(user_id, frozenset())
+            for name in new_counters - old_counters:
+                deltas[user_id][name] += 1
+            for name in old_counters - new_counters:
+                deltas[user_id][name] -= 1
+    return deltas
+
+
+# Счетчики, по которым определяется папка письма у пользователя
+FOLDER_COUNTERS = (
+    ('inbox', 'inbox_total'),
+    ('sent', 'sent_total'),
+    ('drafts', 'drafts_total'),
+    ('trash', 'trash_total'),
+)
+
+
+def folders_of(counters):
+    """
+    Имена папок, в которых лежит письмо, по набору его счетчиков
+    """
+    return [folder for folder, name in FOLDER_COUNTERS if name in counters]
+
+
+def classify_change(old, new):
+    """
+    Действие, которым письмо перешло из набора счетчиков old в new у одного пользователя
+    """
+    if not old:
+        return 'created'
+    if not new:
+        return 'deleted'
+    if 'trash_total' in new and 'trash_total' not in old:
+        return 'trashed'
+    if 'trash_total' in old and 'trash_total' not in new:
+        return 'restored'
+    if folders_of(old) == folders_of(new):
+        became_read = {'inbox_unread', 'trash_unread'} & (old - new)
+        return 'read' if became_read else 'unread'
+    return 'moved'
+
+
+def message_changes(before, after, action=None):
+    """
+    Изменения писем по участникам: список (user_id, message_id, действие)
+
+    Если передано action, оно записывается и для участников, у которых папки
+    не изменились (например, правка темы черновика)
+    """
+    changes = []
+    for message_id in before.keys() | after.keys():
+        old = before.get(message_id, {})
+        new = after.get(message_id, {})
+        for user_id in old.keys() | new.keys():
+            old_counters = old.get(user_id, frozenset())
+            new_counters = new.get(user_id, frozenset())
+            if old_counters != new_counters:
+                changes.append((user_id, message_id, classify_change(old_counters, new_counters)))
+            elif action:
+                changes.append((user_id, message_id, action))
+    return changes
+
+
+def record_changes(changes):
+    """
+    Записывает изменения в журнал MailChange одним INSERT
+    """
+    return MailChange.objects.bulk_create([
+        MailChange(user_id=user_id, message_id=message_id, action=action)
+        for user_id, message_id, action in changes
+    ])
+
+
+def apply_counter_deltas(deltas):
+    """
+    Применяет изменения счетчиков одним UPDATE на пользователя
+    """
+    for user_id, delta in deltas.items():
+        values = {name: models.F(name) + change for name, change in delta.items() if change}
+        if not values:
+            continue
+        counters = MailboxCounters.objects.filter(user_id=user_id)
+        if not counters.update(**values):
+            # Строки еще нет - у пользователя не было писем
+            try:
+                with transaction.atomic():
+                    MailboxCounters.objects.create(user_id=user_id)
+            except IntegrityError:
+                pass
+            counters.update(**values)
+
+
+def apply_snapshots(before, after, action=None):
+    """
+    Применяет разницу снимков: счетчики, журнал MailChange и события после коммита
+
+    Снимки можно строить и по словарям values() - так массовые операции
+    учитывают изменения без загрузки экземпляров моделей
+    """
+    apply_counter_deltas(counter_deltas(before, after))
+    changes = record_changes(message_changes(before, after, action))
+    if changes:
+        # Подключенные клиенты узнают об изменениях только после коммита
+        transaction.on_commit(lambda: events.publish_changes(changes))
+
+
+def lock_states(messages):
+    """
+    Перечитывает состояние писем под блокировкой строк (SELECT ... FOR UPDATE)
+
+    Экземпляры загружены до транзакции: если два запроса одновременно
+    отмечают прочтение или удаляют одно письмо, оба увидели бы одно и то же
+    исходное состояние и применили бы одну разницу к счетчикам дважды.
+    Второй запрос ждет блокировку и получает состояние, уже измененное первым.
+    """
+    ids = [message.pk for message in messages if message.pk is not None]
+    if not ids:
+        return
+    states = {
+        state['id']: state
+        for state in MailMessage.objects.select_for_update().filter(pk__in=ids).order_by('pk').values(*STATE_FIELDS)
+    }
+    for message in messages:
+        state = states.get(message.pk)
+        if state is None:
+            continue
+        for field in STATE_FIELDS[1:]:
+            setattr(message, field, state[field])
+
+
+class MailboxTransition:
+    """
+    Изменение набора писем, отслеживаемое для счетчиков и журнала изменений
+
+    Письма, переданные в конструктор, перечитываются под блокировкой строк
+    (lock_states) и запоминаются в исходном состоянии.
+    Новые письма добавляются через add() после сохранения. Удаленные письма
+    (pk стал None после delete()) считаются выбывшими из всех папок.
+    Новые и измененные целиком (action='updated') письма индексируются для поиска.
+    Новые письма получают переписку; агрегаты переписок пересчитываются, если
+    письма в них появились, удалены или изменены целиком (отправка черновика,
+    вложения). Прочтение и корзина на агрегаты не влияют.
+    """
+
+    def __init__(self, messages=(), action=None):
+        self.messages = list(messages)
+        self.action = action
+        lock_states(self.messages)
+        self.before = snapshot(self.messages)
+
+    def add(self, *messages):
+        self.messages.extend(messages)
+
+    def commit(self):
+        alive = [message for message in self.messages if message.pk is not None]
+        created = [message for message in alive if message.pk not in self.before]
+        threads.assign(created)
+        apply_snapshots(self.before, snapshot(alive), self.action)
+        indexed = [message.pk for message in alive if self.action == 'updated' or message.pk not in self.before]
+        if indexed:
+            search.index_messages(indexed)
+        if created or self.action == 'updated' or len(alive) < len(self.messages):
+            threads.refresh(message.thread_id for message in self.messages if message.thread_id)
+
+
+@contextmanager
+def track(messages=(), action=None):
+    """
+    Контекстный менеджер для изменения писем вместе со счетчиками в одной транзакции
+
+    Пример:
+        with mailbox.track([message]):
+            message.is_deleted_by_sender = True
+            message.save()
+    """
+    with transaction.atomic():
+        transition = MailboxTransition(messages, action=action)
+        yield transition
+        transition.commit()
+
+
+def rebuild_counters(batch_size=2000):
+    """
+    Пересчитывает счетчики всех ящиков с нуля одним проходом по письмам (команда mail_rebuild_counters)
+    """
+    totals = defaultdict(Counter)
+    states = MailMessage.objects.order_by().values(*STATE_FIELDS).iterator(chunk_size=batch_size)
+    for state in states:
+        for user_id, counters in message_contributions(state).items():
+            totals[user_id].update(counters)
+
+    with transaction.atomic():
+        MailboxCounters.objects.all().delete()
+        MailboxCounters.objects.bulk_create(
+            [
+                MailboxCounters(user_id=user_id, **{name: total[name] for name in MailboxCounters.COUNTER_FIELDS})
+                for user_id, total in totals.items()
+            ],
+            batch_size=batch_size
+        )
+    return len(totals)
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from mail import links
+
+
+class Command(BaseCommand):
+    """
+    Связи писем с вложениями по attachments_meta
+
+    Миграция 0025 переносит связи один раз; команда нужна, если письма с
+    attachments_meta появились в обход API (импорт, ручные правки базы).
+    Существующие связи не дублируются, команду можно запускать повторно.
+
+    Пример:
+        python manage.py mail_attachment_backfill --batch-size 2000
+    """
+    help = 'Создает недостающие связи писем с вложениями из attachments_meta'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000, help='Размер пачки писем')
+
+    def handle(self, *args, **options):
+        count, linked = links.backfill(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Проверено писем: {count}, создано связей: {linked}'))
@@ -0,0 +1,543 @@
+import os
+import shutil
+import smtplib
+import tempfile
+import time
+import tracemalloc
+import uuid
+from datetime import timedelta
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import gnupg
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count, Max, Sum
+from django.db.models.functions import Length
+from django.test.utils import override_settings
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from mail.armor import armor, dearmor
+from mail import export, links, search, threads
+from mail.cleanup import collect_orphan_attachments
+from mail.keyring import PublicKeyCache
+from mail.models import MailAttachment, MailMessage, OutboundEmail
+from mail.mime import iter_message, write_message
+from mail.outbox import SMTPConnection, claim_batch, deliver, enqueue
+from mail.pagination import MailCursorPagination
+from mail.smtpsink import SMTPSink
+from mail.views import MailThreadViewSet, MailViewSet
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    """
+    Замеры производительности почты на синтетических данных
+
+    Данные создаются внутри транзакции, которая откатывается в конце,
+    поэтому команду можно запускать на рабочей базе.
+
+    Пример:
+        python manage.py mail_benchmark trash --messages 100000
+        python manage.py mail_benchmark gc --messages 100000
+        python manage.py mail_benchmark encrypt --messages 500
+        python manage.py mail_benchmark smtp --messages 1000
+        python manage.py mail_benchmark mime --messages 200
+        python manage.py mail_benchmark bodies --messages 20000
+        python manage.py mail_benchmark search --messages 100000
+        python manage.py mail_benchmark threads --messages 100000
+        python manage.py mail_benchmark links --messages 20000
+        python manage.py mail_benchmark export --messages 20000
+    """
+    help = 'Замеры производительности почты на синтетических данных'
+
+    scenarios = ('trash', 'gc', 'encrypt', 'smtp', 'mime', 'bodies', 'search', 'threads', 'links', 'export')
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=self.scenarios, help='Сценарий замера')
+        parser.add_argument('--messages', type=int, default=100000, help='Размер почтового ящика')
+        parser.add_argument('--repeat', type=int, default=10, help='Число повторов каждого замера')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Размер пачки bulk_create при наполнении')
+
+    def handle(self, *args, **options):
+        self.repeat = options['repeat']
+        # Запросы к view строятся APIRequestFactory с хостом testserver
+        with override_settings(ALLOWED_HOSTS=['testserver']), transaction.atomic():
+            getattr(self, f'run_{options["scenario"]}')(options)
+            transaction.set_rollback(True)
+
+    def measure(self, label, func):
+        """
+        Выполняет func заданное число раз и печатает медиану в миллисекундах
+        """
+        timings = []
+        for _ in range(self.repeat):
+            started = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        self.stdout.write(f'{label:<45} {timings[len(timings) // 2]:>10.2f} мс')
+
+    def create_users(self, count):
+        suffix = uuid.uuid4().hex[:8]
+        return User.objects.bulk_create([
+            User(email=f'bench-{index}-{suffix}@example.com', first_name='Bench', last_name=str(index))
+            for index in range(count)
+        ])
+
+    def fill_mailbox(self, owner, peer, total, batch_size):
+        """
+        Наполняет ящик: половина писем входящие, половина исходящие,
+        примерно треть каждой стороны лежит в корзине
+        """
+        created = 0
+        while created < total:
+            size = min(batch_size, total - created)
+            batch = []
+            for index in range(created, created + size):
+                incoming = index % 2 == 0
+                batch.append(MailMessage(
+                    from_user=peer if incoming else owner,
+                    to_user=owner if incoming else peer,
+                    subject=f'Письмо {index}',
+                    content_encrypted='-----BEGIN PGP MESSAGE-----',
+                    is_deleted_by_recipient=incoming and index % 3 == 0,
+                    is_deleted_by_sender=not incoming and index % 3 == 0,
+                ))
+            MailMessage.objects.bulk_create(batch, batch_size=batch_size)
+            created += size
+
+    def call_view(self, action, user, params=None):
+        request = APIRequestFactory().get(f'/api/v1/mail/{action}/', params or {})
+        force_authenticate(request, user=user)
+        response = MailViewSet.as_view({'get': action})(request)
+        response.render()
+        return response
+
+    def run_trash(self, options):
+        owner, peer = self.create_users(2)
+        self.stdout.write(f'Наполнение ящика: {options["messages"]} писем...')
+        self.fill_mailbox(owner, peer, options['messages'], options['batch_size'])
+
+        trash = MailMessage.objects.trash(owner)
+        trash_size = trash.count()
+        if not trash_size:
+            raise CommandError('Корзина пуста, замеры не показательны')
+        self.stdout.write(f'В корзине: {trash_size} писем\n')
+
+        # Прежняя реализация: union() двух половин, только count и срезы
+        def union_page():
+            sent = MailMessage.objects.filter(from_user=owner, is_deleted_by_sender=True).order_by()
+            received = MailMessage.objects.filter(to_user=owner, is_deleted_by_recipient=True).order_by()
+            return list(sent.union(received).order_by('-created_at')[:10])
+
+        def union_count():
+            sent = MailMessage.objects.filter(from_user=owner, is_deleted_by_sender=True).order_by()
+            received = MailMessage.objects.filter(to_user=owner, is_deleted_by_recipient=True).order_by()
+            return sent.union(received).count()
+
+        self.measure('union(): первая страница', union_page)
+        self.measure('union(): count()', union_count)
+        self.measure('предикат: первая страница', lambda: list(trash.order_by('-created_at', '-id')[:10]))
+        self.measure('предикат: count()', trash.count)
+
+        last_page = max(trash_size // 10, 1)
+        self.measure('API: ?page=1', lambda: self.call_view('trash', owner))
+        self.measure(f'API: ?page={last_page}', lambda: self.call_view('trash', owner, {'page': last_page}))
+
+        # Курсор из середины корзины: стоимость не должна зависеть от глубины
+        middle = trash.order_by('-created_at', '-id')[trash_size // 2]
+        cursor = MailCursorPagination().encode_cursor(middle.created_at, middle.id)
+        self.measure('API: ?pagination=cursor', lambda: self.call_view('trash', owner, {'pagination': 'cursor'}))
+        self.measure('API: курсор из середины', lambda: self.call_view('trash', owner, {'cursor': cursor}))
+        self.measure('API: ?search=', lambda: self.call_view('trash', owner, {'search': 'Письмо 99'}))
+        # Для сравнения - папка, которая читается прямым проходом по индексу
+        self.measure('API: входящие ?pagination=cursor', lambda: self.call_view('inbox', owner, {'pagination': 'cursor'}))
+
+    def run_gc(self, options):
+        """
+        Очистка осиротевших вложений: --messages задает число вложений,
+        половина из них прикреплена к письмам и должна остаться
+        """
+        owner, peer = self.create_users(2)
+        total = options['messages']
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            os.makedirs(os.path.join(media_root, 'mail_attachments'))
+            self.stdout.write(f'Создание {total} вложений с файлами...')
+            attachments = []
+            for index in range(total):
+                name = f'mail_attachments/bench-{index}.bin'
+                with open(os.path.join(media_root, name), 'wb') as file:
+                    file.write(b'x' * 128)
+                attachments.append(MailAttachment(
+                    file=name, filename=f'bench-{index}.bin', file_size=128, content_type='application/octet-stream'
+                ))
+            MailAttachment.objects.bulk_create(attachments, batch_size=options['batch_size'])
+            MailAttachment.objects.update(created_at=timezone.now() - timedelta(days=2))
+
+            message = MailMessage.objects.create(from_user=owner, to_user=peer, subject='Вложения', content_encrypted='-')
+            message.attachments.add(*attachments[::2])
+
+            started = time.perf_counter()
+            result = collect_orphan_attachments(timedelta(hours=24), batch_size=2000)
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f'{"mail_gc: удаление осиротевших вложений":<45} {elapsed * 1000:>10.2f} мс '
+                f'({result.count} шт., {result.count / elapsed * 60:.0f} в минуту)'
+            )
+            remaining = len(os.listdir(os.path.join(media_root, 'mail_attachments')))
+            if result.count != total - len(attachments[::2]) or remaining != len(attachments[::2]):
+                raise CommandError('Удалено не то число вложений')
+
+    def run_encrypt(self, options):
+        """
+        Шифрование писем ключом получателя: --messages задает число писем,
+        keyring создается во временном каталоге
+        """
+        total = options['messages']
+        gnupghome = tempfile.mkdtemp()
+        try:
+            gpg = gnupg.GPG(gnupghome=gnupghome)
+            gpg.encoding = 'utf-8'
+            key = gpg.gen_key(gpg.gen_key_input(
+                name_email='bench@example.com', key_type='RSA', key_length=2048, no_protection=True
+            ))
+            public_key = gpg.export_keys(key.fingerprint)
+            content = 'Текст письма ' * 100
+
+            # Прежняя реализация: импорт ключа перед каждым шифрованием
+            def import_every_time():
+                for _ in range(total):
+                    result = gpg.import_keys(public_key)
+                    gpg.encrypt(content, result.fingerprints[0], always_trust=True)
+
+            cache = PublicKeyCache(gpg)
+
+            def cached():
+                for _ in range(total):
+                    cache.encrypt(content, public_key)
+
+            for label, func in (('импорт перед каждым письмом', import_every_time), ('кеш отпечатков', cached)):
+                started = time.perf_counter()
+                func()
+                elapsed = time.perf_counter() - started
+                self.stdout.write(f'{label:<45} {total / elapsed:>10.1f} писем/с')
+        finally:
+            shutil.rmtree(gnupghome, ignore_errors=True)
+
+    def run_smtp(self, options):
+        """
+        Отправка писем через SMTP: --messages задает число писем, сервер -
+        локальный SMTPSink в этом процессе
+        """
+        total = options['messages']
+        body = '<p>Текст письма</p>' * 50
+        with SMTPSink() as sink:
+            # Прежняя реализация: новое соединение на каждое письмо
+            def connection_per_message():
+                for index in range(total):
+                    smtp = smtplib.SMTP(sink.host, sink.port)
+                    message = b''.join(iter_message('bench@example.com', f'to-{index}@example.com', 'Письмо', body))
+                    smtp.sendmail('bench@example.com', f'to-{index}@example.com', message)
+                    smtp.quit()
+
+            def queue():
+                for index in range(total):
+                    enqueue('bench@example.com', f'to-{index}@example.com', 'Письмо', body)
+                connection = SMTPConnection(sink.host, sink.port, max_messages=total)
+                while batch := claim_batch(options['batch_size']):
+                    deliver(batch, connection)
+                connection.close()
+
+            for label, func in (('соединение на каждое письмо', connection_per_message), ('очередь, постоянное соединение', queue)):
+                started = time.perf_counter()
+                func()
+                elapsed = time.perf_counter() - started
+                self.stdout.write(f'{label:<45} {total / elapsed:>10.1f} писем/с')
+
+            if OutboundEmail.objects.exclude(status='sent').exists() or len(sink.messages) != total * 2:
+                raise CommandError('Отправлены не все письма')
+
+    def run_mime(self, options):
+        """
+        Отправка письма с большим вложением: --messages задает размер вложения
+        в мегабайтах; замеряется пик памяти Python при сборке и отправке
+        """
+        size = options['messages'] * 1024 * 1024
+        with tempfile.TemporaryDirectory() as directory, SMTPSink(keep_data=False) as sink:
+            path = os.path.join(directory, 'attachment.bin')
+            with open(path, 'wb') as file:
+                block = os.urandom(1024 * 1024)
+                for _ in range(options['messages']):
+                    file.write(block)
+
+            # Прежняя реализация: письмо целиком в памяти, вложение читается одним read()
+            def in_memory():
+                msg = MIMEMultipart()
+                msg['Subject'] = 'Письмо'
+                msg.attach(MIMEText('<p>Текст</p>', 'html'))
+                with open(path, 'rb') as file:
+                    msg.attach(MIMEApplication(file.read(), Name='attachment.bin'))
+                smtp = smtplib.SMTP(sink.host, sink.port)
+                smtp.sendmail('bench@example.com', 'to@example.com', msg.as_bytes())
+                smtp.quit()
+
+            def streaming():
+                outbound = enqueue('bench@example.com', 'to@example.com', 'Письмо', '<p>Текст</p>', [path])
+                connection = SMTPConnection(sink.host, sink.port)
+                connection.send(outbound)
+                connection.close()
+
+            def spool():
+                with open(os.path.join(directory, 'message.eml'), 'wb') as file:
+                    write_message(file, 'bench@example.com', 'to@example.com', 'Письмо', '<p>Текст</p>', [path])
+
+            for label, func in (('MIMEMultipart в памяти', in_memory), ('поток в DATA', streaming), ('поток в файл', spool)):
+                started = time.perf_counter()
+                func()
+                elapsed = time.perf_counter() - started
+                # tracemalloc замедляет выделения памяти, поэтому пик замеряется отдельным прогоном
+                tracemalloc.start()
+                func()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                self.stdout.write(f'{label:<45} {elapsed * 1000:>10.2f} мс, пик памяти {peak / 1024 / 1024:.1f} МБ')
+            # base64 увеличивает вложение на треть
+            if any(message.size < size * 4 // 3 for message in sink.messages):
+                raise CommandError('Письма отправлены не целиком')
+
+    def run_bodies(self, options):
+        """
+        Хранение зашифрованных тел: --messages задает число писем; тела в
+        armor переводятся в двоичный вид командой mail_body_backfill
+        """
+        owner, peer = self.create_users(2)
+        total = options['messages']
+        gnupghome = tempfile.mkdtemp()
+        try:
+            gpg = gnupg.GPG(gnupghome=gnupghome)
+            gpg.encoding = 'utf-8'
+            key = gpg.gen_key(gpg.gen_key_input(
+                name_email='bench@example.com', key_type='RSA', key_length=2048, no_protection=True
+            ))
+            text = '<p>Текст письма с реквизитами договора</p>' * 100
+            encrypted = str(gpg.encrypt(text, key.fingerprint, always_trust=True))
+        finally:
+            shutil.rmtree(gnupghome, ignore_errors=True)
+
+        def used_pages():
+            # Страницы таблиц в файле SQLite без освобожденных (freelist)
+            if connection.vendor != 'sqlite':
+                return 0
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA page_count')
+                page_count = cursor.fetchone()[0]
+                cursor.execute('PRAGMA freelist_count')
+                return page_count - cursor.fetchone()[0]
+
+        binary = dearmor(encrypted)
+        self.stdout.write(f'Наполнение: {total} писем, текст {len(text.encode())} байт...')
+        for label, values in (
+            ('armor-текст', {'content_encrypted': encrypted}),
+            ('двоичные тела', {'content_encrypted': '', 'content_binary': binary}),
+        ):
+            pages = used_pages()
+            MailMessage.objects.bulk_create([
+                MailMessage(from_user=peer, to_user=owner, subject=f'Письмо {index}', **values)
+                for index in range(total)
+            ], batch_size=options['batch_size'])
+            messages = MailMessage.objects.filter(to_user=owner, content_binary__isnull='content_binary' not in values)
+            sizes = messages.aggregate(text=Sum(Length('content_encrypted')), binary=Sum(Length('content_binary')))
+            stored = (sizes['text'] or 0) + (sizes['binary'] or 0)
+            self.stdout.write(f'{label:<45} {stored / 1024 / 1024:>10.2f} МБ тел, {used_pages() - pages} страниц базы')
+            field = 'content_binary' if 'content_binary' in values else 'content_encrypted'
+            self.measure(f'чтение всех тел ({label})', lambda: list(messages.values_list(field, flat=True)))
+
+        self.measure(
+            'чтение и armor при выдаче',
+            lambda: [armor(data) for data in messages.values_list('content_binary', flat=True)]
+        )
+
+        started = time.perf_counter()
+        call_command('mail_body_backfill', stdout=open(os.devnull, 'w'))
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'{"mail_body_backfill":<45} {elapsed * 1000:>10.2f} мс ({total / elapsed:.0f} писем/с)')
+        if MailMessage.objects.filter(to_user=owner, content_binary__isnull=True).exists():
+            raise CommandError('Переведены не все письма')
+
+    def run_search(self, options):
+        """
+        Поиск по теме в ящике из --messages писем: LIKE через SearchFilter и индекс FTS5
+        """
+        owner, peer = self.create_users(2)
+        self.stdout.write(f'Наполнение ящика: {options["messages"]} писем...')
+        self.fill_mailbox(owner, peer, options['messages'], options['batch_size'])
+        started = time.perf_counter()
+        search.rebuild(batch_size=options['batch_size'])
+        self.stdout.write(f'{"mail_search_rebuild":<45} {(time.perf_counter() - started) * 1000:>10.2f} мс')
+        if not search.fts_available():
+            self.stdout.write('FTS5 недоступен: замеряется поиск по документам без индекса')
+
+        term = str(options['messages'] // 2)
+        like = self.call_view('list', owner, {'search': term})
+        ranked = self.call_view('search', owner, {'q': term})
+        if not ranked.data['results'] or ranked.data['results'][0]['id'] not in {item['id'] for item in like.data['results']}:
+            raise CommandError('Поиск вернул разные письма')
+        self.measure('SearchFilter: LIKE по теме', lambda: self.call_view('list', owner, {'search': term}))
+        self.measure('mail/search: индекс', lambda: self.call_view('search', owner, {'q': term}))
+        self.measure('mail/search: участник (все письма)', lambda: self.call_view('search', owner, {'q': peer.email}))
+
+    def run_threads(self, options):
+        """
+        Переписки по 10 писем в ящике из --messages писем: поиск писем переписки
+        по теме и группировка писем против индексов переписок
+        """
+        owner, peer = self.create_users(2)
+        self.stdout.write(f'Наполнение ящика: {options["messages"]} писем...')
+        batch = []
+        for index in range(options['messages']):
+            incoming = index % 2 == 0
+            topic = index // 10
+            batch.append(MailMessage(
+                from_user=peer if incoming else owner,
+                to_user=owner if incoming else peer,
+                subject=f'Re: Дело {topic}' if index % 10 else f'Дело {topic}',
+                content_encrypted='-----BEGIN PGP MESSAGE-----',
+            ))
+        MailMessage.objects.bulk_create(batch, batch_size=options['batch_size'])
+        started = time.perf_counter()
+        threads.backfill(batch_size=options['batch_size'])
+        self.stdout.write(f'{"mail_thread_backfill":<45} {(time.perf_counter() - started) * 1000:>10.2f} мс')
+
+        topic = options['messages'] // 20
+        subject = f'Дело {topic}'
+        thread = MailMessage.objects.filter(subject=subject).values_list('thread', flat=True).first()
+
+        def subject_scan():
+            return list(
+                MailMessage.objects.visible_to(owner).filter(subject__in=[subject, f'Re: {subject}'])
+                .for_listing().order_by('created_at', 'id')
+            )
+
+        def conversation():
+            return list(MailMessage.objects.conversation(thread, owner).for_listing())
+
+        if [message.id for message in subject_scan()] != [message.id for message in conversation()]:
+            raise CommandError('Переписка и поиск по теме вернули разные письма')
+
+        def grouped_list():
+            return list(
+                MailMessage.objects.visible_to(owner).order_by().values('thread')
+                .annotate(last=Max('created_at'), count=Count('id')).order_by('-last')[:20]
+            )
+
+        def thread_list():
+            request = APIRequestFactory().get('/api/v1/mail/threads/')
+            force_authenticate(request, user=owner)
+            response = MailThreadViewSet.as_view({'get': 'list'})(request)
+            response.render()
+            return response
+
+        self.measure('Переписка: поиск писем по теме', subject_scan)
+        self.measure('Переписка: индекс (thread, created_at)', conversation)
+        self.measure('Список переписок: GROUP BY по письмам', grouped_list)
+        self.measure('mail/threads: индекс участников', thread_list)
+
+    def run_links(self, options):
+        """
+        Письма с attachments_meta без связей: чтение письма с прежним
+        восстановлением связей, перенос связей mail_attachment_backfill
+        и чтение после него
+        """
+        owner, peer = self.create_users(2)
+        total = options['messages']
+        attachments = MailAttachment.objects.bulk_create([
+            MailAttachment(file=f'mail_attachments/bench-{index}.bin', filename=f'bench-{index}.bin',
+                           file_size=128, content_type='application/octet-stream')
+            for index in range(5)
+        ])
+        # У половины писем метаданные ссылаются на вложения, которых уже нет:
+        # прежнее восстановление повторяло для них поиск при каждом чтении
+        missing = [{'id': str(uuid.uuid4())} for _ in range(5)]
+        present = [{'id': str(attachment.id)} for attachment in attachments]
+        self.stdout.write(f'Создание {total} писем с attachments_meta...')
+        MailMessage.objects.bulk_create([
+            MailMessage(from_user=peer, to_user=owner, subject=f'Письмо {index}', content_encrypted='-',
+                        attachments_meta=missing if index % 2 else present)
+            for index in range(total)
+        ], batch_size=options['batch_size'])
+        stale = MailMessage.objects.filter(attachments_meta=missing).first()
+
+        def retrieve():
+            request = APIRequestFactory().get(f'/api/v1/mail/{stale.pk}/')
+            force_authenticate(request, user=owner)
+            response = MailViewSet.as_view({'get': 'retrieve'})(request, pk=stale.pk)
+            response.render()
+            return response
+
+        def repair_on_read():
+            # Прежний retrieve: проверка связей и MailAttachment.objects.get на каждый id
+            message = MailMessage.objects.get(pk=stale.pk)
+            if not message.attachments.exists():
+                for item in message.attachments_meta:
+                    try:
+                        message.attachments.add(MailAttachment.objects.get(id=item['id']))
+                    except MailAttachment.DoesNotExist:
+                        pass
+            return retrieve()
+
+        self.measure('GET письма: восстановление связей при чтении', repair_on_read)
+        self.measure('GET письма: только чтение', retrieve)
+        started = time.perf_counter()
+        count, linked = links.backfill(batch_size=2000)
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f'{"mail_attachment_backfill":<45} {elapsed * 1000:>10.2f} мс ({count} писем, {linked} связей)'
+        )
+        if linked != (total + 1) // 2 * len(attachments):
+            raise CommandError('Создано не то число связей')
+
+    def run_export(self, options):
+        """
+        Выгрузка ящика в mbox: время до первого куска ответа, полное время
+        и пик памяти Python при сборке в памяти и при потоковой отдаче
+        """
+        owner, peer = self.create_users(2)
+        total = options['messages']
+        body = os.urandom(4096)
+        self.stdout.write(f'Создание {total} писем с двоичными телами...')
+        MailMessage.objects.bulk_create([
+            MailMessage(from_user=peer, to_user=owner, subject=f'Письмо {index}', content_encrypted='',
+                        content_binary=body)
+            for index in range(total)
+        ], batch_size=options['batch_size'])
+
+        def in_memory():
+            # Все письма одним запросом без select_related и весь файл в памяти до отдачи
+            messages = list(MailMessage.objects.folder('inbox', owner).order_by('created_at', 'id'))
+            return [b''.join(export.iter_mbox(messages, 'testserver'))]
+
+        def streaming():
+            return export.iter_mbox(export.iter_export_messages(owner, 'inbox'), 'testserver')
+
+        for label, func in (('mbox в памяти', in_memory), ('mbox потоком', streaming)):
+            started = time.perf_counter()
+            chunks = iter(func())
+            size = len(next(chunks))
+            first = time.perf_counter() - started
+            size += sum(len(chunk) for chunk in chunks)
+            elapsed = time.perf_counter() - started
+            tracemalloc.start()
+            for _ in func():
+                pass
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.stdout.write(
+                f'{label:<45} {elapsed * 1000:>10.2f} мс, первый кусок {first * 1000:.2f} мс, '
+                f'пик памяти {peak / 1024 / 1024:.1f} МБ, {size / 1024 / 1024:.1f} МБ'
+            )
@@ -0,0 +1,56 @@
+import hashlib
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from mail.blobs import CHUNK_SIZE, store_file
+from mail.models import MailAttachment
+
+
+class Command(BaseCommand):
+    """
+    Перенос файлов старых вложений из mail_attachments/ в хранилище блобов
+
+    Одинаковые файлы схлопываются в один блоб. Команду можно прерывать и
+    запускать повторно: обрабатываются только вложения без блоба.
+
+    Пример:
+        python manage.py mail_blob_backfill --batch-size 200
+    """
+    help = 'Переносит файлы вложений без блоба в хранилище с адресацией по SHA-256'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200, help='Размер пачки вложений')
+
+    def handle(self, *args, **options):
+        legacy = MailAttachment.objects.filter(blob__isnull=True).order_by('id')
+        moved, missing = 0, 0
+        last_id = None
+        while True:
+            batch = legacy.filter(id__gt=last_id) if last_id else legacy
+            batch = list(batch.only('id', 'file', 'file_size')[:options['batch_size']])
+            if not batch:
+                break
+            last_id = batch[-1].id
+            for attachment in batch:
+                name = attachment.file.name
+                if not name or not default_storage.exists(name):
+                    missing += 1
+                    continue
+                sha256 = self.hash_file(name)
+                with transaction.atomic():
+                    blob = store_file(name, sha256, default_storage.size(name))
+                    attachment.blob = blob
+                    attachment.file = blob.file.name
+                    attachment.save(update_fields=['blob', 'file'])
+                moved += 1
+
+        self.stdout.write(self.style.SUCCESS(f'Перенесено вложений: {moved}, без файла: {missing}'))
+
+    def hash_file(self, name):
+        hasher = hashlib.sha256()
+        with default_storage.open(name, 'rb') as file:
+            for chunk in file.chunks(CHUNK_SIZE):
+                hasher.update(chunk)
+        return hasher.hexdigest()
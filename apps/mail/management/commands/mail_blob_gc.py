@@ -0,0 +1,38 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from mail.blobs import collect_garbage, recount_references
+
+
+class Command(BaseCommand):
+    """
+    Удаление содержимого вложений, на которое больше не ссылается ни одно вложение
+
+    Блоб удаляется только если ссылок нет дольше --grace-minutes: за это время
+    завершившаяся загрузка того же файла успеет сослаться на него снова.
+
+    Пример:
+        python manage.py mail_blob_gc --dry-run
+        python manage.py mail_blob_gc --recount
+    """
+    help = 'Удаляет блобы вложений без ссылок'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace-minutes', type=int, default=60, help='Сколько минут блоб должен быть без ссылок')
+        parser.add_argument('--recount', action='store_true', help='Сначала пересчитать ссылки по таблице вложений')
+        parser.add_argument('--dry-run', action='store_true', help='Только показать, что будет удалено')
+        parser.add_argument('--batch-size', type=int, default=500, help='Размер пачки при выборке блобов')
+
+    def handle(self, *args, **options):
+        if options['recount']:
+            fixed = recount_references()
+            self.stdout.write(f'Исправлено счетчиков ссылок: {fixed}')
+
+        removed, freed = collect_garbage(
+            grace=timedelta(minutes=options['grace_minutes']),
+            dry_run=options['dry_run'],
+            batch_size=options['batch_size']
+        )
+        verb = 'Будет удалено' if options['dry_run'] else 'Удалено'
+        self.stdout.write(self.style.SUCCESS(f'{verb} блобов: {removed}, освобождено {freed} байт'))
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from mail.armor import BEGIN, pack
+from mail.models import MailMessage
+
+
+class Command(BaseCommand):
+    """
+    Перевод тел зашифрованных писем из armor-текста в двоичный вид (content_binary)
+
+    Письма обрабатываются пачками по id, каждая пачка - одним bulk_update в
+    своей транзакции. Команду можно прерывать и запускать повторно:
+    обрабатываются только письма, у которых тело еще хранится текстом.
+    Поврежденный armor остается как есть.
+
+    Пример:
+        python manage.py mail_body_backfill --batch-size 500
+    """
+    help = 'Переводит armor-тела зашифрованных писем в двоичный вид'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Размер пачки писем')
+
+    def handle(self, *args, **options):
+        legacy = MailMessage.objects.filter(
+            is_encrypted=True, content_binary__isnull=True, content_encrypted__startswith=BEGIN
+        ).order_by('id')
+        converted, skipped, saved = 0, 0, 0
+        last_id = None
+        while True:
+            batch = legacy.filter(id__gt=last_id) if last_id else legacy
+            batch = list(batch.only('id', 'content_encrypted')[:options['batch_size']])
+            if not batch:
+                break
+            last_id = batch[-1].id
+            changed = []
+            for message in batch:
+                text = message.content_encrypted
+                message.content_encrypted, message.content_binary = pack(text)
+                if message.content_binary is None:
+                    skipped += 1
+                    continue
+                saved += len(text.encode('utf-8')) - len(message.content_binary)
+                changed.append(message)
+            with transaction.atomic():
+                MailMessage.objects.bulk_update(changed, ['content_encrypted', 'content_binary'])
+            converted += len(changed)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Переведено писем: {converted}, поврежденный armor: {skipped}, освобождено байт: {saved}'
+        ))
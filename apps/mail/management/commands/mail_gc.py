@@ -0,0 +1,50 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from mail.blobs import collect_garbage
+from mail.cleanup import collect_orphan_attachments, collect_stale_uploads
+
+
+class Command(BaseCommand):
+    """
+    Очистка вложений, не прикрепленных ни к одному письму
+
+    Удаляет осиротевшие вложения старше --grace-hours, брошенные загрузки по
+    частям старше --upload-ttl-hours и блобы, на которые больше нет ссылок.
+
+    Пример:
+        python manage.py mail_gc --dry-run
+        python manage.py mail_gc --grace-hours 48 --batch-size 5000
+    """
+    help = 'Удаляет вложения без писем, брошенные загрузки и неиспользуемые блобы'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace-hours', type=int, default=24, help='Минимальный возраст осиротевшего вложения')
+        parser.add_argument('--upload-ttl-hours', type=int, default=24, help='Сколько хранить брошенную загрузку по частям')
+        parser.add_argument('--batch-size', type=int, default=2000, help='Размер пачки удаления')
+        parser.add_argument('--dry-run', action='store_true', help='Только показать, что будет удалено')
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        grace = timedelta(hours=options['grace_hours'])
+        verb = 'Будет удалено' if dry_run else 'Удалено'
+
+        started = time.perf_counter()
+        attachments = collect_orphan_attachments(grace, batch_size=options['batch_size'], dry_run=dry_run)
+        elapsed = time.perf_counter() - started
+        rate = attachments.count / elapsed * 60 if elapsed else 0
+        self.stdout.write(
+            f'{verb} вложений: {attachments.count}, файлов на {attachments.bytes} байт '
+            f'за {elapsed:.2f} с ({rate:.0f} в минуту)'
+        )
+
+        uploads = collect_stale_uploads(timedelta(hours=options['upload_ttl_hours']), dry_run=dry_run)
+        self.stdout.write(f'{verb} брошенных загрузок: {uploads.count}, {uploads.bytes} байт')
+
+        blobs, blob_bytes = collect_garbage(grace=grace, dry_run=dry_run, batch_size=options['batch_size'])
+        self.stdout.write(f'{verb} блобов: {blobs}, {blob_bytes} байт')
+
+        total = attachments.bytes + uploads.bytes + blob_bytes
+        self.stdout.write(self.style.SUCCESS(f'Всего освобождено: {total} байт'))
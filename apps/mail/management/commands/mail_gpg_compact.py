@@ -0,0 +1,40 @@
+from datetime import timedelta
+
+import gnupg
+from django.core.management.base import BaseCommand
+
+from mail.keyring import compact_keyring
+from mail.utils import gpg, public_keys
+
+
+class Command(BaseCommand):
+    """
+    Удаление из общего keyring GnuPG ключей, владельцев которых больше нет
+
+    Ключ остается, если его отпечаток совпадает с публичным ключом какой-либо
+    записи PGPKey. Ключи моложе --grace-minutes не удаляются.
+
+    Пример:
+        python manage.py mail_gpg_compact --dry-run
+    """
+    help = 'Удаляет из keyring ключи без владельцев'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace-minutes', type=int, default=60, help='Не удалять ключи моложе этого числа минут')
+        parser.add_argument('--homedir', help='Каталог GnuPG (по умолчанию keyring почты)')
+        parser.add_argument('--dry-run', action='store_true', help='Только показать, что будет удалено')
+
+    def handle(self, *args, **options):
+        keyring = gnupg.GPG(gnupghome=options['homedir']) if options['homedir'] else gpg
+        removed = compact_keyring(
+            keyring,
+            grace=timedelta(minutes=options['grace_minutes']),
+            dry_run=options['dry_run']
+        )
+        for fingerprint in removed:
+            self.stdout.write(fingerprint)
+        if not options['dry_run'] and keyring is gpg:
+            public_keys.forget_fingerprints(removed)
+
+        verb = 'Будет удалено' if options['dry_run'] else 'Удалено'
+        self.stdout.write(self.style.SUCCESS(f'{verb} ключей: {len(removed)}'))
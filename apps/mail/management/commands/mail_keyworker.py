@@ -0,0 +1,51 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from mail.keygen import claim_job, get_config, refill_pool, run_job
+
+
+class Command(BaseCommand):
+    """
+    Воркер создания PGP ключей: выполняет задания PGPKeyJob и пополняет запас
+
+    Запас пополняется по одной паре между проверками очереди, чтобы новое
+    задание не ждало, пока создается весь запас.
+
+    Пример:
+        python manage.py mail_keyworker
+        python manage.py mail_keyworker --once
+    """
+    help = 'Создает PGP ключи по заданиям и пополняет запас готовых пар'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Обработать очередь и запас один раз и выйти')
+        parser.add_argument('--sleep', type=float, default=2, help='Пауза между проверками пустой очереди, секунд')
+        parser.add_argument('--stale-minutes', type=int, default=30, help='Через сколько минут выполняемое задание считается брошенным')
+
+    def handle(self, *args, **options):
+        stale_after = timedelta(minutes=options['stale_minutes'])
+        self.stdout.write(f'Запас ключей: {get_config()["POOL_SIZE"]}')
+        while True:
+            close_old_connections()
+            busy = self.run_jobs(stale_after)
+            if refill_pool(limit=1):
+                busy = True
+            if options['once']:
+                if busy:
+                    continue
+                break
+            if not busy:
+                time.sleep(options['sleep'])
+
+    def run_jobs(self, stale_after):
+        processed = False
+        while True:
+            job = claim_job(stale_after)
+            if job is None:
+                return processed
+            processed = True
+            job = run_job(job)
+            self.stdout.write(f'Задание {job.pk}: {job.get_status_display()}')
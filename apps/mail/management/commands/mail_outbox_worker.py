@@ -0,0 +1,46 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from mail.outbox import SMTPConnection, get_config, process_queue
+
+
+class Command(BaseCommand):
+    """
+    Воркер очереди исходящих писем: отправляет OutboundEmail через SMTP
+
+    Письма отправляются по одному постоянному соединению, пока в очереди
+    есть работа; соединение закрывается после простоя дольше IDLE_TIMEOUT.
+    Несколько воркеров можно запускать параллельно - каждый забирает свою пачку.
+
+    Пример:
+        python manage.py mail_outbox_worker
+        python manage.py mail_outbox_worker --once
+    """
+    help = 'Отправляет письма из очереди исходящих через SMTP'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Отправить все готовые письма и выйти')
+        parser.add_argument('--sleep', type=float, default=1, help='Пауза между проверками пустой очереди, секунд')
+        parser.add_argument('--stale-minutes', type=int, default=30, help='Через сколько минут отправляемое письмо считается брошенным')
+
+    def handle(self, *args, **options):
+        config = get_config()
+        stale_after = timedelta(minutes=options['stale_minutes'])
+        connection = SMTPConnection.from_config(config)
+        self.stdout.write(f'SMTP: {config["HOST"]}:{config["PORT"]}')
+        try:
+            while True:
+                close_old_connections()
+                taken = process_queue(connection, config, stale_after)
+                if taken:
+                    self.stdout.write(f'Обработано писем: {taken}')
+                    continue
+                if options['once']:
+                    break
+                connection.close_if_idle()
+                time.sleep(options['sleep'])
+        finally:
+            connection.close()
@@ -0,0 +1,38 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from mail.postfixlog import index_log
+
+
+class Command(BaseCommand):
+    """
+    Индексация статусов доставки из лога Postfix в таблицу PostfixDelivery
+
+    Каждый запуск читает только строки, появившиеся после прошлого; с
+    --follow команда продолжает читать лог по мере его роста.
+
+    Пример:
+        python manage.py mail_postfix_index
+        python manage.py mail_postfix_index --follow --log /var/log/mail.log
+    """
+    help = 'Переносит статусы доставки из лога Postfix в базу'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--log', default=None, help='Путь к логу Postfix (по умолчанию MAIL_POSTFIX_LOG)')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Число статусов в одной транзакции')
+        parser.add_argument('--follow', action='store_true', help='Следить за логом, а не выходить после прочтения')
+        parser.add_argument('--sleep', type=float, default=2, help='Пауза между проверками лога в режиме --follow, секунд')
+
+    def handle(self, *args, **options):
+        path = options['log'] or getattr(settings, 'MAIL_POSTFIX_LOG', '/var/log/mail.log')
+        while True:
+            close_old_connections()
+            count = index_log(path, options['batch_size'])
+            if count or not options['follow']:
+                self.stdout.write(f'Статусов доставки: {count}')
+            if not options['follow']:
+                break
+            time.sleep(options['sleep'])
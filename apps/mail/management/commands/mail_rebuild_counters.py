@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from mail.mailbox import rebuild_counters
+
+
+class Command(BaseCommand):
+    """
+    Пересчет счетчиков почтовых ящиков с нуля
+
+    Счетчики поддерживаются инкрементально; команда нужна для восстановления
+    после ручных правок писем (например, через админку) или сбоев.
+    Изменения писем, выполненные во время пересчета, могут потеряться -
+    запускайте команду в период низкой нагрузки.
+    """
+    help = 'Пересчитывает счетчики папок всех почтовых ящиков по таблице сообщений'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000, help='Размер пачки при чтении писем')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        users = rebuild_counters(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Счетчики пересчитаны для {users} пользователей за {time.perf_counter() - started:.2f} с'
+        ))
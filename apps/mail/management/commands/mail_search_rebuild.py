@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from mail import search
+
+
+class Command(BaseCommand):
+    """
+    Переиндексация писем для поиска
+
+    Документы всех писем строятся заново по текущим темам и данным участников
+    (индекс хранит имена и email на момент создания письма), затем индекс
+    FTS5 перестраивается из документов.
+
+    Пример:
+        python manage.py mail_search_rebuild --batch-size 1000
+    """
+    help = 'Перестраивает поисковые документы и индекс FTS5 писем'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Размер пачки писем')
+
+    def handle(self, *args, **options):
+        total = search.rebuild(batch_size=options['batch_size'])
+        index = 'FTS5' if search.fts_available() else 'без FTS5'
+        self.stdout.write(self.style.SUCCESS(f'Проиндексировано писем: {total} ({index})'))
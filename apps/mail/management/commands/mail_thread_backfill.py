@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from mail import threads
+
+
+class Command(BaseCommand):
+    """
+    Переписки для писем, созданных до их появления
+
+    Связей ответов у старых писем нет: письма объединяются по теме без
+    префиксов Re:/Fwd: и паре участников, затем считаются агрегаты переписок.
+    Новые письма получают переписку сами, повторный запуск обрабатывает
+    только письма без переписки.
+
+    Пример:
+        python manage.py mail_thread_backfill --batch-size 1000
+    """
+    help = 'Назначает переписки старым письмам'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Размер пачки писем')
+
+    def handle(self, *args, **options):
+        total = threads.backfill(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Писем с назначенной перепиской: {total}'))
@@ -0,0 +1,35 @@
+# Generated by Django 5.2 on 2026-10-18 13:52
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0012_alter_pgpkey_options_remove_pgpkey_password_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='mailmessage',
+            index=models.Index(condition=models.Q(('is_deleted_by_recipient', False), ('is_draft', False)), fields=['to_user', 'created_at', 'id'], name='mail_inbox_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mailmessage',
+            index=models.Index(condition=models.Q(('is_deleted_by_sender', False), ('is_draft', False)), fields=['from_user', 'created_at', 'id'], name='mail_sent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mailmessage',
+            index=models.Index(condition=models.Q(('is_deleted_by_sender', False), ('is_draft', True)), fields=['from_user', 'created_at', 'id'], name='mail_drafts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mailmessage',
+            index=models.Index(condition=models.Q(('is_deleted_by_sender', True)), fields=['from_user', 'created_at', 'id'], name='mail_sender_trash_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mailmessage',
+            index=models.Index(condition=models.Q(('is_deleted_by_recipient', True)), fields=['to_user', 'created_at', 'id'], name='mail_recipient_trash_idx'),
+        ),
+    ]
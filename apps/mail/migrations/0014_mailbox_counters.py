@@ -0,0 +1,84 @@
+# Generated by Django 5.2 on 2026-10-18 13:58
+
+from collections import Counter, defaultdict
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def mark_existing_read(apps, schema_editor):
+    # До появления отметок о прочтении все письма считались просмотренными
+    MailMessage = apps.get_model('mail', 'MailMessage')
+    MailMessage.objects.update(is_read=True)
+
+
+def build_counters(apps, schema_editor):
+    # Те же правила, что у mailbox.message_contributions() на момент миграции
+    MailMessage = apps.get_model('mail', 'MailMessage')
+    MailboxCounters = apps.get_model('mail', 'MailboxCounters')
+    totals = defaultdict(Counter)
+    rows = MailMessage.objects.order_by().values_list(
+        'from_user_id', 'to_user_id', 'is_draft', 'is_deleted_by_sender', 'is_deleted_by_recipient', 'is_read'
+    ).iterator(chunk_size=2000)
+    for sender, recipient, is_draft, deleted_by_sender, deleted_by_recipient, is_read in rows:
+        if not deleted_by_sender:
+            totals[sender]['drafts_total' if is_draft else 'sent_total'] += 1
+        if not is_draft and not deleted_by_recipient:
+            totals[recipient]['inbox_total'] += 1
+            if not is_read:
+                totals[recipient]['inbox_unread'] += 1
+        # Письмо самому себе, удаленное с обеих сторон, лежит в корзине один раз
+        in_trash = set()
+        if deleted_by_sender:
+            in_trash.add(sender)
+        if deleted_by_recipient:
+            in_trash.add(recipient)
+        for user_id in in_trash:
+            totals[user_id]['trash_total'] += 1
+            if user_id == recipient and not is_read:
+                totals[user_id]['trash_unread'] += 1
+    MailboxCounters.objects.bulk_create(
+        [MailboxCounters(user_id=user_id, **total) for user_id, total in totals.items()],
+        batch_size=2000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+        ('mail', '0013_mailmessage_folder_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailboxCounters',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='mailbox_counters', serialize=False, to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+                ('inbox_total', models.IntegerField(default=0, verbose_name='Входящие')),
+                ('inbox_unread', models.IntegerField(default=0, verbose_name='Непрочитанные входящие')),
+                ('sent_total', models.IntegerField(default=0, verbose_name='Отправленные')),
+                ('drafts_total', models.IntegerField(default=0, verbose_name='Черновики')),
+                ('trash_total', models.IntegerField(default=0, verbose_name='Корзина')),
+                ('trash_unread', models.IntegerField(default=0, verbose_name='Непрочитанные в корзине')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Дата обновления')),
+            ],
+            options={
+                'verbose_name': 'Счетчики почтового ящика',
+                'verbose_name_plural': 'Счетчики почтовых ящиков',
+            },
+        ),
+        migrations.AddField(
+            model_name='mailmessage',
+            name='is_read',
+            field=models.BooleanField(default=False, verbose_name='Прочитано получателем'),
+        ),
+        migrations.AddField(
+            model_name='mailmessage',
+            name='read_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Дата прочтения'),
+        ),
+        migrations.RunPython(mark_existing_read, migrations.RunPython.noop),
+        migrations.RunPython(build_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2 on 2026-10-18 14:01
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0014_mailbox_counters'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailChange',
+            fields=[
+                ('seq', models.BigAutoField(primary_key=True, serialize=False, verbose_name='Порядковый номер')),
+                ('message_id', models.UUIDField(verbose_name='ID сообщения')),
+                ('action', models.CharField(choices=[('created', 'Создано'), ('updated', 'Изменено'), ('moved', 'Перемещено'), ('trashed', 'Перемещено в корзину'), ('restored', 'Восстановлено'), ('read', 'Прочитано'), ('unread', 'Не прочитано'), ('deleted', 'Удалено')], max_length=16, verbose_name='Действие')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата изменения')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mail_changes', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Изменение почты',
+                'verbose_name_plural': 'Изменения почты',
+                'ordering': ['seq'],
+                'indexes': [models.Index(fields=['user', 'seq'], name='mail_change_user_seq_idx')],
+            },
+        ),
+    ]
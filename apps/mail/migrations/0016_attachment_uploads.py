@@ -0,0 +1,44 @@
+# Generated by Django 5.2 on 2026-10-18 14:06
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0015_mail_change_log'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailattachment',
+            name='uploaded_by',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='mail_attachments', to=settings.AUTH_USER_MODEL, verbose_name='Загрузил'),
+        ),
+        migrations.CreateModel(
+            name='AttachmentUpload',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('filename', models.CharField(max_length=255, verbose_name='Имя файла')),
+                ('content_type', models.CharField(default='application/octet-stream', max_length=100, verbose_name='Тип содержимого')),
+                ('size', models.PositiveBigIntegerField(verbose_name='Размер файла (байт)')),
+                ('sha256', models.CharField(blank=True, max_length=64, verbose_name='Ожидаемый SHA-256')),
+                ('file_name', models.CharField(max_length=255, verbose_name='Путь к файлу в хранилище')),
+                ('received', models.PositiveBigIntegerField(default=0, verbose_name='Получено байт')),
+                ('status', models.CharField(choices=[('uploading', 'Загружается'), ('complete', 'Завершена')], default='uploading', max_length=16, verbose_name='Статус')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Дата обновления')),
+                ('attachment', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='upload', to='mail.mailattachment', verbose_name='Вложение')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='attachment_uploads', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Загрузка вложения',
+                'verbose_name_plural': 'Загрузки вложений',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2 on 2026-10-18 14:09
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0016_attachment_uploads'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AttachmentBlob',
+            fields=[
+                ('sha256', models.CharField(max_length=64, primary_key=True, serialize=False, verbose_name='SHA-256')),
+                ('file', models.FileField(max_length=255, upload_to='', verbose_name='Файл')),
+                ('size', models.PositiveBigIntegerField(verbose_name='Размер (байт)')),
+                ('ref_count', models.PositiveIntegerField(default=0, verbose_name='Число ссылок')),
+                ('unreferenced_at', models.DateTimeField(blank=True, null=True, verbose_name='Без ссылок с')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+            ],
+            options={
+                'verbose_name': 'Содержимое вложения',
+                'verbose_name_plural': 'Содержимое вложений',
+                'indexes': [models.Index(condition=models.Q(('ref_count', 0)), fields=['unreferenced_at'], name='mail_blob_unreferenced_idx')],
+            },
+        ),
+        migrations.AddField(
+            model_name='mailattachment',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='attachments', to='mail.attachmentblob', verbose_name='Содержимое'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 14:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0017_attachment_blobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pgpkey',
+            name='fingerprint',
+            field=models.CharField(blank=True, default='', help_text='Заполняется командой mail_gpg_compact; сбрасывается при смене ключа', max_length=40, verbose_name='Отпечаток публичного ключа'),
+        ),
+    ]
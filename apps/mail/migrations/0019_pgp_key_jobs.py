@@ -0,0 +1,51 @@
+# Generated by Django 5.2 on 2026-10-18 14:23
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0018_pgp_key_fingerprint'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PregeneratedKey',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('public_key', models.TextField(verbose_name='Публичный ключ')),
+                ('private_key_encrypted', models.TextField(verbose_name='Приватный ключ, зашифрованный ключом сервера')),
+                ('fingerprint', models.CharField(max_length=40, verbose_name='Отпечаток')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+            ],
+            options={
+                'verbose_name': 'Запасная пара PGP ключей',
+                'verbose_name_plural': 'Запас PGP ключей',
+                'ordering': ['created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='PGPKeyJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('status', models.CharField(choices=[('pending', 'В очереди'), ('running', 'Выполняется'), ('done', 'Готово'), ('failed', 'Ошибка')], default='pending', max_length=16, verbose_name='Статус')),
+                ('passphrase_encrypted', models.TextField(blank=True, verbose_name='Пароль, зашифрованный ключом сервера')),
+                ('from_pool', models.BooleanField(default=False, verbose_name='Ключи взяты из запаса')),
+                ('error', models.TextField(blank=True, verbose_name='Ошибка')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Дата обновления')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pgp_key_jobs', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Создание PGP ключей',
+                'verbose_name_plural': 'Создание PGP ключей',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(condition=models.Q(('status', 'pending')), fields=['created_at'], name='mail_pgp_job_pending_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2 on 2026-10-18 14:34
+
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0019_pgp_key_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboundEmail',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('from_email', models.CharField(max_length=254, verbose_name='Отправитель')),
+                ('to_email', models.CharField(max_length=254, verbose_name='Получатель')),
+                ('subject', models.CharField(blank=True, max_length=998, verbose_name='Тема')),
+                ('body', models.TextField(blank=True, verbose_name='Тело письма')),
+                ('attachments', models.JSONField(blank=True, default=list, verbose_name='Пути к файлам вложений')),
+                ('status', models.CharField(choices=[('queued', 'В очереди'), ('sending', 'Отправляется'), ('sent', 'Отправлено'), ('failed', 'Ошибка')], default='queued', max_length=16, verbose_name='Статус')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Число попыток')),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Следующая попытка')),
+                ('lease', models.UUIDField(blank=True, null=True, verbose_name='Метка воркера')),
+                ('last_error', models.TextField(blank=True, verbose_name='Последняя ошибка')),
+                ('queue_id', models.CharField(blank=True, max_length=32, verbose_name='ID в очереди Postfix')),
+                ('sent_at', models.DateTimeField(blank=True, null=True, verbose_name='Дата отправки')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Дата обновления')),
+                ('message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='outbound', to='mail.mailmessage', verbose_name='Сообщение')),
+            ],
+            options={
+                'verbose_name': 'Исходящее письмо',
+                'verbose_name_plural': 'Очередь исходящих писем',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(condition=models.Q(('status', 'queued')), fields=['next_attempt_at'], name='mail_outbound_queued_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2 on 2026-10-18 14:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0020_outbound_email'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PostfixLogCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=255, unique=True, verbose_name='Путь к логу')),
+                ('inode', models.BigIntegerField(default=0, verbose_name='Inode файла')),
+                ('offset', models.BigIntegerField(default=0, verbose_name='Смещение')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Дата обновления')),
+            ],
+            options={
+                'verbose_name': 'Позиция в логе Postfix',
+                'verbose_name_plural': 'Позиции в логах Postfix',
+            },
+        ),
+        migrations.CreateModel(
+            name='PostfixDelivery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('queue_id', models.CharField(max_length=32, verbose_name='ID в очереди Postfix')),
+                ('recipient', models.CharField(max_length=254, verbose_name='Получатель')),
+                ('status', models.CharField(max_length=16, verbose_name='Статус')),
+                ('dsn', models.CharField(blank=True, max_length=16, verbose_name='Код DSN')),
+                ('relay', models.CharField(blank=True, max_length=255, verbose_name='Relay')),
+                ('response', models.TextField(blank=True, verbose_name='Ответ сервера')),
+                ('logged_at', models.DateTimeField(blank=True, null=True, verbose_name='Время записи в логе')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Дата обновления')),
+            ],
+            options={
+                'verbose_name': 'Доставка Postfix',
+                'verbose_name_plural': 'Доставки Postfix',
+                'ordering': ['-logged_at'],
+                'constraints': [models.UniqueConstraint(fields=('queue_id', 'recipient'), name='mail_postfix_delivery_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 14:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0021_postfix_delivery'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailmessage',
+            name='content_binary',
+            field=models.BinaryField(blank=True, null=True, verbose_name='Зашифрованное содержимое (двоичное)'),
+        ),
+    ]
@@ -0,0 +1,131 @@
+# Generated by Django 5.2 on 2026-10-18 15:03
+
+import django.db.models.deletion
+from django.db import OperationalError, migrations, models
+
+# Индекс FTS5 с внешним содержимым: текст хранится в mail_mailsearchdocument,
+# индекс обновляют триггеры этой таблицы (rowid индекса = id документа)
+CREATE_FTS = (
+    """
+    CREATE VIRTUAL TABLE mail_search USING fts5(
+        subject, participants, users,
+        content='mail_mailsearchdocument', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )
+    """,
+    """
+    CREATE TRIGGER mail_search_insert AFTER INSERT ON mail_mailsearchdocument BEGIN
+        INSERT INTO mail_search(rowid, subject, participants, users)
+        VALUES (new.id, new.subject, new.participants, new.users);
+    END
+    """,
+    """
+    CREATE TRIGGER mail_search_delete AFTER DELETE ON mail_mailsearchdocument BEGIN
+        INSERT INTO mail_search(mail_search, rowid, subject, participants, users)
+        VALUES ('delete', old.id, old.subject, old.participants, old.users);
+    END
+    """,
+    """
+    CREATE TRIGGER mail_search_update AFTER UPDATE ON mail_mailsearchdocument BEGIN
+        INSERT INTO mail_search(mail_search, rowid, subject, participants, users)
+        VALUES ('delete', old.id, old.subject, old.participants, old.users);
+        INSERT INTO mail_search(rowid, subject, participants, users)
+        VALUES (new.id, new.subject, new.participants, new.users);
+    END
+    """,
+)
+DROP_FTS = (
+    'DROP TRIGGER IF EXISTS mail_search_insert',
+    'DROP TRIGGER IF EXISTS mail_search_delete',
+    'DROP TRIGGER IF EXISTS mail_search_update',
+    'DROP TABLE IF EXISTS mail_search',
+)
+
+
+def create_fts(apps, schema_editor):
+    # На других СУБД и в SQLite без FTS5 поиск работает по документам без индекса
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    try:
+        schema_editor.execute(CREATE_FTS[0])
+    except OperationalError:
+        return
+    for statement in CREATE_FTS[1:]:
+        schema_editor.execute(statement)
+
+
+def drop_fts(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in DROP_FTS:
+        schema_editor.execute(statement)
+
+
+def normalize(text):
+    # Как mail.search.normalize() на момент миграции: нижний регистр, ё как е.
+    # Поэтому документы строятся в Python: lower() SQLite меняет только ASCII
+    return (text or '').lower().replace('ё', 'е')
+
+
+def build_documents(apps, schema_editor):
+    MailMessage = apps.get_model('mail', 'MailMessage')
+    MailSearchDocument = apps.get_model('mail', 'MailSearchDocument')
+    fields = ['id', 'subject', 'is_draft', 'from_user_id', 'to_user_id']
+    for side in ('from_user', 'to_user'):
+        fields += [f'{side}__email', f'{side}__first_name', f'{side}__last_name', f'{side}__middle_name']
+    messages = MailMessage.objects.order_by('pk').values(*fields)
+    last_pk = None
+    while True:
+        batch = list((messages.filter(pk__gt=last_pk) if last_pk else messages)[:1000])
+        if not batch:
+            return
+        last_pk = batch[-1]['id']
+        documents = []
+        for message in batch:
+            participants = {
+                ' '.join(
+                    part for part in (
+                        message[f'{side}__email'], message[f'{side}__first_name'],
+                        message[f'{side}__last_name'], message[f'{side}__middle_name'],
+                    ) if part
+                )
+                for side in ('from_user', 'to_user')
+            }
+            # Черновик находит только отправитель
+            user_ids = {message['from_user_id']}
+            if not message['is_draft']:
+                user_ids.add(message['to_user_id'])
+            documents.append(MailSearchDocument(
+                message_id=message['id'],
+                subject=normalize(message['subject']),
+                participants=normalize(' '.join(sorted(participants))),
+                users=' '.join(sorted(f'u{user_id.hex}' for user_id in user_ids)),
+            ))
+        MailSearchDocument.objects.bulk_create(documents)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+        ('mail', '0022_message_content_binary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailSearchDocument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.CharField(max_length=255, verbose_name='Тема')),
+                ('participants', models.TextField(verbose_name='Участники')),
+                ('users', models.CharField(max_length=80, verbose_name='Токены участников')),
+                ('message', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='search_document', to='mail.mailmessage', verbose_name='Сообщение')),
+            ],
+            options={
+                'verbose_name': 'Поисковый документ письма',
+                'verbose_name_plural': 'Поисковые документы писем',
+            },
+        ),
+        migrations.RunPython(create_fts, drop_fts),
+        migrations.RunPython(build_documents, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 5.2 on 2026-10-18 15:11
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0023_mail_search'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailThread',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('subject', models.CharField(blank=True, max_length=255, verbose_name='Тема')),
+                ('message_count', models.PositiveIntegerField(default=0, verbose_name='Число писем')),
+                ('has_attachments', models.BooleanField(default=False, verbose_name='Есть вложения')),
+                ('last_activity_at', models.DateTimeField(blank=True, null=True, verbose_name='Последнее письмо')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+            ],
+            options={
+                'verbose_name': 'Переписка',
+                'verbose_name_plural': 'Переписки',
+                'ordering': ['-last_activity_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='MailThreadParticipant',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_activity_at', models.DateTimeField(verbose_name='Последнее письмо')),
+            ],
+            options={
+                'verbose_name': 'Участник переписки',
+                'verbose_name_plural': 'Участники переписок',
+                'ordering': ['-last_activity_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='mailmessage',
+            name='in_reply_to',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='replies', to='mail.mailmessage', verbose_name='Ответ на письмо'),
+        ),
+        migrations.AddField(
+            model_name='mailmessage',
+            name='thread',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='messages', to='mail.mailthread', verbose_name='Переписка'),
+        ),
+        migrations.AddIndex(
+            model_name='mailmessage',
+            index=models.Index(fields=['thread', 'created_at', 'id'], name='mail_thread_messages_idx'),
+        ),
+        migrations.AddField(
+            model_name='mailthreadparticipant',
+            name='thread',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='participants', to='mail.mailthread', verbose_name='Переписка'),
+        ),
+        migrations.AddField(
+            model_name='mailthreadparticipant',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mail_threads', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь'),
+        ),
+        migrations.AddIndex(
+            model_name='mailthreadparticipant',
+            index=models.Index(fields=['user', 'last_activity_at', 'id'], name='mail_thread_user_activity_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='mailthreadparticipant',
+            constraint=models.UniqueConstraint(fields=('thread', 'user'), name='mail_thread_participant_unique'),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 5.2 on 2026-10-18 15:40
+
+import uuid
+
+from django.db import migrations
+
+
+def meta_attachment_ids(meta):
+    # Как mail.links.meta_attachment_ids() на момент миграции
+    ids = set()
+    for item in meta or ():
+        if not isinstance(item, dict) or not item.get('id'):
+            continue
+        try:
+            ids.add(uuid.UUID(str(item['id'])))
+        except ValueError:
+            continue
+    return ids
+
+
+def link_attachments(apps, schema_editor):
+    # Связи, которые раньше восстанавливались при чтении писем
+    MailMessage = apps.get_model('mail', 'MailMessage')
+    MailAttachment = apps.get_model('mail', 'MailAttachment')
+    through = MailMessage.attachments.through
+    messages = MailMessage.objects.exclude(attachments_meta=[]).order_by('pk').only('pk', 'attachments_meta')
+    last_pk = None
+    while True:
+        batch = list((messages.filter(pk__gt=last_pk) if last_pk else messages)[:2000])
+        if not batch:
+            return
+        last_pk = batch[-1].pk
+        wanted = {message.pk: meta_attachment_ids(message.attachments_meta) for message in batch}
+        existing = set(
+            MailAttachment.objects.filter(pk__in=set().union(*wanted.values())).values_list('pk', flat=True)
+        )
+        through.objects.bulk_create(
+            [
+                through(mailmessage_id=message_id, mailattachment_id=attachment_id)
+                for message_id, attachment_ids in wanted.items()
+                for attachment_id in attachment_ids & existing
+            ],
+            ignore_conflicts=True,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0024_mail_threads'),
+    ]
+
+    operations = [
+        migrations.RunPython(link_attachments, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,111 @@
+"""
+Потоковая сборка MIME-письма для отправки
+
+iter_message() отдает письмо кусками байтов (строки с CRLF): заголовки,
+HTML-тело и вложения, которые читаются с диска блоками и кодируются в
+base64 по мере отправки. Письмо целиком в памяти не собирается, поэтому
+память на отправку не зависит от размера вложений - куски пишутся прямо в
+поток DATA (mail.outbox.SMTPConnection), в файл (write_message) или в
+ответ выгрузки ящика (mail.export).
+"""
+import base64
+import mimetypes
+import os
+import uuid
+from email.header import Header
+from email.utils import encode_rfc2231
+
+# 57 байт дают ровно одну строку base64 из 76 символов (RFC 2045)
+LINE_BYTES = 57
+# Блок чтения вложения: 1024 строки base64, около 78 КБ на кусок
+READ_BLOCK = LINE_BYTES * 1024
+
+
+def encode_header(value):
+    """
+    Значение заголовка: как есть для ASCII, иначе RFC 2047; переводы строк заменяются пробелами
+    """
+    value = ' '.join(value.splitlines())
+    if value.isascii():
+        return value
+    return Header(value, 'utf-8').encode(linesep='\r\n')
+
+
+def encode_filename(filename):
+    """
+    Параметр filename для Content-Disposition; не-ASCII имена - по RFC 2231
+    """
+    if filename.isascii():
+        return 'filename="{}"'.format(filename.replace('\\', '\\\\').replace('"', '\\"'))
+    return f"filename*={encode_rfc2231(filename, 'utf-8')}"
+
+
+def base64_lines(data):
+    """
+    base64 блока данных строками по 76 символов с CRLF
+    """
+    encoded = base64.b64encode(data)
+    return b''.join(encoded[index:index + 76] + b'\r\n' for index in range(0, len(encoded), 76))
+
+
+def iter_file_base64(path):
+    """
+    Содержимое файла в base64, по блоку READ_BLOCK за раз
+    """
+    with open(path, 'rb') as file:
+        while block := file.read(READ_BLOCK):
+            yield base64_lines(block)
+
+
+def iter_message(from_email, to_email, subject, body, attachments=None, extra_headers=None, body_type='text/html'):
+    """
+    Письмо multipart/mixed кусками байтов; отсутствующие файлы вложений пропускаются
+
+    Вложение - путь к файлу или кортеж (путь, имя файла, тип содержимого):
+    так передаются вложения на блобах, у файлов которых нет исходного имени.
+    extra_headers - дополнительные заголовки {имя: значение} (Date, Message-ID)
+    """
+    boundary = f'=={uuid.uuid4().hex}=='
+    headers = [
+        f'From: {encode_header(from_email)}',
+        f'To: {encode_header(to_email)}',
+        f'Subject: {encode_header(subject)}',
+        *(f'{name}: {encode_header(value)}' for name, value in (extra_headers or {}).items()),
+        'MIME-Version: 1.0',
+        f'Content-Type: multipart/mixed; boundary="{boundary}"',
+    ]
+    yield ('\r\n'.join(headers) + '\r\n\r\n').encode('ascii')
+
+    yield (
+        f'--{boundary}\r\n'
+        f'Content-Type: {body_type}; charset="utf-8"\r\n'
+        'Content-Transfer-Encoding: base64\r\n\r\n'
+    ).encode('ascii')
+    yield base64_lines(body.encode('utf-8'))
+
+    for attachment in attachments or []:
+        attachment_path, filename, content_type = attachment if isinstance(attachment, tuple) else (attachment, None, None)
+        if not os.path.exists(attachment_path):
+            continue
+        filename = filename or os.path.basename(attachment_path)
+        content_type = content_type or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        yield (
+            f'--{boundary}\r\n'
+            f'Content-Type: {content_type}\r\n'
+            'Content-Transfer-Encoding: base64\r\n'
+            f'Content-Disposition: attachment; {encode_filename(filename)}\r\n\r\n'
+        ).encode('ascii')
+        yield from iter_file_base64(attachment_path)
+
+    yield f'--{boundary}--\r\n'.encode('ascii')
+
+
+def write_message(file, from_email, to_email, subject, body, attachments=None):
+    """
+    Записывает письмо в открытый на запись двоичный файл; вернет число байтов
+    """
+    size = 0
+    for chunk in iter_message(from_email, to_email, subject, body, attachments):
+        file.write(chunk)
+        size += len(chunk)
+    return size
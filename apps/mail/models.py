@@ -1,9 +1,11 @@
-from django.db import models
+from django.db import models, transaction
 import uuid
 import os
 from django.conf import settings
 from django.utils import timezone
 
+from mail.armor import armor
+
 
 def get_attachment_file_path(instance, filename):
     """
@@ -15,16 +17,94 @@ def get_attachment_file_path(instance, filename):
     return os.path.join('mail_attachments', unique_filename)
 
 
+def get_blob_file_path(sha256):
+    """
+    Путь файла в хранилище блобов по SHA-256 содержимого
+
+    Два уровня каталогов по первым байтам хеша (mail_blobs/ab/cd/abcd...):
+    в каждом каталоге остается немного файлов при любом объеме вложений
+    """
+    return os.path.join('mail_blobs', sha256[:2], sha256[2:4], sha256)
+
+
+class AttachmentBlob(models.Model):
+    """
+    Содержимое вложения, хранящееся один раз на каждый уникальный SHA-256
+
+    ref_count - число вложений (MailAttachment), ссылающихся на блоб.
+    Блоб без ссылок удаляет команда mail_blob_gc спустя время ожидания
+    после unreferenced_at.
+    """
+    sha256 = models.CharField(max_length=64, primary_key=True, verbose_name="SHA-256")
+    file = models.FileField(max_length=255, verbose_name="Файл")
+    size = models.PositiveBigIntegerField(verbose_name="Размер (байт)")
+    ref_count = models.PositiveIntegerField(default=0, verbose_name="Число ссылок")
+    unreferenced_at = models.DateTimeField(null=True, blank=True, verbose_name="Без ссылок с")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+
+    class Meta:
+        verbose_name = "Содержимое вложения"
+        verbose_name_plural = "Содержимое вложений"
+        indexes = [
+            models.Index(
+                fields=['unreferenced_at'],
+                name='mail_blob_unreferenced_idx',
+                condition=models.Q(ref_count=0)
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.sha256} ({self.size} байт, ссылок: {self.ref_count})"
+
+
+class MailAttachmentQuerySet(models.QuerySet):
+    """
+    QuerySet вложений с проверкой доступа
+    """
+
+    def accessible_to(self, user):
+        """
+        Вложения, которые пользователь загрузил сам или получил/отправил в письме
+        """
+        linked = MailMessage.attachments.through.objects.filter(
+            models.Q(mailmessage__from_user=user) | models.Q(mailmessage__to_user=user),
+            mailattachment_id=models.OuterRef('pk')
+        )
+        return self.filter(models.Q(uploaded_by=user) | models.Exists(linked))
+
+
 class MailAttachment(models.Model):
     """
     Модель для хранения вложений сообщений
+
+    Вложения, загруженные после появления блобов, ссылаются на AttachmentBlob,
+    и file указывает на файл блоба. У старых вложений blob пустой, а файл
+    лежит в mail_attachments/ (перенос - команда mail_blob_backfill).
     """
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     file = models.FileField(upload_to=get_attachment_file_path, verbose_name="Файл")
     filename = models.CharField(max_length=255, verbose_name="Имя файла")
     file_size = models.PositiveIntegerField(verbose_name="Размер файла (байт)")
     content_type = models.CharField(max_length=100, verbose_name="Тип содержимого")
+    blob = models.ForeignKey(
+        AttachmentBlob,
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        related_name='attachments',
+        verbose_name="Содержимое"
+    )
+    uploaded_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='mail_attachments',
+        verbose_name="Загрузил"
+    )
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+
+    objects = MailAttachmentQuerySet.as_manager()
     
     class Meta:
         verbose_name = "Вложение"
@@ -37,11 +117,147 @@ class MailAttachment(models.Model):
     def delete(self, *args, **kwargs):
         """
         Переопределяем метод delete, чтобы удалить сам файл при удалении записи
+
+        Файл блоба общий для нескольких вложений: вместо удаления уменьшаем
+        число ссылок, сам файл удалит mail_blob_gc
         """
+        if self.blob_id:
+            from mail import blobs
+
+            blob_id = self.blob_id
+            with transaction.atomic():
+                result = super().delete(*args, **kwargs)
+                blobs.release(blob_id)
+            return result
+
         # Проверяем существование файла и удаляем его
         if self.file and os.path.isfile(self.file.path):
             os.remove(self.file.path)
-        super().delete(*args, **kwargs)
+        return super().delete(*args, **kwargs)
+
+
+class AttachmentUpload(models.Model):
+    """
+    Незавершенная загрузка вложения по частям
+
+    Части дописываются прямо в итоговый файл file_name в хранилище, received -
+    сколько байт уже записано. После finalize создается MailAttachment с этим
+    файлом, а загрузка помечается завершенной.
+    """
+    STATUS_CHOICES = (
+        ('uploading', 'Загружается'),
+        ('complete', 'Завершена'),
+    )
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='attachment_uploads',
+        verbose_name="Пользователь"
+    )
+    filename = models.CharField(max_length=255, verbose_name="Имя файла")
+    content_type = models.CharField(max_length=100, default='application/octet-stream', verbose_name="Тип содержимого")
+    size = models.PositiveBigIntegerField(verbose_name="Размер файла (байт)")
+    sha256 = models.CharField(max_length=64, blank=True, verbose_name="Ожидаемый SHA-256")
+    file_name = models.CharField(max_length=255, verbose_name="Путь к файлу в хранилище")
+    received = models.PositiveBigIntegerField(default=0, verbose_name="Получено байт")
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default='uploading', verbose_name="Статус")
+    attachment = models.OneToOneField(
+        MailAttachment,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='upload',
+        verbose_name="Вложение"
+    )
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
+
+    class Meta:
+        verbose_name = "Загрузка вложения"
+        verbose_name_plural = "Загрузки вложений"
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.filename} ({self.received}/{self.size} байт)"
+
+
+class MailMessageQuerySet(models.QuerySet):
+    """
+    QuerySet почтовых сообщений с условиями папок
+
+    Каждая папка - одно условие WHERE без union(), поэтому к результату применимы
+    фильтры, поиск, сортировка, count() и keyset-пагинация
+    """
+    FOLDERS = ('inbox', 'sent', 'drafts', 'trash')
+
+    def visible_to(self, user):
+        """
+        Все сообщения, в которых пользователь - отправитель или получатель
+        """
+        return self.filter(models.Q(from_user=user) | models.Q(to_user=user))
+
+    def inbox(self, user):
+        """
+        Входящие: получатель - пользователь, не черновик, не в корзине
+        """
+        return self.filter(to_user=user, is_draft=False, is_deleted_by_recipient=False)
+
+    def sent(self, user):
+        """
+        Отправленные: отправитель - пользователь, не черновик, не в корзине
+        """
+        return self.filter(from_user=user, is_draft=False, is_deleted_by_sender=False)
+
+    def drafts(self, user):
+        """
+        Черновики: отправитель - пользователь, черновик, не в корзине
+        """
+        return self.filter(from_user=user, is_draft=True, is_deleted_by_sender=False)
+
+    def trash(self, user):
+        """
+        Корзина: сообщения, удаленные пользователем со своей стороны.
+        Каждая ветка OR покрыта своим частичным индексом корзины
+        """
+        return self.filter(
+            models.Q(from_user=user, is_deleted_by_sender=True) |
+            models.Q(to_user=user, is_deleted_by_recipient=True)
+        )
+
+    def folder(self, name, user):
+        """
+        Сообщения папки по ее имени; для неизвестного имени - все сообщения пользователя
+        """
+        if name in self.FOLDERS:
+            return getattr(self, name)(user)
+        return self.visible_to(user)
+
+    def for_listing(self):
+        """
+        Подгружает все, что нужно MailMessageListSerializer, в одном запросе:
+        участников переписки через JOIN и признак наличия вложений через EXISTS
+        """
+        linked_attachments = MailMessage.attachments.through.objects.filter(
+            mailmessage_id=models.OuterRef('pk')
+        )
+        # Тела писем в списке не нужны, а это самые большие колонки строки
+        return self.select_related('from_user', 'to_user').defer('content_encrypted', 'content_binary').annotate(
+            has_linked_attachments=models.Exists(linked_attachments)
+        )
+
+    def conversation(self, thread, user):
+        """
+        Письма переписки, которые видит пользователь, от старых к новым
+
+        Чужие черновики ответов не показываются. Условие на thread
+        читается по индексу mail_thread_messages_idx уже в нужном порядке
+        """
+        return self.visible_to(user).filter(
+            models.Q(is_draft=False) | models.Q(from_user=user),
+            thread=thread
+        ).order_by('created_at', 'id')
 
 
 class MailMessage(models.Model):
@@ -63,18 +279,74 @@ class MailMessage(models.Model):
     )
     subject = models.CharField(max_length=255, verbose_name="Тема")
     content_encrypted = models.TextField(verbose_name="Зашифрованное содержимое")
+    # OpenPGP-сообщение без armor (см. mail.armor); тогда content_encrypted пустой
+    content_binary = models.BinaryField(null=True, blank=True, verbose_name="Зашифрованное содержимое (двоичное)")
     attachments = models.ManyToManyField(MailAttachment, blank=True, related_name="messages", verbose_name="Вложения")
     attachments_meta = models.JSONField(default=list, blank=True, verbose_name="Метаданные вложений")
     is_encrypted = models.BooleanField(default=True, verbose_name="Зашифровано")
     is_draft = models.BooleanField(default=False, verbose_name="Черновик")
     is_deleted_by_sender = models.BooleanField(default=False, verbose_name="Удалено отправителем")
     is_deleted_by_recipient = models.BooleanField(default=False, verbose_name="Удалено получателем")
+    is_read = models.BooleanField(default=False, verbose_name="Прочитано получателем")
+    read_at = models.DateTimeField(null=True, blank=True, verbose_name="Дата прочтения")
+    # Переписка назначается в mailbox.track() (см. mail.threads)
+    thread = models.ForeignKey(
+        'MailThread',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='messages',
+        verbose_name="Переписка"
+    )
+    in_reply_to = models.ForeignKey(
+        'self',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='replies',
+        verbose_name="Ответ на письмо"
+    )
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
 
+    objects = MailMessageQuerySet.as_manager()
+
     class Meta:
         verbose_name = "Сообщение"
         verbose_name_plural = "Сообщения"
         ordering = ['-created_at']
+        # Частичные индексы повторяют условия папок и заканчиваются ключом
+        # keyset-пагинации (created_at, id), чтобы страница читалась по индексу без сортировки.
+        # Булевы флаги вынесены в условие индекса: Django сравнивает их как "NOT is_draft",
+        # а такое выражение не может использовать колонку составного индекса
+        indexes = [
+            models.Index(
+                fields=['to_user', 'created_at', 'id'],
+                condition=models.Q(is_draft=False, is_deleted_by_recipient=False),
+                name='mail_inbox_idx'
+            ),
+            models.Index(
+                fields=['from_user', 'created_at', 'id'],
+                condition=models.Q(is_draft=False, is_deleted_by_sender=False),
+                name='mail_sent_idx'
+            ),
+            models.Index(
+                fields=['from_user', 'created_at', 'id'],
+                condition=models.Q(is_draft=True, is_deleted_by_sender=False),
+                name='mail_drafts_idx'
+            ),
+            models.Index(
+                fields=['from_user', 'created_at', 'id'],
+                condition=models.Q(is_deleted_by_sender=True),
+                name='mail_sender_trash_idx'
+            ),
+            models.Index(
+                fields=['to_user', 'created_at', 'id'],
+                condition=models.Q(is_deleted_by_recipient=True),
+                name='mail_recipient_trash_idx'
+            ),
+            # Письма переписки в хронологическом порядке
+            models.Index(fields=['thread', 'created_at', 'id'], name='mail_thread_messages_idx'),
+        ]
 
     def __str__(self):
         return f"От: {self.from_user.email} К: {self.to_user.email} - {self.subject}"
@@ -87,9 +359,196 @@ class MailMessage(models.Model):
             return self.is_deleted_by_sender
         elif user.id == self.to_user.id:
             return self.is_deleted_by_recipient
-        return False 
+        return False
+
+    def encrypted_payload(self):
+        """
+        Тело письма для gpg: двоичное OpenPGP-сообщение или текст старого формата
+        """
+        if self.content_binary is not None:
+            return bytes(self.content_binary)
+        return self.content_encrypted
+
+    def armored_content(self):
+        """
+        Тело письма в том виде, в каком его отправил клиент (armor-текст)
+        """
+        if self.content_binary is not None:
+            return armor(self.content_binary)
+        return self.content_encrypted
     
 
+class MailThread(models.Model):
+    """
+    Переписка: исходное письмо и ответы на него (MailMessage.in_reply_to)
+
+    Агрегаты хранятся в строке и пересчитываются при создании, отправке и
+    удалении писем переписки (mail.threads.refresh), поэтому список переписок
+    не группирует письма. Черновики в агрегаты не входят.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    subject = models.CharField(max_length=255, blank=True, verbose_name="Тема")
+    message_count = models.PositiveIntegerField(default=0, verbose_name="Число писем")
+    has_attachments = models.BooleanField(default=False, verbose_name="Есть вложения")
+    last_activity_at = models.DateTimeField(null=True, blank=True, verbose_name="Последнее письмо")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+
+    class Meta:
+        verbose_name = "Переписка"
+        verbose_name_plural = "Переписки"
+        ordering = ['-last_activity_at']
+
+    def __str__(self):
+        return f"{self.subject} ({self.message_count})"
+
+
+class MailThreadParticipant(models.Model):
+    """
+    Участник переписки
+
+    last_activity_at повторяет поле переписки: список переписок пользователя
+    читается по индексу (user, last_activity_at, id) этой таблицы без JOIN
+    перед сортировкой.
+    """
+    thread = models.ForeignKey(
+        MailThread,
+        on_delete=models.CASCADE,
+        related_name='participants',
+        verbose_name="Переписка"
+    )
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='mail_threads',
+        verbose_name="Пользователь"
+    )
+    last_activity_at = models.DateTimeField(verbose_name="Последнее письмо")
+
+    class Meta:
+        verbose_name = "Участник переписки"
+        verbose_name_plural = "Участники переписок"
+        ordering = ['-last_activity_at']
+        constraints = [
+            models.UniqueConstraint(fields=['thread', 'user'], name='mail_thread_participant_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'last_activity_at', 'id'], name='mail_thread_user_activity_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} в {self.thread_id}"
+
+
+class MailboxCounters(models.Model):
+    """
+    Счетчики папок почтового ящика пользователя
+
+    Поддерживаются инкрементально при каждом изменении писем (см. mail.mailbox),
+    поэтому эндпоинт счетчиков не выполняет COUNT(*) по сообщениям.
+    Пересчитать с нуля можно командой manage.py mail_rebuild_counters
+    """
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='mailbox_counters',
+        verbose_name="Пользователь"
+    )
+    inbox_total = models.IntegerField(default=0, verbose_name="Входящие")
+    inbox_unread = models.IntegerField(default=0, verbose_name="Непрочитанные входящие")
+    sent_total = models.IntegerField(default=0, verbose_name="Отправленные")
+    drafts_total = models.IntegerField(default=0, verbose_name="Черновики")
+    trash_total = models.IntegerField(default=0, verbose_name="Корзина")
+    trash_unread = models.IntegerField(default=0, verbose_name="Непрочитанные в корзине")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
+
+    COUNTER_FIELDS = (
+        'inbox_total', 'inbox_unread', 'sent_total',
+        'drafts_total', 'trash_total', 'trash_unread',
+    )
+
+    class Meta:
+        verbose_name = "Счетчики почтового ящика"
+        verbose_name_plural = "Счетчики почтовых ящиков"
+
+    def __str__(self):
+        return f"Счетчики почты: {self.user.email}"
+
+
+class MailChange(models.Model):
+    """
+    Журнал изменений писем для дельта-синхронизации клиентов
+
+    Запись появляется, когда письмо меняет положение в папках пользователя
+    (создано, перемещено в корзину, восстановлено, прочитано, удалено).
+    seq монотонно растет, клиент запоминает последний полученный seq и
+    запрашивает только более новые изменения (GET /mail/sync/?since=<seq>).
+    Ссылка на письмо хранится без внешнего ключа, чтобы запись об удалении
+    пережила само письмо.
+    """
+    ACTION_CHOICES = (
+        ('created', 'Создано'),
+        ('updated', 'Изменено'),
+        ('moved', 'Перемещено'),
+        ('trashed', 'Перемещено в корзину'),
+        ('restored', 'Восстановлено'),
+        ('read', 'Прочитано'),
+        ('unread', 'Не прочитано'),
+        ('deleted', 'Удалено'),
+    )
+
+    seq = models.BigAutoField(primary_key=True, verbose_name="Порядковый номер")
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='mail_changes',
+        verbose_name="Пользователь"
+    )
+    message_id = models.UUIDField(verbose_name="ID сообщения")
+    action = models.CharField(max_length=16, choices=ACTION_CHOICES, verbose_name="Действие")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата изменения")
+
+    class Meta:
+        verbose_name = "Изменение почты"
+        verbose_name_plural = "Изменения почты"
+        ordering = ['seq']
+        indexes = [
+            models.Index(fields=['user', 'seq'], name='mail_change_user_seq_idx'),
+        ]
+
+    def __str__(self):
+        return f"#{self.seq} {self.action} {self.message_id}"
+
+
+class MailSearchDocument(models.Model):
+    """
+    Текст письма для полнотекстового поиска (см. mail.search)
+
+    Тема и участники (email, имя, фамилия отправителя и получателя) в нижнем
+    регистре, как они были при создании письма. В SQLite по этой таблице
+    строится индекс FTS5 mail_search: целочисленный id служит его rowid, а
+    триггеры таблицы обновляют индекс при вставке, изменении и удалении строк.
+    users - токены участников "u<id>", по ним поиск ограничивается письмами
+    пользователя внутри индекса. Строка удаляется вместе с письмом.
+    """
+    message = models.OneToOneField(
+        MailMessage,
+        on_delete=models.CASCADE,
+        related_name='search_document',
+        verbose_name="Сообщение"
+    )
+    subject = models.CharField(max_length=255, verbose_name="Тема")
+    participants = models.TextField(verbose_name="Участники")
+    users = models.CharField(max_length=80, verbose_name="Токены участников")
+
+    class Meta:
+        verbose_name = "Поисковый документ письма"
+        verbose_name_plural = "Поисковые документы писем"
+
+    def __str__(self):
+        return self.subject
+
+
 class PGPKey(models.Model):
     """
     Модель для хранения PGP ключей пользователей
@@ -102,6 +561,13 @@ class PGPKey(models.Model):
         verbose_name="Пользователь"
     )
     public_key = models.TextField(verbose_name="Публичный ключ")
+    fingerprint = models.CharField(
+        max_length=40,
+        blank=True,
+        default='',
+        verbose_name="Отпечаток публичного ключа",
+        help_text="Заполняется командой mail_gpg_compact; сбрасывается при смене ключа"
+    )
     private_key_encrypted = models.TextField(verbose_name="Зашифрованный приватный ключ (AES-256)")
     session_key = models.CharField(max_length=255, null=True, blank=True, verbose_name="Ключ сессии (AES-256)")
     session_expires = models.DateTimeField(null=True, blank=True, verbose_name="Срок действия ключа сессии")
@@ -115,6 +581,34 @@ class PGPKey(models.Model):
 
     def __str__(self):
         return f"PGP ключ: {self.user.email}"
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Загруженный ключ нужен, чтобы при сохранении заметить его смену
+        instance._loaded_public_key = instance.__dict__.get('public_key')
+        return instance
+
+    def save(self, *args, **kwargs):
+        """
+        При смене публичного ключа забывает старый ключ в кешах процесса
+        """
+        loaded = getattr(self, '_loaded_public_key', None)
+        update_fields = kwargs.get('update_fields')
+        saves_key = update_fields is None or 'public_key' in update_fields
+        if saves_key and loaded is not None and loaded != self.public_key:
+            from mail.keysessions import unlocked_keys
+            from mail.utils import public_keys
+
+            public_keys.forget(loaded)
+            # Разблокированный старый ключ этого воркера больше не нужен
+            unlocked_keys.discard(self.user_id)
+            self.fingerprint = ''
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'fingerprint'}
+        super().save(*args, **kwargs)
+        if saves_key:
+            self._loaded_public_key = self.public_key
     
     def is_session_valid(self):
         """
@@ -124,3 +618,174 @@ class PGPKey(models.Model):
             return False
         return self.session_expires > timezone.now()
     
+
+
+class PGPKeyJob(models.Model):
+    """
+    Фоновое создание пары PGP ключей пользователя
+
+    Пока задание ждет воркер (mail_keyworker), пароль хранится зашифрованным
+    ключом сервера и стирается сразу после создания ключей.
+    """
+    STATUS_CHOICES = (
+        ('pending', 'В очереди'),
+        ('running', 'Выполняется'),
+        ('done', 'Готово'),
+        ('failed', 'Ошибка'),
+    )
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='pgp_key_jobs',
+        verbose_name="Пользователь"
+    )
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default='pending', verbose_name="Статус")
+    passphrase_encrypted = models.TextField(blank=True, verbose_name="Пароль, зашифрованный ключом сервера")
+    from_pool = models.BooleanField(default=False, verbose_name="Ключи взяты из запаса")
+    error = models.TextField(blank=True, verbose_name="Ошибка")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
+
+    class Meta:
+        verbose_name = "Создание PGP ключей"
+        verbose_name_plural = "Создание PGP ключей"
+        ordering = ['-created_at']
+        indexes = [
+            # Очередь воркера: только ожидающие задания
+            models.Index(
+                fields=['created_at'],
+                name='mail_pgp_job_pending_idx',
+                condition=models.Q(status='pending')
+            ),
+        ]
+
+    def __str__(self):
+        return f"Создание ключей {self.user_id}: {self.get_status_display()}"
+
+
+class PregeneratedKey(models.Model):
+    """
+    Заранее созданная пара ключей, еще не выданная пользователю
+
+    Приватный ключ без пароля GnuPG, поэтому хранится зашифрованным ключом
+    сервера; при выдаче он шифруется паролем пользователя (AES-256), как и
+    ключи, созданные по заданию.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    public_key = models.TextField(verbose_name="Публичный ключ")
+    private_key_encrypted = models.TextField(verbose_name="Приватный ключ, зашифрованный ключом сервера")
+    fingerprint = models.CharField(max_length=40, verbose_name="Отпечаток")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+
+    class Meta:
+        verbose_name = "Запасная пара PGP ключей"
+        verbose_name_plural = "Запас PGP ключей"
+        ordering = ['created_at']
+
+    def __str__(self):
+        return self.fingerprint
+
+
+class OutboundEmail(models.Model):
+    """
+    Письмо в очереди отправки через SMTP (Postfix)
+
+    Запрос только ставит письмо в очередь, отправляет его воркер
+    mail_outbox_worker (mail.outbox) по постоянному соединению. Временные
+    ошибки (4xx, обрыв соединения) повторяются с экспоненциальной задержкой,
+    постоянные (5xx) и исчерпание попыток завершают доставку статусом failed.
+    """
+    STATUS_CHOICES = (
+        ('queued', 'В очереди'),
+        ('sending', 'Отправляется'),
+        ('sent', 'Отправлено'),
+        ('failed', 'Ошибка'),
+    )
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    message = models.ForeignKey(
+        MailMessage,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='outbound',
+        verbose_name="Сообщение"
+    )
+    from_email = models.CharField(max_length=254, verbose_name="Отправитель")
+    to_email = models.CharField(max_length=254, verbose_name="Получатель")
+    subject = models.CharField(max_length=998, blank=True, verbose_name="Тема")
+    body = models.TextField(blank=True, verbose_name="Тело письма")
+    attachments = models.JSONField(default=list, blank=True, verbose_name="Пути к файлам вложений")
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default='queued', verbose_name="Статус")
+    attempts = models.PositiveIntegerField(default=0, verbose_name="Число попыток")
+    next_attempt_at = models.DateTimeField(default=timezone.now, verbose_name="Следующая попытка")
+    lease = models.UUIDField(null=True, blank=True, verbose_name="Метка воркера")
+    last_error = models.TextField(blank=True, verbose_name="Последняя ошибка")
+    queue_id = models.CharField(max_length=32, blank=True, verbose_name="ID в очереди Postfix")
+    sent_at = models.DateTimeField(null=True, blank=True, verbose_name="Дата отправки")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
+
+    class Meta:
+        verbose_name = "Исходящее письмо"
+        verbose_name_plural = "Очередь исходящих писем"
+        ordering = ['-created_at']
+        indexes = [
+            # Очередь воркера: только ожидающие письма в порядке следующей попытки
+            models.Index(
+                fields=['next_attempt_at'],
+                name='mail_outbound_queued_idx',
+                condition=models.Q(status='queued')
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.to_email}: {self.get_status_display()}"
+
+
+class PostfixDelivery(models.Model):
+    """
+    Последний статус доставки письма получателю по логу Postfix
+
+    Заполняется индексатором лога (mail.postfixlog, команда mail_postfix_index):
+    одна строка на пару (ID очереди Postfix, получатель), более поздняя строка
+    лога перезаписывает статус (deferred -> sent).
+    """
+    queue_id = models.CharField(max_length=32, verbose_name="ID в очереди Postfix")
+    recipient = models.CharField(max_length=254, verbose_name="Получатель")
+    status = models.CharField(max_length=16, verbose_name="Статус")
+    dsn = models.CharField(max_length=16, blank=True, verbose_name="Код DSN")
+    relay = models.CharField(max_length=255, blank=True, verbose_name="Relay")
+    response = models.TextField(blank=True, verbose_name="Ответ сервера")
+    logged_at = models.DateTimeField(null=True, blank=True, verbose_name="Время записи в логе")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
+
+    class Meta:
+        verbose_name = "Доставка Postfix"
+        verbose_name_plural = "Доставки Postfix"
+        ordering = ['-logged_at']
+        constraints = [
+            models.UniqueConstraint(fields=['queue_id', 'recipient'], name='mail_postfix_delivery_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.queue_id} {self.recipient}: {self.status}"
+
+
+class PostfixLogCursor(models.Model):
+    """
+    Позиция индексатора в файле лога Postfix: inode и смещение прочитанной части
+    """
+    path = models.CharField(max_length=255, unique=True, verbose_name="Путь к логу")
+    inode = models.BigIntegerField(default=0, verbose_name="Inode файла")
+    offset = models.BigIntegerField(default=0, verbose_name="Смещение")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
+
+    class Meta:
+        verbose_name = "Позиция в логе Postfix"
+        verbose_name_plural = "Позиции в логах Postfix"
+
+    def __str__(self):
+        return f"{self.path}: {self.offset}"
@@ -0,0 +1,283 @@
+"""
+Очередь исходящих писем и их доставка через SMTP (Postfix)
+
+Отправитель только ставит письмо в очередь (enqueue) - запись OutboundEmail,
+запрос не ждет SMTP. Воркер mail_outbox_worker забирает пачки писем и
+отправляет их по одному постоянному соединению: установка соединения и EHLO
+выполняются один раз на много писем, соединение переоткрывается после
+MESSAGES_PER_CONNECTION писем, а после простоя дольше IDLE_TIMEOUT
+проверяется командой NOOP. Письмо собирается потоком (mail.mime): вложения
+кодируются в base64 по мере передачи в DATA.
+
+Ошибки:
+    4xx, обрыв соединения - повтор через RETRY_BASE * 2^(попытка-1) секунд,
+                            но не позже RETRY_MAX; после MAX_ATTEMPTS - failed
+    5xx                   - failed сразу, повтор не поможет
+
+Письмо с ответом 250 получает статус sent и ID очереди Postfix (queue_id).
+
+Настройки MAIL_OUTBOX: HOST, PORT, TIMEOUT, BATCH_SIZE, MAX_ATTEMPTS,
+RETRY_BASE, RETRY_MAX, MESSAGES_PER_CONNECTION, IDLE_TIMEOUT.
+"""
+import logging
+import re
+import smtplib
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import models
+from django.utils import timezone
+
+from mail.mime import iter_message
+from mail.models import OutboundEmail
+
+logger = logging.getLogger('mail_service')
+
+queue_id_pattern = re.compile(r'queued as ([0-9A-Za-z]+)')
+# Строки, начинающиеся с точки, в DATA удваивают точку (RFC 5321, 4.5.2)
+leading_dot_pattern = re.compile(rb'^\.', re.MULTILINE)
+# Сколько байтов письма копить перед записью в сокет
+SEND_BUFFER = 64 * 1024
+
+
+def get_config():
+    config = getattr(settings, 'MAIL_OUTBOX', {})
+    return {
+        'HOST': config.get('HOST', 'localhost'),
+        'PORT': config.get('PORT', 25),
+        'TIMEOUT': config.get('TIMEOUT', 30),
+        'BATCH_SIZE': config.get('BATCH_SIZE', 50),
+        'MAX_ATTEMPTS': config.get('MAX_ATTEMPTS', 10),
+        'RETRY_BASE': config.get('RETRY_BASE', 60),
+        'RETRY_MAX': config.get('RETRY_MAX', 3600),
+        'MESSAGES_PER_CONNECTION': config.get('MESSAGES_PER_CONNECTION', 100),
+        'IDLE_TIMEOUT': config.get('IDLE_TIMEOUT', 60),
+    }
+
+
+def enqueue(from_email, to_email, subject, body, attachments=None, message=None):
+    """
+    Ставит письмо в очередь отправки; вернется запись OutboundEmail
+    """
+    return OutboundEmail.objects.create(
+        message=message,
+        from_email=from_email,
+        to_email=to_email,
+        subject=subject,
+        body=body,
+        attachments=list(attachments or [])
+    )
+
+
+def retry_delay(attempts, config=None):
+    """
+    Задержка перед следующей попыткой после attempts неудачных
+    """
+    config = config or get_config()
+    return timedelta(seconds=min(config['RETRY_BASE'] * 2 ** (attempts - 1), config['RETRY_MAX']))
+
+
+class SMTPConnection:
+    """
+    Постоянное соединение с SMTP-сервером для последовательной отправки писем
+    """
+
+    def __init__(self, host, port, timeout=30, max_messages=100, idle_timeout=60):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.max_messages = max_messages
+        self.idle_timeout = idle_timeout
+        self.smtp = None
+        self.sent = 0
+        self.used_at = 0
+
+    @classmethod
+    def from_config(cls, config=None):
+        config = config or get_config()
+        return cls(
+            config['HOST'], config['PORT'], config['TIMEOUT'],
+            config['MESSAGES_PER_CONNECTION'], config['IDLE_TIMEOUT']
+        )
+
+    def open(self):
+        """
+        Открытое соединение: переиспользуется, пока живо и не исчерпан лимит писем
+        """
+        if self.smtp is not None and self.sent >= self.max_messages:
+            self.close()
+        if self.smtp is not None and time.monotonic() - self.used_at > self.idle_timeout:
+            # Сервер мог закрыть соединение, пока оно простаивало
+            try:
+                if self.smtp.noop()[0] != 250:
+                    self.close()
+            except (smtplib.SMTPException, OSError):
+                self.abort()
+        if self.smtp is None:
+            self.smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            self.smtp.ehlo_or_helo_if_needed()
+            self.sent = 0
+        self.used_at = time.monotonic()
+        return self.smtp
+
+    def send(self, outbound):
+        """
+        Отправляет письмо; вернет ответ сервера на DATA
+
+        Письмо передается в DATA кусками из mail.mime.iter_message, вложения
+        читаются с диска по мере отправки. Отказ в MAIL/RCPT/DATA - исключение
+        smtplib с кодом ответа, соединение при этом остается пригодным для
+        следующего письма; ошибка посреди передачи оставляет соединение сломанным
+        """
+        smtp = self.open()
+        try:
+            code, response = smtp.mail(outbound.from_email)
+            if code != 250:
+                raise smtplib.SMTPSenderRefused(code, response, outbound.from_email)
+            code, response = smtp.rcpt(outbound.to_email)
+            if code not in (250, 251):
+                raise smtplib.SMTPRecipientsRefused({outbound.to_email: (code, response)})
+            code, response = smtp.docmd('data')
+            if code != 354:
+                raise smtplib.SMTPDataError(code, response)
+        except (smtplib.SMTPSenderRefused, smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError):
+            smtp.rset()
+            raise
+
+        message = iter_message(outbound.from_email, outbound.to_email, outbound.subject, outbound.body, outbound.attachments)
+        # Мелкие куски (заголовки, границы частей) копятся в буфере: отдельные
+        # маленькие записи в сокет ждали бы подтверждения (алгоритм Нейгла)
+        buffer = bytearray()
+        for chunk in message:
+            buffer += leading_dot_pattern.sub(b'..', chunk)
+            if len(buffer) >= SEND_BUFFER:
+                smtp.send(buffer)
+                buffer.clear()
+        buffer += b'.\r\n'
+        smtp.send(buffer)
+        code, response = smtp.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, response)
+        self.sent += 1
+        self.used_at = time.monotonic()
+        return response.decode('utf-8', 'replace')
+
+    def close(self):
+        if self.smtp is None:
+            return
+        try:
+            self.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self.smtp.close()
+        self.smtp = None
+
+    def abort(self):
+        """
+        Закрывает сломанное соединение без QUIT
+        """
+        if self.smtp is not None:
+            self.smtp.close()
+        self.smtp = None
+
+    def close_if_idle(self):
+        if self.smtp is not None and time.monotonic() - self.used_at > self.idle_timeout:
+            self.close()
+
+
+def smtp_error_code(error):
+    """
+    Код ответа SMTP из исключения smtplib; None - ошибка соединения
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return min(code for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code
+    return None
+
+
+def claim_batch(size, stale_after=timedelta(minutes=30)):
+    """
+    Пачка писем, готовых к отправке, помеченная меткой этого воркера
+
+    Письмо, которое отправляется дольше stale_after, считается брошенным
+    (воркер остановили) и берется снова
+    """
+    now = timezone.now()
+    available = (
+        models.Q(status='queued', next_attempt_at__lte=now)
+        | models.Q(status='sending', updated_at__lt=now - stale_after)
+    )
+    ids = list(OutboundEmail.objects.filter(available).order_by('next_attempt_at').values_list('pk', flat=True)[:size])
+    if not ids:
+        return []
+    lease = uuid.uuid4()
+    # Повторная проверка условия в UPDATE: письма, которые уже забрал другой воркер, пропускаются
+    OutboundEmail.objects.filter(available, pk__in=ids).update(status='sending', lease=lease, updated_at=now)
+    return list(OutboundEmail.objects.filter(lease=lease, status='sending').order_by('next_attempt_at'))
+
+
+def record_failure(outbound, error, config):
+    """
+    Временная ошибка - письмо возвращается в очередь с задержкой, постоянная - failed
+    """
+    code = smtp_error_code(error)
+    outbound.attempts += 1
+    outbound.last_error = str(error)
+    outbound.lease = None
+    if (code is not None and code >= 500) or outbound.attempts >= config['MAX_ATTEMPTS']:
+        outbound.status = 'failed'
+        logger.error(f"Письмо {outbound.pk} к {outbound.to_email} не доставлено: {error}")
+    else:
+        outbound.status = 'queued'
+        outbound.next_attempt_at = timezone.now() + retry_delay(outbound.attempts, config)
+        logger.warning(f"Письмо {outbound.pk} к {outbound.to_email} отложено (попытка {outbound.attempts}): {error}")
+    outbound.save(update_fields=['status', 'attempts', 'last_error', 'lease', 'next_attempt_at', 'updated_at'])
+
+
+def deliver(batch, connection, config=None):
+    """
+    Отправляет пачку писем по соединению connection; вернет число отправленных
+
+    При обрыве соединения оно открывается заново для следующего письма; если
+    соединиться не удалось, откладывается весь остаток пачки
+    """
+    config = config or get_config()
+    delivered = 0
+    for index, outbound in enumerate(batch):
+        try:
+            connection.open()
+        except (smtplib.SMTPException, OSError) as e:
+            for rest in batch[index:]:
+                record_failure(rest, e, config)
+            break
+        try:
+            response = connection.send(outbound)
+        except (smtplib.SMTPException, OSError) as e:
+            if smtp_error_code(e) is None:
+                connection.abort()
+            record_failure(outbound, e, config)
+            continue
+
+        match = queue_id_pattern.search(response)
+        outbound.status = 'sent'
+        outbound.attempts += 1
+        outbound.queue_id = match.group(1) if match else ''
+        outbound.last_error = ''
+        outbound.lease = None
+        outbound.sent_at = timezone.now()
+        outbound.save(update_fields=['status', 'attempts', 'queue_id', 'last_error', 'lease', 'sent_at', 'updated_at'])
+        delivered += 1
+    return delivered
+
+
+def process_queue(connection, config=None, stale_after=timedelta(minutes=30)):
+    """
+    Отправляет одну пачку из очереди; вернет число взятых писем
+    """
+    config = config or get_config()
+    batch = claim_batch(config['BATCH_SIZE'], stale_after)
+    if batch:
+        deliver(batch, connection, config)
+    return len(batch)
@@ -0,0 +1,249 @@
+import base64
+import json
+import uuid
+from datetime import datetime
+
+from django.core.paginator import Paginator
+from django.db import models
+from rest_framework import pagination
+from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+from mail import search
+from mail.models import MailMessage
+
+
+def slice_by_primary_key(queryset, bottom, top):
+    """
+    Срез страницы с отложенной выборкой строк (late row lookup)
+
+    Сначала подзапрос выбирает только id строк страницы - узкая сортировка,
+    которую можно выполнить по индексу. Затем JOIN участников и EXISTS вложений
+    считаются только для этих строк, а не для всей папки перед сортировкой.
+    Это важно для условий с OR (корзина, все письма), где SQLite сортирует
+    результат целиком.
+    """
+    page_ids = queryset.values('pk')[bottom:top]
+    return queryset.filter(pk__in=page_ids)
+
+
+class LateRowLookupPaginator(Paginator):
+    """
+    Постраничный Paginator, который выбирает строки страницы через slice_by_primary_key
+    """
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        top = bottom + self.per_page
+        if top + self.orphans >= self.count:
+            top = self.count
+        return self._get_page(slice_by_primary_key(self.object_list, bottom, top), number, self)
+
+
+class MailCursorPagination(pagination.BasePagination):
+    """
+    Keyset-пагинация писем по паре (created_at, id)
+
+    Курсор - непрозрачная base64-строка с позицией последнего письма страницы.
+    Следующая страница выбирается условием "строго после курсора" по индексу
+    папки, без OFFSET и без COUNT(*), поэтому глубокие страницы стоят столько же,
+    сколько первая. Листать можно только вперед.
+    """
+    # Поле времени ключа; вторая часть ключа - id
+    ordering_field = 'created_at'
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = api_settings.PAGE_SIZE
+    max_page_size = 100
+    invalid_cursor_message = 'Неверный курсор'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.descending = self.is_descending(queryset)
+        sign = '-' if self.descending else ''
+
+        position = self.decode_cursor(request)
+        if position is not None:
+            queryset = queryset.filter(self.get_keyset_filter(*position))
+
+        queryset = queryset.order_by(f'{sign}{self.ordering_field}', f'{sign}id')
+        results = list(slice_by_primary_key(queryset, 0, self.page_size + 1))
+        self.has_next = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': None,
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def is_descending(self, queryset):
+        """
+        Направление берется из сортировки, которую уже применил OrderingFilter
+        """
+        ordering = queryset.query.order_by or queryset.model._meta.ordering
+        return not ordering or str(ordering[0]).startswith('-')
+
+    def get_keyset_filter(self, created_at, pk):
+        # Время <= курсора задает диапазон по индексу, id разрешает совпадения времени
+        field = self.ordering_field
+        if self.descending:
+            return models.Q(**{f'{field}__lte': created_at}) & (
+                models.Q(**{f'{field}__lt': created_at}) | models.Q(id__lt=pk)
+            )
+        return models.Q(**{f'{field}__gte': created_at}) & (
+            models.Q(**{f'{field}__gt': created_at}) | models.Q(id__gt=pk)
+        )
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        last = self.page[-1]
+        url = self.request.build_absolute_uri()
+        return replace_query_param(
+            url, self.cursor_query_param, self.encode_cursor(getattr(last, self.ordering_field), last.id)
+        )
+
+    def encode_cursor(self, created_at, pk):
+        payload = json.dumps({'c': created_at.isoformat(), 'i': str(pk)})
+        return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+    def parse_key(self, value):
+        """
+        id из курсора; ValueError или TypeError - курсор подделан
+        """
+        return uuid.UUID(value)
+
+    def decode_cursor(self, request):
+        """
+        Позиция (время, id) из курсора; NotFound, если курсор поврежден
+
+        Время и id проверяются здесь, иначе подделанный курсор дошел бы до
+        запроса и дал 500
+        """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8'))
+            position = datetime.fromisoformat(payload['c'])
+            if position.tzinfo is None:
+                raise ValueError(payload['c'])
+            return position, self.parse_key(payload['i'])
+        except (TypeError, ValueError, KeyError, AttributeError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+
+class MailThreadPagination(MailCursorPagination):
+    """
+    Keyset-пагинация списка переписок по паре (last_activity_at, id) строк MailThreadParticipant
+    """
+    ordering_field = 'last_activity_at'
+
+    def parse_key(self, value):
+        # id строки участника - целое число
+        return int(value)
+
+
+class MailSearchPagination(MailCursorPagination):
+    """
+    Курсорная пагинация результатов поиска по паре (релевантность, номер документа)
+
+    Страница - найденные письма в порядке mail.search.search(); курсор хранит
+    оценку и номер документа последнего результата
+    """
+
+    def paginate_search(self, request, user, text):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        hits = search.search(user, text, self.decode_cursor(request), self.page_size + 1)
+        self.has_next = len(hits) > self.page_size
+        self.hits = hits[:self.page_size]
+
+        ids = [message_id for message_id, _, _ in self.hits]
+        # Чужие черновики не показываются, даже если документ построен до их исключения из индекса
+        messages = MailMessage.objects.visible_to(user).filter(
+            models.Q(is_draft=False) | models.Q(from_user=user)
+        ).for_listing().in_bulk(ids)
+        self.page = [messages[message_id] for message_id in ids if message_id in messages]
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        _, score, key = self.hits[-1]
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(score, key))
+
+    def encode_cursor(self, score, key):
+        payload = json.dumps({'s': score, 'k': key})
+        return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8'))
+            return float(payload['s']), int(payload['k'])
+        except (TypeError, ValueError, KeyError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+
+class MailFolderPagination(pagination.PageNumberPagination):
+    """
+    Пагинация папок почты
+
+    По умолчанию работает как обычная постраничная пагинация. Если клиент передал
+    ?cursor=... или ?pagination=cursor, а действие поддерживает курсоры
+    (перечислено во view.cursor_actions), страница отдается через MailCursorPagination.
+    """
+    mode_query_param = 'pagination'
+    cursor_class = MailCursorPagination
+    django_paginator_class = LateRowLookupPaginator
+
+    def use_cursor(self, request, view):
+        if view is None or view.action not in getattr(view, 'cursor_actions', ()):
+            return False
+        return (
+            self.cursor_class.cursor_query_param in request.query_params
+            or request.query_params.get(self.mode_query_param) == 'cursor'
+        )
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor_paginator = None
+        if self.use_cursor(request, view):
+            self.cursor_paginator = self.cursor_class()
+            return self.cursor_paginator.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.cursor_paginator is not None:
+            return self.cursor_paginator.get_paginated_response(data)
+        return super().get_paginated_response(data)
@@ -0,0 +1,170 @@
+"""
+Индексатор лога Postfix: статусы доставки в таблицу PostfixDelivery
+
+Лог читается с места, где индексатор остановился в прошлый раз
+(PostfixLogCursor: inode файла и смещение), поэтому каждый запуск
+разбирает только новые строки. Строки статуса доставки
+
+    May  1 12:00:00 host postfix/smtp[123]: 4F9D12A3B: to=<a@example.com>,
+        relay=mx.example.com[1.2.3.4]:25, delay=1.2, dsn=2.0.0, status=sent (250 Ok)
+
+пишутся в базу пачками; позиция сохраняется в той же транзакции, что и пачка.
+
+Ротация: если inode файла сменился, сначала дочитывается прежний файл
+(path.1 с тем же inode), затем новый с начала. Если файл стал короче
+сохраненного смещения (copytruncate), он читается с начала.
+"""
+import os
+import re
+from datetime import datetime, timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from mail.models import PostfixDelivery, PostfixLogCursor
+
+# Короткий (шестнадцатеричный) и длинный (enable_long_queue_ids) ID очереди
+line_pattern = re.compile(
+    r'^(?P<timestamp>\w{3} [ \d]\d \d\d:\d\d:\d\d|\d{4}-\d\d-\d\dT\S+)\s+\S+\s+'
+    r'postfix(?:-[\w-]+)?/[\w/-]+\[\d+\]:\s+(?P<queue_id>[0-9A-F]{6,}|[0-9B-DF-HJ-NP-TV-Zb-df-hj-np-tv-z]{10,}):\s+'
+    r'(?P<details>.*)$'
+)
+delivery_pattern = re.compile(r'\bto=<(?P<recipient>[^>]*)>.*?\bstatus=(?P<status>\w+)(?: \((?P<response>.*)\))?$')
+field_pattern = re.compile(r'\b(?P<name>relay|dsn)=(?P<value>[^,\s]+)')
+
+
+def parse_timestamp(value, now=None):
+    """
+    Время строки лога: RFC 3339 или syslog без года (год - текущий или прошлый)
+    """
+    if value[0].isdigit():
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    now = now or timezone.localtime()
+    try:
+        parsed = datetime.strptime(f'{now.year} {value}', '%Y %b %d %H:%M:%S')
+    except ValueError:
+        return None
+    parsed = timezone.make_aware(parsed, now.tzinfo)
+    # Декабрьские строки, прочитанные в январе, относятся к прошлому году
+    if parsed - now > timedelta(days=1):
+        parsed = parsed.replace(year=now.year - 1)
+    return parsed
+
+
+def parse_line(line, timestamps=None):
+    """
+    Статус доставки из строки лога или None, если строка не о доставке
+
+    timestamps - словарь уже разобранных отметок времени: у соседних строк
+    лога они обычно совпадают, а strptime - самая дорогая часть разбора
+    """
+    if 'status=' not in line:
+        return None
+    match = line_pattern.match(line)
+    if match is None:
+        return None
+    delivery = delivery_pattern.search(match['details'])
+    if delivery is None:
+        return None
+    fields = {field['name']: field['value'] for field in field_pattern.finditer(match['details'])}
+    timestamp = match['timestamp']
+    if timestamps is None:
+        logged_at = parse_timestamp(timestamp)
+    elif timestamp in timestamps:
+        logged_at = timestamps[timestamp]
+    else:
+        if len(timestamps) > 1024:
+            timestamps.clear()
+        logged_at = timestamps[timestamp] = parse_timestamp(timestamp)
+    return PostfixDelivery(
+        queue_id=match['queue_id'],
+        recipient=delivery['recipient'][:254],
+        status=delivery['status'][:16],
+        dsn=fields.get('dsn', '')[:16],
+        relay=fields.get('relay', '')[:255],
+        response=delivery['response'] or '',
+        logged_at=logged_at,
+    )
+
+
+def save_batch(deliveries, cursor):
+    """
+    Записывает пачку статусов и позицию лога одной транзакцией
+    """
+    # В пределах пачки остается последняя строка по каждому получателю
+    latest = {(delivery.queue_id, delivery.recipient): delivery for delivery in deliveries}
+    with transaction.atomic():
+        PostfixDelivery.objects.bulk_create(
+            latest.values(),
+            update_conflicts=True,
+            unique_fields=['queue_id', 'recipient'],
+            update_fields=['status', 'dsn', 'relay', 'response', 'logged_at', 'updated_at'],
+        )
+        cursor.save(update_fields=['inode', 'offset', 'updated_at'])
+
+
+def read_file(path, cursor, batch_size):
+    """
+    Разбирает файл с cursor.offset до последней полной строки; вернет число статусов
+    """
+    count = 0
+    deliveries = []
+    timestamps = {}
+    with open(path, 'rb') as file:
+        file.seek(cursor.offset)
+        for line in file:
+            # Незаконченная строка дочитывается в следующий раз
+            if not line.endswith(b'\n'):
+                break
+            cursor.offset += len(line)
+            delivery = parse_line(line.decode('utf-8', 'replace').rstrip('\r\n'), timestamps)
+            if delivery is not None:
+                deliveries.append(delivery)
+            if len(deliveries) >= batch_size:
+                save_batch(deliveries, cursor)
+                count += len(deliveries)
+                deliveries = []
+    save_batch(deliveries, cursor)
+    return count + len(deliveries)
+
+
+def index_log(path, batch_size=1000):
+    """
+    Индексирует новые строки лога path; вернет число записанных статусов
+    """
+    cursor, _ = PostfixLogCursor.objects.get_or_create(path=path)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return 0
+
+    if cursor.inode == stat.st_ino and cursor.offset == stat.st_size:
+        return 0
+
+    count = 0
+    if cursor.inode and cursor.inode != stat.st_ino:
+        rotated = f'{path}.1'
+        if os.path.exists(rotated) and os.stat(rotated).st_ino == cursor.inode:
+            count += read_file(rotated, cursor, batch_size)
+        cursor.offset = 0
+    elif stat.st_size < cursor.offset:
+        cursor.offset = 0
+    cursor.inode = stat.st_ino
+    return count + read_file(path, cursor, batch_size)
+
+
+def delivery_status(queue_id):
+    """
+    Итоговый статус письма по всем получателям: delivered, bounced, deferred или unknown
+    """
+    statuses = set(PostfixDelivery.objects.filter(queue_id=queue_id).values_list('status', flat=True))
+    if statuses & {'bounced', 'expired'}:
+        return 'bounced'
+    if 'deferred' in statuses:
+        return 'deferred'
+    if 'sent' in statuses:
+        return 'delivered'
+    return 'unknown'
@@ -0,0 +1,197 @@
+"""
+Полнотекстовый поиск писем по теме и участникам
+
+Для каждого письма хранится MailSearchDocument: тема и участники в нижнем
+регистре и токены участников "u<id>". В SQLite по документам построен индекс
+FTS5 mail_search (миграция 0023), его синхронизируют триггеры таблицы
+документов. Поиск пользователя - одно обращение к индексу:
+
+    users : "u<id>" AND {subject participants} : ("догов"* AND "иван"*)
+
+Пересечение с токеном пользователя выполняется внутри FTS5 по спискам
+вхождений, поэтому чужие письма не читаются вовсе. Результаты упорядочены
+по bm25 (совпадение в теме весит больше, чем в участниках), затем по
+убыванию номера документа - более новые письма выше.
+
+Документы пишутся при создании и изменении писем внутри mailbox.track()
+(index_messages), удаляются каскадом вместе с письмами. Если FTS5 нет
+(другая СУБД или SQLite без модуля), поиск выполняется фильтром contains
+по тем же документам: совпадения в теме выше, затем более новые письма.
+
+Черновик индексируется только под токеном отправителя: адресат не должен
+находить письмо, которое ему еще не отправлено. После отправки черновик
+переиндексируется (action='updated') уже под обоими токенами.
+
+Тела писем зашифрованы и в индекс не попадают.
+"""
+import re
+import uuid
+
+from django.db import connection, models
+
+from mail.models import MailMessage, MailSearchDocument
+
+TABLE = 'mail_search'
+# Веса столбцов в bm25: subject, participants, users
+WEIGHTS = (10.0, 2.0, 0.0)
+# Больше слов в запросе не учитывается
+MAX_TERMS = 10
+
+term_pattern = re.compile(r'\w+')
+
+available = {}
+
+
+def fts_available():
+    """
+    Есть ли в базе индекс FTS5 (проверяется один раз на процесс)
+    """
+    alias = connection.alias
+    if alias not in available:
+        available[alias] = connection.vendor == 'sqlite' and TABLE in connection.introspection.table_names()
+    return available[alias]
+
+
+def normalize(text):
+    """
+    Текст для индекса и запроса: нижний регистр, ё как е (FTS5 их не сводит)
+    """
+    return (text or '').lower().replace('ё', 'е')
+
+
+def get_terms(text):
+    return term_pattern.findall(normalize(text))[:MAX_TERMS]
+
+
+def user_token(user_id):
+    return f'u{user_id.hex}'
+
+
+def participant_text(email, first_name, last_name, middle_name):
+    return ' '.join(part for part in (email, first_name, last_name, middle_name) if part)
+
+
+# Поля письма и участников, из которых строится документ
+DOCUMENT_FIELDS = (
+    'id', 'subject', 'is_draft', 'from_user_id', 'to_user_id',
+    'from_user__email', 'from_user__first_name', 'from_user__last_name', 'from_user__middle_name',
+    'to_user__email', 'to_user__first_name', 'to_user__last_name', 'to_user__middle_name',
+)
+
+
+def build_documents(messages):
+    """
+    Документы для писем из values() с полями DOCUMENT_FIELDS
+    """
+    documents = []
+    for message in messages:
+        participants = {
+            participant_text(
+                message[f'{side}__email'], message[f'{side}__first_name'],
+                message[f'{side}__last_name'], message[f'{side}__middle_name']
+            )
+            for side in ('from_user', 'to_user')
+        }
+        users = {user_token(message['from_user_id'])}
+        if not message['is_draft']:
+            users.add(user_token(message['to_user_id']))
+        documents.append(MailSearchDocument(
+            message_id=message['id'],
+            subject=normalize(message['subject']),
+            participants=normalize(' '.join(sorted(participants))),
+            users=' '.join(sorted(users)),
+        ))
+    return documents
+
+
+def index_messages(message_ids, batch_size=1000):
+    """
+    Создает или обновляет документы писем: один SELECT с участниками и один INSERT ... ON CONFLICT на пачку
+    """
+    message_ids = list(message_ids)
+    for start in range(0, len(message_ids), batch_size):
+        chunk = message_ids[start:start + batch_size]
+        messages = MailMessage.objects.filter(pk__in=chunk).order_by().values(*DOCUMENT_FIELDS)
+        MailSearchDocument.objects.bulk_create(
+            build_documents(messages),
+            update_conflicts=True,
+            unique_fields=['message'],
+            update_fields=['subject', 'participants', 'users'],
+        )
+
+
+def rebuild(batch_size=1000):
+    """
+    Переиндексирует все письма и перестраивает FTS5 из документов; вернет число писем
+    """
+    ids = list(MailMessage.objects.order_by().values_list('pk', flat=True))
+    index_messages(ids, batch_size=batch_size)
+    if fts_available():
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {TABLE}({TABLE}) VALUES ('rebuild')")
+    return len(ids)
+
+
+def fts_query(user, terms):
+    text = ' AND '.join(f'"{term}"*' for term in terms)
+    return f'users : "{user_token(user.id)}" AND {{subject participants}} : ({text})'
+
+
+def fts_hits(user, terms, position, limit):
+    """
+    (message_id, score, key) из индекса FTS5; key - rowid документа
+    """
+    weights = ', '.join(str(weight) for weight in WEIGHTS)
+    params = [fts_query(user, terms)]
+    after = ''
+    if position is not None:
+        after = 'WHERE hits.score > %s OR (hits.score = %s AND hits.rowid < %s)'
+        params += [position[0], position[0], position[1]]
+    sql = (
+        f'SELECT document.message_id, hits.score, hits.rowid FROM ('
+        f'SELECT rowid, bm25({TABLE}, {weights}) AS score FROM {TABLE} WHERE {TABLE} MATCH %s'
+        f') AS hits JOIN {MailSearchDocument._meta.db_table} AS document ON document.id = hits.rowid '
+        f'{after} ORDER BY hits.score, hits.rowid DESC LIMIT %s'
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params + [limit])
+        # В SQLite UUID хранится строкой из 32 шестнадцатеричных цифр
+        return [(uuid.UUID(message_id), score, key) for message_id, score, key in cursor.fetchall()]
+
+
+def fallback_hits(user, terms, position, limit):
+    """
+    (message_id, score, key) фильтром contains; score 0 - все слова есть в теме, иначе 1
+    """
+    documents = MailSearchDocument.objects.filter(
+        models.Q(message__from_user=user) | models.Q(message__to_user=user, message__is_draft=False)
+    )
+    in_subject = models.Q()
+    for term in terms:
+        documents = documents.filter(models.Q(subject__contains=term) | models.Q(participants__contains=term))
+        in_subject &= models.Q(subject__contains=term)
+    documents = documents.annotate(
+        score=models.Case(models.When(in_subject, then=0), default=1, output_field=models.IntegerField())
+    )
+    if position is not None:
+        documents = documents.filter(
+            models.Q(score__gt=position[0]) | models.Q(score=position[0], id__lt=position[1])
+        )
+    hits = documents.order_by('score', '-id').values_list('message_id', 'score', 'id')[:limit]
+    return list(hits)
+
+
+def search(user, text, position=None, limit=20):
+    """
+    Найденные письма пользователя: список (message_id, score, key) по убыванию релевантности
+
+    position - (score, key) последнего результата предыдущей страницы. Оценки
+    bm25 зависят от состава индекса, поэтому новые письма между запросами
+    страниц могут сдвинуть порядок - это обычная цена курсора по релевантности
+    """
+    terms = get_terms(text)
+    if not terms:
+        return []
+    if fts_available():
+        return fts_hits(user, terms, position, limit)
+    return fallback_hits(user, terms, position, limit)
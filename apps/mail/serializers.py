@@ -1,6 +1,10 @@
 from rest_framework import serializers
-from mail.models import MailMessage, MailAttachment, PGPKey
+from django.conf import settings
+from mail import armor, blobs, bulk, export, search
+from mail.models import MailMessage, MailMessageQuerySet, MailThread, MailAttachment, AttachmentUpload, MailboxCounters, PGPKey, PGPKeyJob
 from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.urls import reverse
 import uuid
 
 User = get_user_model()
@@ -29,10 +33,12 @@ class MailAttachmentSerializer(serializers.ModelSerializer):
     def get_file_url(self, obj):
         """
         Получаем URL для доступа к файлу
+
+        Файл отдается через эндпоинт скачивания с проверкой доступа, а не по MEDIA_URL
         """
         request = self.context.get('request')
         if request and obj.file:
-            return request.build_absolute_uri(obj.file.url)
+            return request.build_absolute_uri(reverse('mail-attachment-download', kwargs={'pk': obj.pk}))
         return None
 
 
@@ -44,15 +50,16 @@ class MailMessageSerializer(serializers.ModelSerializer):
     to_user = UserEmailSerializer(read_only=True)
     to_user_id = serializers.CharField(write_only=True)
     attachments = MailAttachmentSerializer(many=True, read_only=True)
+    in_reply_to = serializers.PrimaryKeyRelatedField(queryset=MailMessage.objects.all(), required=False, allow_null=True)
     
     class Meta:
         model = MailMessage
         fields = [
             'id', 'from_user', 'to_user', 'to_user_id', 'subject', 
             'content_encrypted', 'attachments', 'attachments_meta', 'is_encrypted',
-            'is_draft', 'created_at'
+            'is_draft', 'is_read', 'read_at', 'thread', 'in_reply_to', 'created_at'
         ]
-        read_only_fields = ['id', 'from_user', 'created_at']
+        read_only_fields = ['id', 'from_user', 'is_read', 'read_at', 'thread', 'created_at']
     
     def validate_to_user_id(self, value):
         """
@@ -66,34 +73,40 @@ class MailMessageSerializer(serializers.ModelSerializer):
             return str(uuid.UUID(value))
         except ValueError:
             raise serializers.ValidationError("Must be a valid UUID.")
+
+    def validate_in_reply_to(self, value):
+        """
+        Ответить можно только на письмо, которое пользователь видит
+        """
+        user = self.context['request'].user
+        if value is not None and user.id not in (value.from_user_id, value.to_user_id):
+            raise serializers.ValidationError("Сообщение не найдено")
+        return value
+
+    def validate(self, attrs):
+        """
+        Зашифрованное тело в armor хранится двоично (content_binary), см. mail.armor
+
+        Переписка письма назначается при создании, поэтому in_reply_to
+        при изменении письма не учитывается
+        """
+        if self.instance is not None:
+            attrs.pop('in_reply_to', None)
+        if 'content_encrypted' in attrs:
+            is_encrypted = attrs.get('is_encrypted', self.instance.is_encrypted if self.instance else True)
+            if is_encrypted:
+                attrs['content_encrypted'], attrs['content_binary'] = armor.pack(attrs['content_encrypted'])
+            else:
+                attrs['content_binary'] = None
+        return attrs
     
     def to_representation(self, instance):
         """
         Переопределяем метод для добавления дополнительных данных при сериализации
         """
         data = super().to_representation(instance)
-        
-        # Проверяем, есть ли вложения через связь ManyToMany
-        if not data['attachments'] and instance.attachments_meta:
-            # Если в модели нет связанных вложений, но есть метаданные, 
-            # попробуем восстановить связи
-            for attachment_data in instance.attachments_meta:
-                attachment_id = attachment_data.get('id')
-                if attachment_id:
-                    try:
-                        attachment = MailAttachment.objects.get(id=attachment_id)
-                        instance.attachments.add(attachment)
-                    except MailAttachment.DoesNotExist:
-                        pass
-            
-            # Обновляем данные вложений после восстановления связей
-            if instance.attachments.exists():
-                serializer = MailAttachmentSerializer(
-                    instance.attachments.all(), many=True, 
-                    context=self.context
-                )
-                data['attachments'] = serializer.data
-        
+        # armor восстанавливается только здесь - при выдаче письма клиенту
+        data['content_encrypted'] = instance.armored_content()
         return data
 
     def create(self, validated_data):
@@ -129,41 +142,182 @@ class MailMessageListSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = MailMessage
-        fields = ['id', 'from_user', 'to_user', 'subject', 'is_encrypted', 'is_draft', 'created_at', 'has_attachments']
+        fields = ['id', 'from_user', 'to_user', 'subject', 'is_encrypted', 'is_draft', 'is_read', 'thread', 'created_at', 'has_attachments']
     
     def get_has_attachments(self, obj):
         """
         Проверяем, есть ли у сообщения вложения
+
+        Списки папок отдают queryset через MailMessageQuerySet.for_listing(),
+        поэтому признак связанных вложений уже посчитан в основном запросе.
+        Сериализатор ничего не пишет в базу во время чтения. Признак берется
+        только из связей: attachments_meta может ссылаться на удаленные вложения.
         """
-        # Проверяем наличие вложений через связь ManyToMany
-        has_attachments = obj.attachments.exists()
-        
-        # Также проверяем attachments_meta (JSON поле)
-        has_attachments_meta = bool(obj.attachments_meta and len(obj.attachments_meta) > 0)
-        
-        # Добавляем отладочную информацию
-        print(f"Сообщение {obj.id}: has_attachments={has_attachments}, has_attachments_meta={has_attachments_meta}, количество вложений={obj.attachments.count()}")
-        
-        if not has_attachments and has_attachments_meta:
-            # Автоматически восстанавливаем связи для вложений, если они есть в meta
-            for attachment_data in obj.attachments_meta:
-                attachment_id = attachment_data.get('id')
-                if attachment_id:
-                    try:
-                        attachment = MailAttachment.objects.get(id=attachment_id)
-                        obj.attachments.add(attachment)
-                        has_attachments = True
-                        print(f"Восстановлена связь с вложением: {attachment_id}")
-                    except MailAttachment.DoesNotExist:
-                        print(f"Вложение не найдено: {attachment_id}")
-                    except Exception as e:
-                        print(f"Ошибка при обработке вложения: {e}")
-            
-            # Сохраняем сообщение после связывания вложений
-            obj.save()
-        
-        # Если есть любые вложения, возвращаем True
-        return has_attachments or has_attachments_meta
+        has_attachments = getattr(obj, 'has_linked_attachments', None)
+        if has_attachments is None:
+            has_attachments = obj.attachments.exists()
+        return has_attachments
+
+
+class MailSyncMessageSerializer(MailMessageListSerializer):
+    """
+    Измененное сообщение в ответе дельта-синхронизации
+
+    folders, change и seq проставляются view перед сериализацией:
+    папки пользователя, в которых сейчас лежит письмо, последнее действие
+    и номер изменения в журнале
+    """
+    folders = serializers.ListField(child=serializers.CharField(), read_only=True)
+    change = serializers.CharField(read_only=True)
+    seq = serializers.IntegerField(read_only=True)
+
+    class Meta(MailMessageListSerializer.Meta):
+        fields = MailMessageListSerializer.Meta.fields + ['folders', 'change', 'seq']
+
+
+class MailThreadSerializer(serializers.ModelSerializer):
+    """
+    Переписка в списке: агрегаты берутся из строки MailThread
+
+    Участники ожидаются подгруженными через prefetch participants__user
+    """
+    participants = serializers.SerializerMethodField()
+
+    class Meta:
+        model = MailThread
+        fields = ['id', 'subject', 'message_count', 'has_attachments', 'last_activity_at', 'participants', 'created_at']
+
+    def get_participants(self, obj):
+        users = sorted((participant.user for participant in obj.participants.all()), key=lambda user: user.email)
+        return UserEmailSerializer(users, many=True).data
+
+
+class MailThreadDetailSerializer(MailThreadSerializer):
+    """
+    Переписка целиком; письма (conversation_messages) view подгружает заранее
+    """
+    messages = MailMessageListSerializer(source='conversation_messages', many=True, read_only=True)
+
+    class Meta(MailThreadSerializer.Meta):
+        fields = MailThreadSerializer.Meta.fields + ['messages']
+
+
+class MailDecryptBatchSerializer(serializers.Serializer):
+    """
+    Запрос на расшифровку пачки писем ключом PGP сессии
+    """
+    # Ограничение размера пачки: одна страница папки
+    max_ids = 50
+
+    ids = serializers.ListField(child=serializers.UUIDField(), allow_empty=False, max_length=max_ids)
+    passphrase = serializers.CharField(write_only=True, required=False)
+
+    def validate_ids(self, value):
+        # Повторы расшифровываются один раз, порядок сохраняется
+        return list(dict.fromkeys(value))
+
+
+class MailFanOutSerializer(serializers.Serializer):
+    """
+    Письмо нескольким получателям: отдельная копия каждому, зашифрованная его ключом
+    """
+    # Ограничение числа получателей одного письма
+    max_recipients = 100
+
+    recipient_ids = serializers.ListField(
+        child=serializers.UUIDField(), allow_empty=False, max_length=max_recipients
+    )
+    subject = serializers.CharField(max_length=255)
+    content = serializers.CharField()
+    is_encrypted = serializers.BooleanField(default=True)
+    attachment_ids = serializers.ListField(child=serializers.UUIDField(), required=False, default=list)
+
+    def validate_recipient_ids(self, value):
+        return list(dict.fromkeys(value))
+
+    def validate_attachment_ids(self, value):
+        """
+        Вложения загружены отправителем или доступны ему из его писем; читаются одним запросом
+        """
+        value = list(dict.fromkeys(value))
+        if not value:
+            return []
+        user = self.context['request'].user
+        attachments = {
+            attachment.id: attachment
+            for attachment in MailAttachment.objects.accessible_to(user).filter(id__in=value)
+        }
+        missing = [str(attachment_id) for attachment_id in value if attachment_id not in attachments]
+        if missing:
+            raise serializers.ValidationError(f"Вложения не найдены: {', '.join(missing)}")
+        return [attachments[attachment_id] for attachment_id in value]
+
+
+class MailBulkSerializer(serializers.Serializer):
+    """
+    Массовое действие над письмами: по списку ids или над всей папкой folder
+    """
+    # Ограничение списка id в одном запросе; папка целиком - без ограничения
+    max_ids = 1000
+
+    action = serializers.ChoiceField(choices=bulk.ACTIONS)
+    ids = serializers.ListField(child=serializers.UUIDField(), allow_empty=False, max_length=max_ids, required=False)
+    folder = serializers.ChoiceField(choices=MailMessageQuerySet.FOLDERS, required=False)
+
+    def validate_ids(self, value):
+        return list(dict.fromkeys(value))
+
+    def validate(self, attrs):
+        if ('ids' in attrs) == ('folder' in attrs):
+            raise serializers.ValidationError("Укажите либо ids, либо folder")
+        return attrs
+
+
+class MailSearchSerializer(serializers.Serializer):
+    """
+    Поисковый запрос по теме и участникам писем
+    """
+    q = serializers.CharField(max_length=200)
+
+    def validate_q(self, value):
+        if not search.get_terms(value):
+            raise serializers.ValidationError("Запрос должен содержать хотя бы одно слово")
+        return value
+
+
+class MailExportSerializer(serializers.Serializer):
+    """
+    Параметры выгрузки писем: формат архива, папка и период по дате создания
+
+    Параметр называется archive, а не format: ?format= занят выбором рендерера DRF
+    """
+    archive = serializers.ChoiceField(choices=export.FORMATS, default='mbox')
+    folder = serializers.ChoiceField(choices=MailMessageQuerySet.FOLDERS, required=False)
+    since = serializers.DateTimeField(required=False)
+    until = serializers.DateTimeField(required=False)
+
+    def validate(self, attrs):
+        if 'since' in attrs and 'until' in attrs and attrs['since'] >= attrs['until']:
+            raise serializers.ValidationError("since должен быть раньше until")
+        return attrs
+
+
+class MailboxCountersSerializer(serializers.ModelSerializer):
+    """
+    Сериализатор счетчиков папок: {"inbox": {"total": 3, "unread": 1}, ...}
+    """
+    class Meta:
+        model = MailboxCounters
+        fields = MailboxCounters.COUNTER_FIELDS
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        return {
+            'inbox': {'total': data['inbox_total'], 'unread': data['inbox_unread']},
+            'sent': {'total': data['sent_total']},
+            'drafts': {'total': data['drafts_total']},
+            'trash': {'total': data['trash_total'], 'unread': data['trash_unread']},
+        }
 
 
 class MailAttachmentUploadSerializer(serializers.ModelSerializer):
@@ -179,18 +333,50 @@ class MailAttachmentUploadSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         file_obj = validated_data['file']
         
-        # Создаем новое вложение
-        attachment = MailAttachment(
-            file=file_obj,
-            filename=file_obj.name,
-            file_size=file_obj.size,
-            content_type=file_obj.content_type or 'application/octet-stream'
-        )
-        attachment.save()
+        request = self.context.get('request')
+        
+        with transaction.atomic():
+            # Содержимое сохраняется как блоб; повторная загрузка того же файла не занимает место
+            blob = blobs.store_uploaded_file(file_obj)
+            
+            # Создаем новое вложение
+            attachment = MailAttachment(
+                file=blob.file.name,
+                blob=blob,
+                filename=file_obj.name,
+                file_size=file_obj.size,
+                content_type=file_obj.content_type or 'application/octet-stream',
+                uploaded_by=request.user if request else None
+            )
+            attachment.save()
         
         return attachment
 
 
+class AttachmentUploadSerializer(serializers.ModelSerializer):
+    """
+    Сериализатор загрузки вложения по частям: offset - сколько байт уже принято
+    """
+    offset = serializers.IntegerField(source='received', read_only=True)
+    
+    class Meta:
+        model = AttachmentUpload
+        fields = ['id', 'filename', 'content_type', 'size', 'sha256', 'offset', 'status', 'created_at']
+        read_only_fields = ['id', 'offset', 'status', 'created_at']
+    
+    def validate_size(self, value):
+        max_size = settings.MAIL_ATTACHMENT_MAX_SIZE
+        if value <= 0 or value > max_size:
+            raise serializers.ValidationError(f"Размер файла должен быть от 1 до {max_size} байт")
+        return value
+    
+    def validate_sha256(self, value):
+        value = value.lower()
+        if value and (len(value) != 64 or any(char not in '0123456789abcdef' for char in value)):
+            raise serializers.ValidationError("Ожидается SHA-256 в шестнадцатеричном виде")
+        return value
+
+
 class PGPKeySerializer(serializers.ModelSerializer):
     """
     Сериализатор модели PGPKey для чтения и создания PGP ключей
@@ -242,6 +428,33 @@ class PGPKeyCreateSerializer(serializers.ModelSerializer):
         return pgp_key
 
 
+class PGPKeyGenerateSerializer(serializers.Serializer):
+    """
+    Сериализатор запроса на создание пары PGP ключей на сервере
+    """
+    passphrase = serializers.CharField(write_only=True, min_length=8)
+
+    def validate(self, data):
+        """
+        Новые ключи создаются только пользователю без ключей: иначе старая почта станет нечитаемой
+        """
+        if PGPKey.objects.filter(user=self.context['request'].user).exists():
+            raise serializers.ValidationError({
+                'passphrase': 'У вас уже есть PGP ключи.'
+            })
+        return data
+
+
+class PGPKeyJobSerializer(serializers.ModelSerializer):
+    """
+    Статус задания на создание PGP ключей
+    """
+    class Meta:
+        model = PGPKeyJob
+        fields = ['id', 'status', 'from_pool', 'error', 'created_at', 'updated_at']
+        read_only_fields = fields
+
+
 class PGPSessionCreateSerializer(serializers.Serializer):
     """
     Сериализатор для создания сессии для PGP ключа
@@ -0,0 +1,149 @@
+"""
+Локальный SMTP-сервер в потоке процесса для тестов и замеров без Postfix
+
+Принимает письма на 127.0.0.1 и складывает их в память. Отвечает как Postfix
+("250 2.0.0 Ok: queued as <ID>"), поэтому воркер очереди сохраняет ID так же,
+как при настоящей отправке. Адресам из refuse() RCPT отвечает заданным
+кодом - так проверяются временные и постоянные ошибки.
+
+    with SMTPSink() as sink:
+        ... отправка на sink.host:sink.port ...
+        sink.messages  # [SinkMessage(...), ...]
+"""
+import socketserver
+import threading
+import uuid
+from dataclasses import dataclass
+
+
+@dataclass
+class SinkMessage:
+    mail_from: str
+    rcpt_tos: list
+    data: bytes
+    size: int
+    queue_id: str
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Одно SMTP-соединение: EHLO/HELO, MAIL, RCPT, DATA, RSET, NOOP, QUIT
+    """
+
+    def reply(self, line):
+        self.wfile.write(f'{line}\r\n'.encode('utf-8'))
+
+    def handle(self):
+        sink = self.server.sink
+        with sink.lock:
+            sink.connections += 1
+        self.reply('220 localhost ESMTP sink')
+        mail_from, rcpt_tos = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command, _, argument = line.decode('utf-8', 'replace').rstrip('\r\n').partition(' ')
+            command = command.upper()
+            if command == 'EHLO':
+                self.reply('250-localhost')
+                self.reply('250-PIPELINING')
+                self.reply('250-8BITMIME')
+                self.reply('250 SMTPUTF8')
+            elif command == 'HELO':
+                self.reply('250 localhost')
+            elif command == 'MAIL':
+                mail_from, rcpt_tos = argument.partition(':')[2].strip().split(' ')[0].strip('<>'), []
+                self.reply('250 2.1.0 Ok')
+            elif command == 'RCPT':
+                address = argument.partition(':')[2].strip().strip('<>')
+                refused = sink.refused.get(address)
+                if refused:
+                    self.reply(refused)
+                else:
+                    rcpt_tos.append(address)
+                    self.reply('250 2.1.5 Ok')
+            elif command == 'DATA':
+                if not rcpt_tos:
+                    self.reply('554 5.5.1 No valid recipients')
+                    continue
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data, size = self.read_data(sink.keep_data)
+                queue_id = uuid.uuid4().hex[:12].upper()
+                with sink.lock:
+                    sink.messages.append(SinkMessage(mail_from, rcpt_tos, data, size, queue_id))
+                mail_from, rcpt_tos = None, []
+                self.reply(f'250 2.0.0 Ok: queued as {queue_id}')
+            elif command == 'RSET':
+                mail_from, rcpt_tos = None, []
+                self.reply('250 2.0.0 Ok')
+            elif command == 'NOOP':
+                self.reply('250 2.0.0 Ok')
+            elif command == 'QUIT':
+                self.reply('221 2.0.0 Bye')
+                return
+            else:
+                self.reply('502 5.5.2 Error: command not recognized')
+
+    def read_data(self, keep_data):
+        """
+        Текст письма до строки из точки и его размер; без keep_data - только размер
+        """
+        lines, size = [], 0
+        while True:
+            line = self.rfile.readline()
+            if not line or line == b'.\r\n':
+                break
+            # Снимаем удвоение точки в начале строки (RFC 5321, 4.5.2)
+            if line.startswith(b'..'):
+                line = line[1:]
+            size += len(line)
+            if keep_data:
+                lines.append(line)
+        return b''.join(lines), size
+
+
+class SMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SMTPSink:
+    """
+    SMTP-сервер на свободном порту 127.0.0.1; письма - в self.messages
+
+    keep_data=False хранит только размер письма - для замеров больших писем
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, keep_data=True):
+        self.keep_data = keep_data
+        self.messages = []
+        self.refused = {}
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.server = SMTPServer((host, port), SMTPHandler)
+        self.server.sink = self
+        self.host, self.port = self.server.server_address[:2]
+        self.thread = None
+
+    def refuse(self, address, reply='550 5.1.1 User unknown'):
+        """
+        RCPT для address получает reply: 4xx - временная ошибка, 5xx - постоянная
+        """
+        self.refused[address] = reply
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='smtp-sink', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,1977 @@
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import tempfile
+import shutil
+import threading
+import tracemalloc
+import uuid
+import zipfile
+from datetime import timedelta
+from email import message_from_bytes, policy
+from io import BytesIO, StringIO
+from mailbox import mbox
+from unittest import mock
+
+import gnupg
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import SimpleTestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APITestCase, APIClient
+from rest_framework import status
+from rest_framework.views import exception_handler
+from rest_framework_simplejwt.tokens import AccessToken
+from mail import armor, export, keygen, keysessions, links, mailbox, mime, outbox, postfixlog, search, threads, uploads, utils
+from mail.crypto import CryptoBusy, CryptoTimeout, GPGPool
+from mail.events import EventBroker, SQLiteBackend
+from mail.keyring import PublicKeyCache, key_digest
+from mail.smtpsink import SMTPSink
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from mail.models import MailMessage, MailAttachment, AttachmentBlob, AttachmentUpload, MailboxCounters, MailChange, MailSearchDocument, MailThread, MailThreadParticipant, OutboundEmail, PostfixDelivery, PostfixLogCursor, PGPKey, PGPKeyJob, PregeneratedKey
+
+User = get_user_model()
+
+MAIL_API_URL = '/api/v1/mail/'
+
+
+def forge_cursor(payload):
+    """Курсор с произвольным содержимым, как у подделанного клиентом"""
+    return base64.urlsafe_b64encode(json.dumps(payload).encode('utf-8')).decode('ascii')
+
+
+# Бюджет SQL-запросов на одну страницу списка: COUNT(*) пагинатора + выборка страницы.
+# Число запросов не должно зависеть от количества строк на странице.
+MAIL_LIST_QUERY_BUDGET = {
+    '': 2,
+    'inbox/': 2,
+    'sent/': 2,
+    'drafts/': 2,
+    'trash/': 2,
+}
+
+
+class MailTestMixin:
+    """Общие данные для тестов почты"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            email='lawyer@example.com',
+            password='lawyerpass123',
+            first_name='Иван',
+            last_name='Иванов'
+        )
+        self.other = User.objects.create_user(
+            email='colleague@example.com',
+            password='colleaguepass123',
+            first_name='Петр',
+            last_name='Петров'
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def create_message(self, from_user=None, to_user=None, **kwargs):
+        kwargs.setdefault('subject', 'Тестовое письмо')
+        kwargs.setdefault('content_encrypted', 'зашифрованный текст')
+        return MailMessage.objects.create(
+            from_user=from_user or self.other,
+            to_user=to_user or self.user,
+            **kwargs
+        )
+
+    def create_attachment(self, filename='document.pdf'):
+        return MailAttachment.objects.create(
+            file=f'mail_attachments/{filename}',
+            filename=filename,
+            file_size=1024,
+            content_type='application/pdf'
+        )
+
+
+class MailFolderQueryBudgetTest(MailTestMixin, APITestCase):
+    """Тесты фиксированного числа запросов при чтении папок"""
+
+    def fill_mailbox(self, count):
+        attachment = self.create_attachment()
+        for index in range(count):
+            incoming = self.create_message(subject=f'Входящее {index}')
+            outgoing = self.create_message(from_user=self.user, to_user=self.other, subject=f'Исходящее {index}')
+            self.create_message(from_user=self.user, to_user=self.other, is_draft=True)
+            self.create_message(is_deleted_by_recipient=True)
+            self.create_message(from_user=self.user, to_user=self.other, is_deleted_by_sender=True)
+            if index % 2:
+                incoming.attachments.add(attachment)
+                outgoing.attachments_meta = [{'id': str(attachment.id)}]
+                outgoing.save()
+
+    def test_folder_pages_fit_query_budget(self):
+        """Тест: страница каждой папки читается фиксированным числом запросов"""
+        for count in (1, 10):
+            self.fill_mailbox(count)
+            for folder, budget in MAIL_LIST_QUERY_BUDGET.items():
+                with self.subTest(folder=folder, count=count):
+                    with self.assertNumQueries(budget):
+                        response = self.client.get(MAIL_API_URL + folder)
+                    self.assertEqual(response.status_code, status.HTTP_200_OK)
+                    self.assertTrue(response.data['results'])
+
+    def test_has_attachments_without_writes(self):
+        """Тест: признак вложений считается по связям без записи в базу"""
+        attachment = self.create_attachment()
+        linked = self.create_message(subject='Со связью')
+        linked.attachments.add(attachment)
+        meta_only = self.create_message(subject='Только метаданные', attachments_meta=[{'id': str(attachment.id)}])
+        self.create_message(subject='Без вложений')
+
+        response = self.client.get(MAIL_API_URL + 'inbox/')
+        flags = {item['subject']: item['has_attachments'] for item in response.data['results']}
+        # Метаданные без связи признак не дают: связи переносит mail_attachment_backfill
+        self.assertEqual(flags, {'Со связью': True, 'Только метаданные': False, 'Без вложений': False})
+        self.assertFalse(meta_only.attachments.exists())
+
+    def test_list_includes_participants(self):
+        """Тест: участники переписки приходят вместе со списком"""
+        self.create_message(subject='Вопрос')
+        response = self.client.get(MAIL_API_URL + 'inbox/')
+        item = response.data['results'][0]
+        self.assertEqual(item['from_user']['email'], 'colleague@example.com')
+        self.assertEqual(item['to_user']['email'], 'lawyer@example.com')
+
+
+class MailAttachmentLinksTest(MailTestMixin, APITestCase):
+    """Тесты связей писем с вложениями из attachments_meta"""
+
+    def uploaded(self, filename, user=None):
+        attachment = self.create_attachment(filename)
+        MailAttachment.objects.filter(pk=attachment.pk).update(uploaded_by=user or self.user)
+        return attachment
+
+    def test_create_links_accessible_attachments(self):
+        """Тест: при создании письма связываются только доступные отправителю вложения"""
+        own = [self.uploaded('акт.pdf'), self.uploaded('счет.pdf')]
+        foreign = self.uploaded('чужое.pdf', user=self.other)
+        meta = [{'id': str(attachment.id)} for attachment in own + [foreign]]
+        meta += [{'id': 'не-uuid'}, {'name': 'без id'}, {'id': str(uuid.uuid4())}]
+        response = self.client.post(MAIL_API_URL, {
+            'to_user_id': str(self.other.id), 'subject': 'Документы', 'content_encrypted': 'текст',
+            'attachments_meta': meta,
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            {item['id'] for item in response.data['attachments']}, {str(attachment.id) for attachment in own}
+        )
+
+        # Новое вложение черновика связывается при изменении
+        draft = self.client.post(MAIL_API_URL, {
+            'to_user_id': str(self.other.id), 'subject': 'Черновик', 'content_encrypted': 'текст', 'is_draft': True,
+        }, format='json').data
+        response = self.client.patch(
+            MAIL_API_URL + f"{draft['id']}/", {'attachments_meta': meta[:1]}, format='json'
+        )
+        self.assertEqual([item['id'] for item in response.data['attachments']], [str(own[0].id)])
+
+    def test_link_counts_only_inserted_rows(self):
+        """Тест: уже существующая связь не считается новой"""
+        first, second = self.create_attachment('акт.pdf'), self.create_attachment('счет.pdf')
+        message = self.create_message(attachments_meta=[{'id': str(first.id)}, {'id': str(second.id)}])
+        message.attachments.add(first)
+
+        self.assertEqual(links.link([message]), 1)
+        self.assertEqual(links.link([message]), 0)
+        self.assertEqual(message.attachments.count(), 2)
+
+    def test_stale_meta_has_no_attachments(self):
+        """Тест: метаданные без связанных вложений не дают признак вложений ни письму, ни переписке"""
+        response = self.client.post(MAIL_API_URL, {
+            'to_user_id': str(self.other.id), 'subject': 'Удаленное вложение', 'content_encrypted': 'текст',
+            'attachments_meta': [{'id': str(uuid.uuid4()), 'name': 'акт.pdf'}],
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        item, = self.client.get(MAIL_API_URL + 'sent/').data['results']
+        self.assertFalse(item['has_attachments'])
+        thread, = self.client.get(MAIL_API_URL + 'threads/').data['results']
+        self.assertFalse(thread['has_attachments'])
+
+    def test_reads_do_not_write_and_backfill_links(self):
+        """Тест: чтение письма со старыми метаданными ничего не пишет, связи переносит команда"""
+        attachment = self.create_attachment()
+        legacy = self.create_message(attachments_meta=[{'id': str(attachment.id)}, {'id': str(uuid.uuid4())}])
+        self.create_message(subject='Без вложений')
+
+        with self.assertNumQueries(2):
+            response = self.client.get(MAIL_API_URL + f'{legacy.id}/')
+        self.assertEqual(response.data['attachments'], [])
+        self.assertFalse(legacy.attachments.exists())
+
+        output = StringIO()
+        call_command('mail_attachment_backfill', '--batch-size', '1', stdout=output)
+        self.assertIn('Проверено писем: 1, создано связей: 1', output.getvalue())
+        call_command('mail_attachment_backfill', stdout=output)
+        self.assertIn('создано связей: 0', output.getvalue())
+        response = self.client.get(MAIL_API_URL + f'{legacy.id}/')
+        self.assertEqual([item['id'] for item in response.data['attachments']], [str(attachment.id)])
+
+
+class MailCursorPaginationTest(MailTestMixin, APITestCase):
+    """Тесты keyset-пагинации папок"""
+
+    def collect_pages(self, url):
+        subjects = []
+        while url:
+            with self.assertNumQueries(1):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotIn('count', response.data)
+            subjects.extend(item['subject'] for item in response.data['results'])
+            url = response.data['next']
+        return subjects
+
+    def test_cursor_walks_folder_without_gaps(self):
+        """Тест: курсор проходит всю папку без пропусков и повторов"""
+        messages = [self.create_message(subject=f'Письмо {index}') for index in range(25)]
+        # Одинаковое время создания у части писем разрешается по id
+        MailMessage.objects.filter(pk__in=[m.pk for m in messages[:6]]).update(created_at=messages[0].created_at)
+
+        subjects = self.collect_pages(MAIL_API_URL + 'inbox/?pagination=cursor&page_size=4')
+        expected = list(
+            MailMessage.objects.filter(to_user=self.user)
+            .order_by('-created_at', '-id').values_list('subject', flat=True)
+        )
+        self.assertEqual(subjects, expected)
+
+    def test_cursor_ascending_trash(self):
+        """Тест: курсор учитывает сортировку и работает в корзине"""
+        for index in range(5):
+            self.create_message(subject=f'Удалено {index}', is_deleted_by_recipient=True)
+            self.create_message(from_user=self.user, to_user=self.other, subject=f'Удалено мной {index}', is_deleted_by_sender=True)
+
+        subjects = self.collect_pages(MAIL_API_URL + 'trash/?pagination=cursor&page_size=3&ordering=created_at')
+        self.assertEqual(len(subjects), 10)
+        self.assertEqual(subjects[0], 'Удалено 0')
+
+    def test_invalid_cursor(self):
+        """Тест: поврежденный курсор дает 404, как в DRF"""
+        response = self.client.get(MAIL_API_URL + 'inbox/?cursor=broken')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        # Подделанные курсоры: id не UUID, время без часового пояса
+        for payload in (
+            {'c': timezone.now().isoformat(), 'i': 'zzz'},
+            {'c': '2026-01-01T10:00:00', 'i': str(uuid.uuid4())},
+        ):
+            response = self.client.get(MAIL_API_URL + f'inbox/?cursor={forge_cursor(payload)}')
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND, payload)
+
+    def test_folder_queries_use_indexes(self):
+        """Тест: запросы папок используют составные индексы"""
+        self.create_message()
+        plans = {
+            'mail_inbox_idx': MailMessage.objects.filter(to_user=self.user, is_draft=False, is_deleted_by_recipient=False),
+            'mail_sent_idx': MailMessage.objects.filter(from_user=self.user, is_draft=False, is_deleted_by_sender=False),
+            'mail_drafts_idx': MailMessage.objects.filter(from_user=self.user, is_draft=True, is_deleted_by_sender=False),
+        }
+        for index_name, queryset in plans.items():
+            with self.subTest(index=index_name):
+                plan = queryset.order_by('-created_at', '-id').explain()
+                self.assertIn(index_name, plan)
+                self.assertNotIn('TEMP B-TREE', plan)
+
+
+class MailFolderQuerySetTest(MailTestMixin, APITestCase):
+    """Тесты условий папок без union()"""
+
+    def test_trash_supports_search_and_count(self):
+        """Тест: поиск и подсчет работают в корзине"""
+        self.create_message(subject='Договор аренды', is_deleted_by_recipient=True)
+        self.create_message(from_user=self.user, to_user=self.other, subject='Договор поставки', is_deleted_by_sender=True)
+        self.create_message(subject='Договор в папке входящих')
+        self.create_message(from_user=self.user, to_user=self.other, subject='Иск', is_deleted_by_sender=True)
+
+        response = self.client.get(MAIL_API_URL + 'trash/?search=Договор')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(
+            {item['subject'] for item in response.data['results']},
+            {'Договор аренды', 'Договор поставки'}
+        )
+
+    def test_list_returns_each_message_once(self):
+        """Тест: письмо самому себе попадает в общий список один раз"""
+        self.create_message(from_user=self.user, to_user=self.user, subject='Заметка')
+        self.create_message(subject='Входящее')
+        self.create_message(from_user=self.other, to_user=self.other, subject='Чужое')
+
+        response = self.client.get(MAIL_API_URL + '?ordering=created_at')
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual([item['subject'] for item in response.data['results']], ['Заметка', 'Входящее'])
+
+    def test_retrieve_uses_participant_filter(self):
+        """Тест: отдельное письмо доступно только участникам"""
+        own = self.create_message()
+        foreign = self.create_message(from_user=self.other, to_user=self.other)
+
+        self.assertEqual(self.client.get(f'{MAIL_API_URL}{own.id}/').status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get(f'{MAIL_API_URL}{foreign.id}/').status_code, status.HTTP_404_NOT_FOUND)
+
+
+    def test_only_sender_edits_own_drafts(self):
+        """Тест: изменять можно только свои черновики; получатель и отправленные письма - 404"""
+        incoming = self.create_message(subject='Входящее')
+        sent = self.create_message(from_user=self.user, to_user=self.other, subject='Отправленное')
+        draft = self.create_message(from_user=self.user, to_user=self.other, subject='Черновик', is_draft=True)
+        changes = {'subject': 'Переписано', 'content_encrypted': 'другой текст'}
+
+        for message in (incoming, sent):
+            response = self.client.patch(f'{MAIL_API_URL}{message.id}/', changes, format='json')
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            message.refresh_from_db()
+            self.assertNotEqual(message.subject, 'Переписано')
+
+        response = self.client.patch(f'{MAIL_API_URL}{draft.id}/', changes, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['subject'], 'Переписано')
+
+
+class MailboxCountersTest(MailTestMixin, APITestCase):
+    """Тесты инкрементальных счетчиков папок"""
+
+    def expected_counters(self, user):
+        return {
+            'inbox': {
+                'total': MailMessage.objects.inbox(user).count(),
+                'unread': MailMessage.objects.inbox(user).filter(is_read=False).count(),
+            },
+            'sent': {'total': MailMessage.objects.sent(user).count()},
+            'drafts': {'total': MailMessage.objects.drafts(user).count()},
+            'trash': {
+                'total': MailMessage.objects.trash(user).count(),
+                'unread': MailMessage.objects.trash(user).filter(to_user=user, is_read=False).count(),
+            },
+        }
+
+    def get_counters(self, user):
+        self.client.force_authenticate(user=user)
+        with self.assertNumQueries(1):
+            response = self.client.get(MAIL_API_URL + 'counters/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def send(self, to_user, **extra):
+        data = {'to_user_id': str(to_user.id), 'subject': 'Письмо', 'content_encrypted': 'текст'}
+        data.update(extra)
+        response = self.client.post(MAIL_API_URL, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data['id']
+
+    def test_counters_follow_mailbox_actions(self):
+        """Тест: счетчики совпадают с содержимым папок после каждого действия"""
+        self.client.force_authenticate(user=self.other)
+        first = self.send(self.user)
+        second = self.send(self.user)
+        self.send(self.other, subject='Себе')
+        draft = self.send(self.user, is_draft=True)
+
+        self.client.force_authenticate(user=self.user)
+        steps = [
+            ('post', f'{first}/read/'),
+            ('delete', f'{second}/'),
+            ('post', f'{second}/restore/'),
+            ('delete', f'{first}/'),
+            ('post', f'{second}/unread/'),
+        ]
+        for method, path in steps:
+            self.client.force_authenticate(user=self.user)
+            response = getattr(self.client, method)(MAIL_API_URL + path)
+            self.assertLess(response.status_code, 300, path)
+            for user in (self.user, self.other):
+                with self.subTest(step=path, user=user.email):
+                    self.assertEqual(self.get_counters(user), self.expected_counters(user))
+
+        # Отправитель удаляет письмо, затем оба удаляют его навсегда
+        self.client.force_authenticate(user=self.other)
+        self.client.delete(f'{MAIL_API_URL}{first}/')
+        self.client.delete(f'{MAIL_API_URL}{draft}/')
+        response = self.client.post(f'{MAIL_API_URL}{first}/permanent_delete/')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        for user in (self.user, self.other):
+            self.assertEqual(self.get_counters(user), self.expected_counters(user))
+
+    def test_bulk_actions_keep_counters(self):
+        """Тест: массовые действия меняют только свою сторону писем и сохраняют счетчики"""
+        incoming = [self.create_message() for _ in range(3)]
+        outgoing = [self.create_message(from_user=self.user, to_user=self.other) for _ in range(2)]
+        to_self = self.create_message(from_user=self.user, to_user=self.user)
+        foreign = self.create_message(from_user=self.other, to_user=self.other)
+        call_command('mail_rebuild_counters', stdout=StringIO())
+        everything = [str(message.id) for message in incoming + outgoing + [to_self, foreign]]
+
+        steps = [
+            ({'action': 'read', 'ids': everything}, 4),
+            ({'action': 'unread', 'ids': [str(incoming[0].id)]}, 1),
+            ({'action': 'trash', 'ids': everything}, 6),
+            ({'action': 'trash', 'ids': everything}, 0),
+            ({'action': 'restore', 'folder': 'trash'}, 6),
+            ({'action': 'trash', 'folder': 'inbox'}, 4),
+        ]
+        for data, updated in steps:
+            self.client.force_authenticate(user=self.user)
+            response = self.client.post(MAIL_API_URL + 'bulk/', data, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK, data)
+            self.assertEqual(response.data['updated'], updated, data)
+            for user in (self.user, self.other):
+                with self.subTest(step=data, user=user.email):
+                    self.assertEqual(self.get_counters(user), self.expected_counters(user))
+        self.assertEqual(response.data['not_found'], [])
+
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post(MAIL_API_URL + 'bulk/', {'action': 'read', 'ids': everything}, format='json')
+        self.assertEqual(response.data['not_found'], [str(foreign.id)])
+        foreign.refresh_from_db()
+        self.assertFalse(foreign.is_read)
+        self.assertEqual(
+            MailChange.objects.filter(user=self.user, message_id=incoming[1].id).values_list('action', flat=True)[0], 'read'
+        )
+
+        # Полностью удаляются только письма, которые удалили обе стороны
+        self.client.force_authenticate(user=self.other)
+        self.client.post(MAIL_API_URL + 'bulk/', {'action': 'trash', 'ids': [str(incoming[0].id)]}, format='json')
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post(MAIL_API_URL + 'bulk/', {'action': 'purge', 'folder': 'trash'}, format='json')
+        self.assertEqual((response.data['matched'], response.data['updated']), (4, 1))
+        self.assertFalse(MailMessage.objects.filter(id=incoming[0].id).exists())
+        for user in (self.user, self.other):
+            self.assertEqual(self.get_counters(user), self.expected_counters(user))
+
+    def test_bulk_request_validation(self):
+        """Тест: нужен ровно один из ids и folder"""
+        for data in ({'action': 'trash'}, {'action': 'trash', 'ids': [str(uuid.uuid4())], 'folder': 'inbox'},
+                     {'action': 'archive', 'folder': 'inbox'}):
+            response = self.client.post(MAIL_API_URL + 'bulk/', data, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, data)
+
+    def test_bulk_query_budget(self):
+        """Тест: число запросов не зависит от числа писем, вложения удаленных писем удаляются"""
+        messages = [self.create_message(is_deleted_by_sender=True, is_deleted_by_recipient=True) for _ in range(60)]
+        attachment = self.create_attachment()
+        kept = self.create_attachment('kept.pdf')
+        messages[0].attachments.add(attachment, kept)
+        self.create_message(from_user=self.other, to_user=self.other).attachments.add(kept)
+        call_command('mail_rebuild_counters', stdout=StringIO())
+
+        for action, folder in (('restore', 'trash'), ('read', 'inbox'), ('trash', 'inbox')):
+            with self.assertNumQueries(6):
+                response = self.client.post(MAIL_API_URL + 'bulk/', {'action': action, 'folder': folder}, format='json')
+            self.assertEqual(response.data['updated'], 60)
+
+        MailMessage.objects.filter(pk__in=[message.pk for message in messages]).update(is_deleted_by_sender=True)
+        call_command('mail_rebuild_counters', stdout=StringIO())
+        response = self.client.post(MAIL_API_URL + 'bulk/', {'action': 'purge', 'folder': 'trash'}, format='json')
+        self.assertEqual(response.data['updated'], 60)
+        self.assertFalse(MailAttachment.objects.filter(pk=attachment.pk).exists())
+        self.assertTrue(MailAttachment.objects.filter(pk=kept.pk).exists())
+        self.assertEqual(self.get_counters(self.user), self.expected_counters(self.user))
+
+    def test_concurrent_changes_counted_once(self):
+        """Тест: два запроса с одним исходным состоянием письма не меняют счетчики дважды"""
+        self.client.force_authenticate(user=self.other)
+        message_id = self.send(self.user)
+        # Экземпляры, загруженные двумя запросами до изменения письма
+        first, second = MailMessage.objects.get(pk=message_id), MailMessage.objects.get(pk=message_id)
+        for message in (first, second):
+            with mailbox.track([message]):
+                message.is_read = True
+                message.save(update_fields=['is_read'])
+        first, second = MailMessage.objects.get(pk=message_id), MailMessage.objects.get(pk=message_id)
+        for message in (first, second):
+            with mailbox.track([message]):
+                message.is_deleted_by_recipient = True
+                message.save()
+        self.assertEqual(self.get_counters(self.user), self.expected_counters(self.user))
+        self.assertEqual(self.get_counters(self.user)['trash']['total'], 1)
+
+    def test_only_recipient_marks_read(self):
+        """Тест: отметка о прочтении доступна только получателю"""
+        message = self.create_message(from_user=self.user, to_user=self.other)
+        response = self.client.post(f'{MAIL_API_URL}{message.id}/read/')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_rebuild_command_matches_incremental(self):
+        """Тест: пересчет с нуля дает те же значения, что и инкрементальные обновления"""
+        self.client.force_authenticate(user=self.other)
+        message_id = self.send(self.user)
+        self.send(self.user, is_draft=True)
+        self.client.force_authenticate(user=self.user)
+        self.client.delete(f'{MAIL_API_URL}{message_id}/')
+        incremental = {user.email: self.get_counters(user) for user in (self.user, self.other)}
+
+        MailboxCounters.objects.all().delete()
+        call_command('mail_rebuild_counters', stdout=StringIO())
+        rebuilt = {user.email: self.get_counters(user) for user in (self.user, self.other)}
+        self.assertEqual(rebuilt, incremental)
+
+
+class MailSyncTest(MailTestMixin, APITestCase):
+    """Тесты дельта-синхронизации через журнал изменений"""
+
+    def send(self, to_user, **extra):
+        data = {'to_user_id': str(to_user.id), 'subject': 'Письмо', 'content_encrypted': 'текст'}
+        data.update(extra)
+        response = self.client.post(MAIL_API_URL, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data['id']
+
+    def sync(self, since=None, **params):
+        if since is not None:
+            params['since'] = since
+        response = self.client.get(MAIL_API_URL + 'sync/', params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_sync_returns_only_new_changes(self):
+        """Тест: изменения после курсора приходят с папками, удаленные - в removed"""
+        cursor = self.sync()['cursor']
+        self.assertEqual(cursor, 0)
+
+        self.client.force_authenticate(user=self.other)
+        first = self.send(self.user)
+        second = self.send(self.user)
+        self.send(self.user, is_draft=True)
+
+        self.client.force_authenticate(user=self.user)
+        data = self.sync(cursor)
+        # Черновик собеседника в папки получателя не попадает
+        self.assertEqual([item['id'] for item in data['changes']], [first, second])
+        self.assertEqual(data['changes'][0]['folders'], ['inbox'])
+        self.assertEqual(data['changes'][0]['change'], 'created')
+        self.assertEqual(data['removed'], [])
+        cursor = data['cursor']
+
+        self.assertEqual(self.sync(cursor)['changes'], [])
+
+        self.client.post(f'{MAIL_API_URL}{first}/read/')
+        self.client.delete(f'{MAIL_API_URL}{second}/')
+        data = self.sync(cursor)
+        changes = {item['id']: item for item in data['changes']}
+        self.assertEqual(changes[first]['change'], 'read')
+        self.assertTrue(changes[first]['is_read'])
+        self.assertEqual(changes[second]['change'], 'trashed')
+        self.assertEqual(changes[second]['folders'], ['trash'])
+        cursor = data['cursor']
+
+        # Собеседник тоже удаляет письмо, и оно удаляется навсегда
+        self.client.force_authenticate(user=self.other)
+        self.client.delete(f'{MAIL_API_URL}{second}/')
+        response = self.client.post(f'{MAIL_API_URL}{second}/permanent_delete/')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        self.client.force_authenticate(user=self.user)
+        data = self.sync(cursor)
+        self.assertEqual(data['changes'], [])
+        self.assertEqual([item['id'] for item in data['removed']], [str(second)])
+
+    def test_sync_collapses_changes_and_pages(self):
+        """Тест: несколько изменений письма схлопываются, limit ограничивает страницу журнала"""
+        messages = [self.create_message() for _ in range(3)]
+        cursor = self.sync()['cursor']
+        for message in messages:
+            self.client.post(f'{MAIL_API_URL}{message.id}/read/')
+            self.client.post(f'{MAIL_API_URL}{message.id}/unread/')
+
+        # Журнал изменений + выборка писем страницы
+        with self.assertNumQueries(2):
+            data = self.sync(cursor, limit=3)
+        self.assertTrue(data['has_more'])
+        self.assertEqual([item['id'] for item in data['changes']], [str(messages[0].id), str(messages[1].id)])
+        self.assertEqual(data['changes'][0]['change'], 'unread')
+        self.assertEqual(data['changes'][1]['change'], 'read')
+
+        # Второе изменение messages[1] попало на следующую страницу
+        data = self.sync(data['cursor'], limit=3)
+        self.assertFalse(data['has_more'])
+        self.assertEqual([item['id'] for item in data['changes']], [str(messages[1].id), str(messages[2].id)])
+        self.assertEqual([item['change'] for item in data['changes']], ['unread', 'unread'])
+
+    def test_sync_rejects_invalid_cursor(self):
+        """Тест: нечисловой курсор отклоняется"""
+        response = self.client.get(MAIL_API_URL + 'sync/', {'since': 'abc'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class MailEventsStreamTest(MailTestMixin, APITestCase):
+    """Тесты потока событий почты (SSE)"""
+
+    def trash(self, message):
+        # Публикация происходит после коммита, в тесте коммит эмулируется
+        with self.captureOnCommitCallbacks(execute=True):
+            with mailbox.track([message]):
+                message.is_deleted_by_recipient = True
+                message.save()
+
+    async def open_stream(self, **extra):
+        token = str(AccessToken.for_user(self.user))
+        response = await self.async_client.get(MAIL_API_URL + 'events/', {'token': token}, **extra)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = aiter(response.streaming_content)
+        # Первая порция отдается после подписки на события
+        self.assertEqual(await anext(stream), b'retry: 5000\n\n')
+        return stream
+
+    async def read_event(self, stream):
+        return (await asyncio.wait_for(anext(stream), timeout=5)).decode()
+
+    async def test_stream_requires_token(self):
+        """Тест: без токена поток недоступен"""
+        response = await self.async_client.get(MAIL_API_URL + 'events/')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        response = await self.async_client.get(MAIL_API_URL + 'events/', {'token': 'invalid'})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_stream_requires_asgi(self):
+        """Тест: под WSGI поток не открывается и не занимает поток сервера"""
+        token = str(AccessToken.for_user(self.user))
+        response = self.client.get(MAIL_API_URL + 'events/', {'token': token})
+        self.assertEqual(response.status_code, status.HTTP_501_NOT_IMPLEMENTED)
+        self.assertFalse(response.streaming)
+
+    async def test_stream_pushes_changes(self):
+        """Тест: изменение письма приходит подключенному получателю"""
+        message = await sync_to_async(self.create_message)()
+        stream = await self.open_stream()
+
+        await sync_to_async(self.trash)(message)
+        event = await self.read_event(stream)
+        self.assertIn('event: trashed', event)
+        self.assertIn(str(message.id), event)
+        await stream.aclose()
+
+    async def test_stream_replays_after_reconnect(self):
+        """Тест: при переподключении с Last-Event-ID пропущенные изменения досылаются"""
+        message = await sync_to_async(self.create_message)()
+        await sync_to_async(self.trash)(message)
+
+        stream = await self.open_stream(headers={'Last-Event-ID': '0'})
+        event = await self.read_event(stream)
+        self.assertIn('event: trashed', event)
+        self.assertRegex(event, r'^id: \d+\n')
+        await stream.aclose()
+
+
+class MailEventBrokerTest(SimpleTestCase):
+    """Тесты межпроцессной доставки событий через файл SQLite"""
+
+    async def test_sqlite_backend_delivers_between_brokers(self):
+        """Тест: событие, опубликованное одним брокером, получает подписчик другого"""
+        # Поток опроса может еще держать файл открытым при удалении каталога
+        with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as directory:
+            path = os.path.join(directory, 'events.sqlite3')
+            receiver = EventBroker(SQLiteBackend(path, poll_interval=0.01))
+            sender = EventBroker(SQLiteBackend(path))
+
+            subscription = await receiver.subscribe('user-1')
+            self.assertEqual(receiver.connection_count(), 1)
+            # Публикация из синхронного потока, как в обычном view
+            thread = threading.Thread(target=sender.publish, args=('user-1', {'seq': 1, 'action': 'created'}))
+            thread.start()
+            thread.join()
+            sender.publish('user-2', {'seq': 2, 'action': 'created'})
+
+            event = await subscription.get(timeout=5)
+            self.assertEqual(event, {'seq': 1, 'action': 'created'})
+            with self.assertRaises(asyncio.TimeoutError):
+                await subscription.get(timeout=0.1)
+
+            receiver.unsubscribe(subscription)
+            self.assertEqual(receiver.connection_count(), 0)
+            receiver.listener.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await receiver.listener
+
+
+class GPGPoolTest(SimpleTestCase):
+    """Тесты ограниченного пула операций GnuPG"""
+
+    def setUp(self):
+        self.pool = GPGPool(workers=1, queue_size=1, timeout=5, retry_after=7)
+        self.release = threading.Event()
+        self.addCleanup(self.pool.shutdown)
+        self.addCleanup(self.release.set)
+
+    def test_saturated_pool_rejects_with_retry_after(self):
+        """Тест: при заполненной очереди операция сразу получает 503 с Retry-After"""
+        running = self.pool.submit(self.release.wait)
+        queued = self.pool.submit(lambda: 'готово')
+        with self.assertRaises(CryptoBusy) as context:
+            self.pool.submit(lambda: None)
+
+        response = exception_handler(context.exception, {})
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '7')
+
+        self.release.set()
+        self.assertTrue(running.result(timeout=5))
+        self.assertEqual(queued.result(timeout=5), 'готово')
+        # Места в очереди освобождаются по завершении операций
+        self.assertEqual(self.pool.call(len, 'abc'), 3)
+
+    def test_timeout_cancels_queued_operation(self):
+        """Тест: по таймауту ожидание прерывается, а не начатая операция снимается с очереди"""
+        calls = []
+        self.pool.submit(self.release.wait)
+        with self.assertRaises(CryptoTimeout):
+            self.pool.call(calls.append, 1, timeout=0.05)
+        self.release.set()
+        self.assertEqual(self.pool.call(len, ''), 0)
+        self.assertEqual(calls, [])
+
+    def test_map_waits_for_own_slots(self):
+        """Тест: пачка больше очереди выполняется целиком, ошибки возвращаются по элементам"""
+        outcomes = self.pool.map(lambda value: 10 // value, [1, 2, 0, 5, 10])
+        self.assertEqual([result for result, _ in outcomes], [10, 5, None, 2, 1])
+        self.assertIsInstance(outcomes[2][1], ZeroDivisionError)
+
+    async def test_async_call_does_not_block_event_loop(self):
+        """Тест: acall ждет результат, не блокируя цикл событий"""
+        ticks = []
+
+        async def ticker():
+            while not self.release.is_set():
+                ticks.append(1)
+                await asyncio.sleep(0.01)
+
+        def slow():
+            self.release.wait(0.2)
+            return 'зашифровано'
+
+        ticker_task = asyncio.create_task(ticker())
+        result = await self.pool.acall(slow)
+        self.release.set()
+        await ticker_task
+        self.assertEqual(result, 'зашифровано')
+        self.assertGreater(len(ticks), 5)
+
+
+class AttachmentUploadMixin(MailTestMixin):
+    """Временный MEDIA_ROOT и помощники загрузки по частям"""
+
+    def setUp(self):
+        super().setUp()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.content = os.urandom(200 * 1024 + 17)
+
+    def start_upload(self, **extra):
+        data = {'filename': 'договор.pdf', 'size': len(self.content), 'content_type': 'application/pdf'}
+        data.update(extra)
+        response = self.client.post(MAIL_API_URL + 'attachments/uploads/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['offset'], 0)
+        return f"{MAIL_API_URL}attachments/uploads/{response.data['id']}/"
+
+    def put_chunk(self, url, offset, chunk):
+        return self.client.put(url, chunk, content_type='application/octet-stream', HTTP_UPLOAD_OFFSET=str(offset))
+
+
+class AttachmentUploadTest(AttachmentUploadMixin, APITestCase):
+    """Тесты загрузки вложений по частям"""
+
+    def test_chunked_upload_with_resume(self):
+        """Тест: части дописываются в файл, загрузку можно продолжить в другом процессе"""
+        digest = hashlib.sha256(self.content).hexdigest()
+        url = self.start_upload(sha256=digest)
+
+        response = self.put_chunk(url, 0, self.content[:100000])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Upload-Offset'], '100000')
+
+        # Обрыв: клиент узнает смещение, а хешер недоступен (другой процесс)
+        uploads.hashers.items.clear()
+        response = self.client.get(url)
+        self.assertEqual(response.data['offset'], 100000)
+
+        response = self.client.put(
+            url, self.content[100000:], content_type='application/octet-stream',
+            HTTP_CONTENT_RANGE=f'bytes 100000-{len(self.content) - 1}/{len(self.content)}'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.post(url + 'finalize/')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        attachment = MailAttachment.objects.get(id=response.data['id'])
+        self.assertEqual(attachment.uploaded_by, self.user)
+        self.assertEqual(attachment.file_size, len(self.content))
+        with attachment.file.open('rb') as file:
+            self.assertEqual(file.read(), self.content)
+
+    def test_offset_and_size_checks(self):
+        """Тест: неверное смещение, выход за размер и незавершенная загрузка отклоняются"""
+        url = self.start_upload()
+        self.put_chunk(url, 0, self.content[:1000])
+
+        response = self.put_chunk(url, 0, self.content[:1000])
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response['Upload-Offset'], '1000')
+
+        response = self.put_chunk(url, 1000, self.content[1000:] + b'lishnee')
+        self.assertEqual(response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        response = self.client.post(url + 'finalize/')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_checksum_mismatch(self):
+        """Тест: файл с другой контрольной суммой не становится вложением"""
+        url = self.start_upload(sha256='0' * 64)
+        self.put_chunk(url, 0, self.content)
+        response = self.client.post(url + 'finalize/')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(MailAttachment.objects.exists())
+
+    def test_upload_visible_only_to_owner(self):
+        """Тест: чужую загрузку нельзя продолжить"""
+        url = self.start_upload()
+        self.client.force_authenticate(user=self.other)
+        response = self.put_chunk(url, 0, self.content[:10])
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class AttachmentBlobTest(AttachmentUploadMixin, APITestCase):
+    """Тесты хранения содержимого вложений с дедупликацией"""
+
+    def upload(self):
+        url = self.start_upload()
+        self.put_chunk(url, 0, self.content)
+        response = self.client.post(url + 'finalize/')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return MailAttachment.objects.get(id=response.data['id'])
+
+    def test_same_content_stored_once(self):
+        """Тест: повторная загрузка того же файла ссылается на существующий блоб"""
+        first = self.upload()
+        second = self.upload()
+        response = self.client.post(
+            MAIL_API_URL + 'attachments/upload_multiple/',
+            {'files': [SimpleUploadedFile('копия.pdf', self.content)]},
+            format='multipart'
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        third = MailAttachment.objects.get(id=response.data[0]['id'])
+
+        digest = hashlib.sha256(self.content).hexdigest()
+        blob = AttachmentBlob.objects.get()
+        self.assertEqual(blob.sha256, digest)
+        self.assertEqual(blob.ref_count, 3)
+        self.assertEqual({first.blob_id, second.blob_id, third.blob_id}, {digest})
+        self.assertEqual(blob.file.name, f'mail_blobs/{digest[:2]}/{digest[2:4]}/{digest}')
+        # Временные файлы загрузок удалены, остался только файл блоба
+        self.assertEqual(default_storage.listdir('mail_attachments')[1], [])
+        with second.file.open('rb') as file:
+            self.assertEqual(file.read(), self.content)
+
+    def test_garbage_collection_keeps_referenced_blobs(self):
+        """Тест: блоб удаляется только когда на него нет ссылок дольше времени ожидания"""
+        first = self.upload()
+        second = self.upload()
+        blob_name = first.blob.file.name
+
+        first.delete()
+        call_command('mail_blob_gc', '--grace-minutes', '0', stdout=StringIO())
+        self.assertTrue(default_storage.exists(blob_name))
+
+        second.delete()
+        blob = AttachmentBlob.objects.get()
+        self.assertEqual(blob.ref_count, 0)
+        call_command('mail_blob_gc', stdout=StringIO())
+        self.assertTrue(default_storage.exists(blob_name))
+
+        call_command('mail_blob_gc', '--grace-minutes', '0', stdout=StringIO())
+        self.assertFalse(AttachmentBlob.objects.exists())
+        self.assertFalse(default_storage.exists(blob_name))
+
+    def test_backfill_moves_legacy_files(self):
+        """Тест: файлы старых вложений переносятся в блобы и схлопываются"""
+        legacy = []
+        for index in range(2):
+            name = default_storage.save(f'mail_attachments/old-{index}.pdf', ContentFile(self.content))
+            legacy.append(MailAttachment.objects.create(
+                file=name, filename='old.pdf', file_size=len(self.content), content_type='application/pdf'
+            ))
+
+        call_command('mail_blob_backfill', stdout=StringIO())
+        blob = AttachmentBlob.objects.get()
+        self.assertEqual(blob.ref_count, 2)
+        for attachment in legacy:
+            attachment.refresh_from_db()
+            self.assertEqual(attachment.blob_id, blob.sha256)
+            self.assertEqual(attachment.file.name, blob.file.name)
+        self.assertEqual(default_storage.listdir('mail_attachments')[1], [])
+
+
+class AttachmentDownloadTest(AttachmentUploadMixin, APITestCase):
+    """Тесты скачивания вложений с проверкой доступа"""
+
+    def setUp(self):
+        super().setUp()
+        response = self.client.post(
+            MAIL_API_URL + 'attachments/upload_multiple/',
+            {'files': [SimpleUploadedFile('акт.pdf', self.content, content_type='application/pdf')]},
+            format='multipart'
+        )
+        self.attachment = MailAttachment.objects.get(id=response.data[0]['id'])
+        self.url = f'{MAIL_API_URL}attachments/{self.attachment.id}/download/'
+        self.third = User.objects.create_user(email='third@example.com', password='thirdpass123')
+
+    def read(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_participants_can_download(self):
+        """Тест: файл доступен автору загрузки и участникам письма, но не посторонним"""
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.read(response), self.content)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['ETag'], f'"{self.attachment.blob_id}"')
+        self.assertIn('attachment;', response['Content-Disposition'])
+
+        self.client.force_authenticate(user=self.other)
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_404_NOT_FOUND)
+        message = self.create_message(from_user=self.user, to_user=self.other)
+        message.attachments.add(self.attachment)
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_200_OK)
+
+        self.client.force_authenticate(user=self.third)
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_404_NOT_FOUND)
+
+        # Ссылка в списке вложений ведет на эндпоинт скачивания, а не в MEDIA_URL
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(f'{MAIL_API_URL}attachments/{self.attachment.id}/')
+        self.assertTrue(response.data['file_url'].endswith(f'attachments/{self.attachment.id}/download/'))
+
+    def test_range_requests(self):
+        """Тест: части файла по Range, суффиксный диапазон и недопустимый диапазон"""
+        size = len(self.content)
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(response['Content-Range'], f'bytes 100-199/{size}')
+        self.assertEqual(self.read(response), self.content[100:200])
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-10')
+        self.assertEqual(self.read(response), self.content[-10:])
+
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={size}-')
+        self.assertEqual(response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        self.assertEqual(response['Content-Range'], f'bytes */{size}')
+
+        # If-Range с другим ETag: файл изменился, отдается целиком
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"other"')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_if_none_match(self):
+        """Тест: совпадающий ETag дает 304 без тела"""
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_missing_file(self):
+        """Тест: вложение без файла на диске дает 404, а не ошибку сервера"""
+        missing = MailAttachment.objects.create(
+            file='mail_attachments/missing.pdf', filename='missing.pdf',
+            file_size=10, content_type='application/pdf', uploaded_by=self.user
+        )
+        response = self.client.get(f'{MAIL_API_URL}attachments/{missing.id}/download/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_offload_to_proxy(self):
+        """Тест: при настроенном прокси Django отдает только заголовок перенаправления"""
+        with override_settings(MAIL_ATTACHMENT_SENDFILE='nginx', MAIL_ATTACHMENT_ACCEL_PREFIX='/protected-media/'):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{self.attachment.file.name}')
+        self.assertEqual(response.content, b'')
+
+        with override_settings(MAIL_ATTACHMENT_SENDFILE='apache'):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Sendfile'], self.attachment.file.path)
+
+
+class MailGarbageCollectionTest(AttachmentUploadMixin, APITestCase):
+    """Тесты команды mail_gc"""
+
+    def legacy_attachment(self, name, age=timedelta(days=2)):
+        name = default_storage.save(f'mail_attachments/{name}', ContentFile(b'x' * 100))
+        attachment = MailAttachment.objects.create(
+            file=name, filename=name, file_size=100, content_type='text/plain'
+        )
+        MailAttachment.objects.filter(pk=attachment.pk).update(created_at=timezone.now() - age)
+        return attachment
+
+    def run_gc(self, *args):
+        out = StringIO()
+        call_command('mail_gc', *args, stdout=out)
+        return out.getvalue()
+
+    def test_removes_only_old_unreferenced_attachments(self):
+        """Тест: удаляются только старые вложения без писем и без упоминаний в attachments_meta"""
+        orphan = self.legacy_attachment('orphan.txt')
+        fresh = self.legacy_attachment('fresh.txt', age=timedelta(minutes=5))
+        linked = self.legacy_attachment('linked.txt')
+        in_meta = self.legacy_attachment('meta.txt')
+        message = self.create_message(attachments_meta=[{'id': str(in_meta.id)}])
+        message.attachments.add(linked)
+
+        output = self.run_gc('--dry-run')
+        self.assertIn('Будет удалено вложений: 1, файлов на 100 байт', output)
+        self.assertTrue(MailAttachment.objects.filter(pk=orphan.pk).exists())
+
+        output = self.run_gc('--batch-size', '1')
+        self.assertIn('Удалено вложений: 1, файлов на 100 байт', output)
+        self.assertEqual(
+            set(MailAttachment.objects.values_list('pk', flat=True)),
+            {fresh.pk, linked.pk, in_meta.pk}
+        )
+        self.assertFalse(default_storage.exists(orphan.file.name))
+        self.assertTrue(default_storage.exists(linked.file.name))
+
+    def test_releases_blobs_and_stale_uploads(self):
+        """Тест: осиротевшие вложения на блобах освобождают ссылки, брошенные загрузки удаляются"""
+        response = self.client.post(
+            MAIL_API_URL + 'attachments/upload_multiple/',
+            {'files': [SimpleUploadedFile('акт.pdf', self.content)]},
+            format='multipart'
+        )
+        attachment = MailAttachment.objects.get(id=response.data[0]['id'])
+        MailAttachment.objects.filter(pk=attachment.pk).update(created_at=timezone.now() - timedelta(days=2))
+
+        url = self.start_upload()
+        self.put_chunk(url, 0, self.content[:1000])
+        upload = AttachmentUpload.objects.get()
+        AttachmentUpload.objects.filter(pk=upload.pk).update(updated_at=timezone.now() - timedelta(days=2))
+
+        self.run_gc()
+        self.assertFalse(MailAttachment.objects.exists())
+        blob = AttachmentBlob.objects.get()
+        self.assertEqual(blob.ref_count, 0)
+        self.assertIsNotNone(blob.unreferenced_at)
+        self.assertFalse(AttachmentUpload.objects.exists())
+        self.assertFalse(default_storage.exists(upload.file_name))
+
+
+class MailExportTest(AttachmentUploadMixin, APITestCase):
+    """Тесты потоковой выгрузки писем в mbox и zip"""
+
+    export_url = MAIL_API_URL + 'export/'
+
+    def setUp(self):
+        super().setUp()
+        name = default_storage.save('mail_attachments/act.pdf', ContentFile(self.content))
+        self.attachment = MailAttachment.objects.create(
+            file=name, filename='акт сверки.pdf', file_size=len(self.content), content_type='application/pdf'
+        )
+        self.encrypted = self.create_message(subject='Шифрованное', content_encrypted='', content_binary=b'\x84\x5e' * 40)
+        self.plain = self.create_message(subject='Открытое', content_encrypted='<p>Текст</p>', is_encrypted=False)
+        self.sent = self.create_message(from_user=self.user, to_user=self.other, subject='С вложением')
+        self.sent.attachments.add(self.attachment)
+        self.trashed = self.create_message(subject='В корзине', is_deleted_by_recipient=True)
+        stranger = User.objects.create_user(email='stranger@example.com', password='strangerpass123')
+        self.create_message(from_user=stranger, to_user=self.other, subject='Чужое')
+
+    def download(self, **params):
+        response = self.client.get(self.export_url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content)
+
+    def read_mbox(self, content):
+        with tempfile.NamedTemporaryFile(suffix='.mbox') as file:
+            file.write(content)
+            file.flush()
+            return [message_from_bytes(message.as_bytes(), policy=policy.default) for message in mbox(file.name)]
+
+    def test_mbox_keeps_bodies_encrypted(self):
+        """Тест: mbox со всеми письмами пользователя по порядку, тела как хранятся, вложения целиком"""
+        with mock.patch.object(export, 'BATCH_SIZE', 2):
+            response, content = self.download()
+        self.assertEqual(response['Content-Type'], 'application/mbox')
+        self.assertIn('.mbox"', response['Content-Disposition'])
+
+        messages = self.read_mbox(content)
+        self.assertEqual(
+            [str(message['Subject']) for message in messages],
+            ['Шифрованное', 'Открытое', 'С вложением', 'В корзине']
+        )
+        encrypted = messages[0]
+        self.assertEqual(encrypted['Message-ID'], f'<{self.encrypted.id}@testserver>')
+        self.assertEqual(encrypted.get_body().get_content(), self.encrypted.armored_content())
+        self.assertEqual(messages[1].get_body(('html',)).get_content().strip(), '<p>Текст</p>')
+        attachment, = messages[2].iter_attachments()
+        self.assertEqual(attachment.get_filename(), 'акт сверки.pdf')
+        self.assertEqual(attachment.get_content(), self.content)
+
+        # Папка и период
+        _, content = self.download(folder='inbox', since=self.plain.created_at.isoformat())
+        self.assertEqual([str(message['Subject']) for message in self.read_mbox(content)], ['Открытое'])
+
+    def test_idn_addresses(self):
+        """Тест: адрес с кириллическим доменом выгружается в punycode, выгрузка не обрывается"""
+        ivan = User.objects.create_user(email='ivan@пример.рф', password='ivanpass123', first_name='Иван')
+        self.create_message(from_user=ivan, to_user=self.user, subject='Из зоны рф')
+
+        _, content = self.download(folder='inbox')
+        self.assertIn(b'\nFrom ivan@xn--e1afmkfd.xn--p1ai ', content)
+        messages = self.read_mbox(content)
+        self.assertEqual(len(messages), 3)
+        self.assertEqual(messages[-1]['From'].addresses[0].addr_spec, 'ivan@xn--e1afmkfd.xn--p1ai')
+        self.assertEqual(messages[-1]['From'].addresses[0].display_name, 'Иван')
+
+        _, content = self.download(archive='zip')
+        with zipfile.ZipFile(BytesIO(content)) as archive:
+            self.assertEqual(len(archive.namelist()), 5)
+
+    def test_zip_by_folder(self):
+        """Тест: zip с файлом .eml на письмо в каталоге его папки"""
+        response, content = self.download(archive='zip')
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        with zipfile.ZipFile(BytesIO(content)) as archive:
+            names = archive.namelist()
+            self.assertEqual([name.split('/')[0] for name in names], ['inbox', 'inbox', 'sent', 'trash'])
+            eml = message_from_bytes(archive.read(names[2]), policy=policy.default)
+        attachment, = eml.iter_attachments()
+        self.assertEqual(attachment.get_content(), self.content)
+
+        for params in ({'archive': 'rar'}, {'folder': 'spam'}, {'since': '2026-02-01', 'until': '2026-01-01'}):
+            response = self.client.get(self.export_url, params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, params)
+
+
+class CountingGPG(gnupg.GPG):
+    """GPG, считающий импорты ключей"""
+
+    imports = 0
+
+    def import_keys(self, *args, **kwargs):
+        self.imports += 1
+        return super().import_keys(*args, **kwargs)
+
+
+class PublicKeyCacheTest(MailTestMixin, APITestCase):
+    """Тесты кеша импортированных ключей и команды mail_gpg_compact"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Ключи создаются один раз в отдельном каталоге; keyring почты не трогается
+        source_home = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, source_home, ignore_errors=True)
+        source = gnupg.GPG(gnupghome=source_home)
+        cls.public_keys = []
+        for email in ('lawyer@example.com', 'former@example.com'):
+            key = source.gen_key(source.gen_key_input(
+                name_email=email, key_type='RSA', key_length=1024, no_protection=True
+            ))
+            cls.public_keys.append(source.export_keys(key.fingerprint))
+
+    def setUp(self):
+        super().setUp()
+        gnupghome = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, gnupghome, ignore_errors=True)
+        self.gnupghome = gnupghome
+        self.gpg = CountingGPG(gnupghome=gnupghome)
+        self.gpg.encoding = 'utf-8'
+        self.cache = PublicKeyCache(self.gpg)
+
+    def test_key_imported_once(self):
+        """Тест: ключ импортируется один раз, дальше шифрование идет по отпечатку"""
+        for _ in range(3):
+            encrypted = self.cache.encrypt('Текст письма', self.public_keys[0])
+            self.assertTrue(encrypted.ok)
+        self.assertEqual(self.gpg.imports, 1)
+        self.assertIn('BEGIN PGP MESSAGE', str(encrypted))
+
+    def test_reimports_key_removed_from_keyring(self):
+        """Тест: если ключа из кеша уже нет в keyring, он импортируется заново"""
+        fingerprint = self.cache.fingerprint(self.public_keys[0])
+        self.gpg.delete_keys(fingerprint)
+
+        encrypted = self.cache.encrypt('Текст письма', self.public_keys[0])
+        self.assertTrue(encrypted.ok)
+        self.assertEqual(self.gpg.imports, 2)
+
+    def test_changed_public_key_is_forgotten(self):
+        """Тест: смена PGPKey.public_key удаляет старый ключ из кеша процесса"""
+        pgp_key = PGPKey.objects.create(
+            user=self.user, public_key=self.public_keys[0], private_key_encrypted='-', fingerprint='F' * 40
+        )
+        pgp_key = PGPKey.objects.get(pk=pgp_key.pk)
+        digest = key_digest(self.public_keys[0])
+        utils.public_keys.items[digest] = 'F' * 40
+        self.addCleanup(utils.public_keys.items.pop, digest, None)
+
+        pgp_key.session_key = 'session'
+        pgp_key.save(update_fields=['session_key'])
+        self.assertIn(digest, utils.public_keys.items)
+
+        pgp_key.public_key = self.public_keys[1]
+        pgp_key.save(update_fields=['public_key'])
+        self.assertNotIn(digest, utils.public_keys.items)
+        pgp_key.refresh_from_db()
+        self.assertEqual(pgp_key.fingerprint, '')
+
+    def test_compact_removes_keys_without_owner(self):
+        """Тест: mail_gpg_compact удаляет из keyring только ключи без владельца"""
+        owned = self.cache.fingerprint(self.public_keys[0])
+        orphan = self.cache.fingerprint(self.public_keys[1])
+        pgp_key = PGPKey.objects.create(user=self.user, public_key=self.public_keys[0], private_key_encrypted='-')
+
+        out = StringIO()
+        call_command('mail_gpg_compact', '--homedir', self.gnupghome, '--grace-minutes', '0', '--dry-run', stdout=out)
+        self.assertIn('Будет удалено ключей: 1', out.getvalue())
+        self.assertEqual(len(self.gpg.list_keys()), 2)
+
+        out = StringIO()
+        call_command('mail_gpg_compact', '--homedir', self.gnupghome, '--grace-minutes', '0', stdout=out)
+        self.assertIn(orphan, out.getvalue())
+        self.assertEqual([key['fingerprint'] for key in self.gpg.list_keys()], [owned])
+        pgp_key.refresh_from_db()
+        self.assertEqual(pgp_key.fingerprint, owned)
+
+
+@override_settings(MAIL_KEYGEN={'KEY_LENGTH': 1024, 'POOL_SIZE': 0})
+class PGPKeyGenerationTest(MailTestMixin, APITestCase):
+    """Тесты фонового создания PGP ключей и запаса готовых пар"""
+
+    url = MAIL_API_URL + 'pgp-keys/generate/'
+
+    def run_worker(self):
+        call_command('mail_keyworker', '--once', stdout=StringIO())
+
+    def test_job_is_processed_by_worker(self):
+        """Тест: без запаса запрос ставит задание, ключи создает воркер"""
+        response = self.client.post(self.url, {'passphrase': 'секретный пароль'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['status'], 'pending')
+        job_url = MAIL_API_URL + f'pgp-keys/jobs/{response.data["id"]}/'
+        # Повторный запрос возвращает то же задание
+        repeated = self.client.post(self.url, {'passphrase': 'секретный пароль'}, format='json')
+        self.assertEqual(repeated.data['id'], response.data['id'])
+
+        self.run_worker()
+        response = self.client.get(job_url)
+        self.assertEqual(response.data['status'], 'done')
+        self.assertFalse(response.data['from_pool'])
+        self.assertEqual(PGPKeyJob.objects.get().passphrase_encrypted, '')
+
+        pgp_key = PGPKey.objects.get(user=self.user)
+        private_key = utils.decrypt_private_key(pgp_key.private_key_encrypted, 'секретный пароль')
+        self.assertIn('PRIVATE KEY BLOCK', private_key)
+        self.assertEqual(len(pgp_key.fingerprint), 40)
+
+        response = self.client.post(self.url, {'passphrase': 'секретный пароль'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_pooled_key_is_assigned_immediately(self):
+        """Тест: при наличии запаса пара выдается прямо в запросе"""
+        with override_settings(MAIL_KEYGEN={'KEY_LENGTH': 1024, 'POOL_SIZE': 1}):
+            self.run_worker()
+        pooled = PregeneratedKey.objects.get()
+
+        response = self.client.post(self.url, {'passphrase': 'секретный пароль'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['status'], 'done')
+        self.assertTrue(response.data['from_pool'])
+        self.assertFalse(PregeneratedKey.objects.exists())
+
+        pgp_key = PGPKey.objects.get(user=self.user)
+        self.assertEqual(pgp_key.fingerprint, pooled.fingerprint)
+        private_key = utils.decrypt_private_key(pgp_key.private_key_encrypted, 'секретный пароль')
+        self.assertIn('PRIVATE KEY BLOCK', private_key)
+
+    def test_job_of_other_user_is_hidden(self):
+        """Тест: статус чужого задания недоступен"""
+        job = keygen.start_generation(self.other, 'секретный пароль')
+        response = self.client.get(MAIL_API_URL + f'pgp-keys/jobs/{job.id}/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class MailSearchTest(MailTestMixin, APITestCase):
+    """Тесты полнотекстового поиска по теме и участникам"""
+
+    search_url = MAIL_API_URL + 'search/'
+
+    def setUp(self):
+        super().setUp()
+        self.stranger = User.objects.create_user(
+            email='stranger@example.com', password='strangerpass123', first_name='Анна', last_name='Смирнова'
+        )
+
+    def create_indexed(self, **kwargs):
+        message = self.create_message(**kwargs)
+        search.index_messages([message.pk])
+        return message
+
+    def search(self, query, **params):
+        response = self.client.get(self.search_url, dict(params, q=query))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response
+
+    def found(self, query):
+        return [item['id'] for item in self.search(query).data['results']]
+
+    def test_ranked_search_with_cursor(self):
+        """Тест: поиск по теме и участникам, совпадения в теме выше, страницы по курсору без повторов"""
+        response = self.client.post(MAIL_API_URL, {
+            'to_user_id': str(self.other.id), 'subject': 'Договор аренды', 'content_encrypted': 'текст',
+        }, format='json')
+        created = response.data['id']
+        supply = self.create_indexed(subject='ДОГОВОР поставки')
+        by_name = self.create_indexed(subject='Петров и партнеры')
+        invoices = [self.create_indexed(subject=f'Счет {index}') for index in range(4)]
+        tree = self.create_indexed(subject='Ёлка в офисе')
+        self.create_indexed(from_user=self.stranger, to_user=self.other, subject='Договор')
+
+        self.assertEqual(sorted(self.found('догов')), sorted([created, str(supply.id)]))
+        self.assertEqual(self.found('договор поставки'), [str(supply.id)])
+        self.assertEqual(self.found('елка'), [str(tree.id)])
+        self.assertEqual(self.found('stranger'), [])
+
+        # Участник Петров есть во всех письмах, но письмо с ним в теме - первое
+        everything = self.found('петров')
+        self.assertEqual(everything[0], str(by_name.id))
+        self.assertEqual(len(everything), 8)
+        self.assertEqual(sorted(self.found('colleague@example.com')), sorted(everything))
+
+        pages, url, params = [], self.search_url, {'q': 'петров', 'page_size': 3}
+        while url:
+            with self.assertNumQueries(2):
+                response = self.client.get(url, params)
+            pages.append([item['id'] for item in response.data['results']])
+            url, params = response.data['next'], None
+        self.assertEqual([len(page) for page in pages], [3, 3, 2])
+        self.assertEqual(sum(pages, []), everything)
+
+        # Удаленное письмо пропадает из индекса
+        MailMessage.objects.filter(pk=invoices[0].pk).delete()
+        self.assertNotIn(str(invoices[0].id), self.found('счет'))
+        self.assertFalse(MailSearchDocument.objects.filter(message_id=invoices[0].pk).exists())
+
+        # Без FTS5 поиск идет по документам с тем же результатом и курсором
+        with mock.patch.object(search, 'fts_available', return_value=False):
+            self.assertEqual(sorted(self.found('догов')), sorted([created, str(supply.id)]))
+            self.assertEqual(self.found('петров')[0], str(by_name.id))
+            data = self.search('петров', page_size=4).data
+            rest = self.client.get(data['next']).data
+            self.assertIsNone(rest['next'])
+            found = [item['id'] for item in data['results'] + rest['results']]
+            self.assertEqual(sorted(found), sorted(set(everything) - {str(invoices[0].id)}))
+
+    def test_draft_edit_reindexed(self):
+        """Тест: правка темы черновика обновляет индекс, команда перестраивает его целиком"""
+        response = self.client.post(MAIL_API_URL, {
+            'to_user_id': str(self.other.id), 'subject': 'Черновик', 'content_encrypted': 'текст', 'is_draft': True,
+        }, format='json')
+        draft = response.data['id']
+        self.client.patch(MAIL_API_URL + f'{draft}/', {'subject': 'Исковое заявление'}, format='json')
+        self.assertEqual(self.found('исковое'), [draft])
+        self.assertEqual(self.found('черновик'), [])
+
+        legacy = self.create_message(subject='Старое письмо')
+        self.assertEqual(self.found('старое'), [])
+        output = StringIO()
+        call_command('mail_search_rebuild', stdout=output)
+        self.assertIn('Проиндексировано писем: 2 (FTS5)', output.getvalue())
+        self.assertEqual(self.found('старое'), [str(legacy.id)])
+
+    def test_foreign_drafts_not_found(self):
+        """Тест: адресат не находит чужой черновик, пока он не отправлен"""
+        draft = self.create_indexed(from_user=self.other, subject='Секретный договор', is_draft=True)
+        self.assertEqual(self.found('договор'), [])
+        with mock.patch.object(search, 'fts_available', return_value=False):
+            self.assertEqual(self.found('договор'), [])
+        # Документ, построенный до исключения черновиков из индекса
+        MailSearchDocument.objects.filter(message=draft).update(
+            users=f'{search.user_token(self.other.id)} {search.user_token(self.user.id)}'
+        )
+        self.assertEqual(self.found('договор'), [])
+
+        self.client.force_authenticate(user=self.other)
+        self.assertEqual(self.found('договор'), [str(draft.id)])
+        self.client.patch(MAIL_API_URL + f'{draft.id}/', {'is_draft': False}, format='json')
+        self.client.force_authenticate(user=self.user)
+        self.assertEqual(self.found('договор'), [str(draft.id)])
+
+    def test_query_validation(self):
+        """Тест: пустой запрос и запрос без слов отклоняются"""
+        for params in ({}, {'q': ''}, {'q': '!!! ???'}):
+            response = self.client.get(self.search_url, params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, params)
+
+
+class MailThreadTest(MailTestMixin, APITestCase):
+    """Тесты переписок и их агрегатов"""
+
+    threads_url = MAIL_API_URL + 'threads/'
+
+    def setUp(self):
+        super().setUp()
+        self.stranger = User.objects.create_user(email='stranger@example.com', password='strangerpass123')
+
+    def send(self, user, to_user, subject, **data):
+        self.client.force_authenticate(user=user)
+        response = self.client.post(MAIL_API_URL, dict(
+            data, to_user_id=str(to_user.id), subject=subject, content_encrypted='текст'
+        ), format='json')
+        self.client.force_authenticate(user=self.user)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.data)
+        return response.data
+
+    def test_replies_join_thread(self):
+        """Тест: ответы попадают в переписку, агрегаты учитывают отправку и удаление писем"""
+        self.send(self.user, self.other, 'Другая тема')
+        question = self.send(self.user, self.other, 'Договор')
+        thread_id = question['thread']
+        answer = self.send(self.other, self.user, 'Re: Договор', in_reply_to=question['id'])
+        self.assertEqual(answer['thread'], thread_id)
+        draft = self.send(self.other, self.user, 'Re: Договор', in_reply_to=answer['id'], is_draft=True)
+
+        thread = MailThread.objects.get(pk=thread_id)
+        self.assertEqual((thread.subject, thread.message_count, thread.has_attachments), ('Договор', 2, False))
+        self.assertEqual(
+            set(thread.participants.values_list('user_id', flat=True)), {self.user.id, self.other.id}
+        )
+
+        # Черновик ответа виден только автору и появляется в переписке после отправки
+        with self.assertNumQueries(3):
+            response = self.client.get(self.threads_url + f'{thread_id}/')
+        self.assertEqual([item['id'] for item in response.data['messages']], [question['id'], answer['id']])
+        self.client.force_authenticate(user=self.other)
+        self.client.patch(MAIL_API_URL + f"{draft['id']}/", {'is_draft': False}, format='json')
+        self.assertEqual(len(self.client.get(self.threads_url + f'{thread_id}/').data['messages']), 3)
+        self.client.force_authenticate(user=self.user)
+        thread.refresh_from_db()
+        self.assertEqual(thread.message_count, 3)
+
+        # Список - по последней активности, страницы по курсору
+        pages, url = [], self.threads_url + '?page_size=1'
+        while url:
+            with self.assertNumQueries(2):
+                response = self.client.get(url)
+            pages.append([(item['subject'], item['message_count']) for item in response.data['results']])
+            url = response.data['next']
+        self.assertEqual(pages, [[('Договор', 3)], [('Другая тема', 1)]])
+        participants = response.data['results'][0]['participants']
+        self.assertEqual([user['email'] for user in participants], ['colleague@example.com', 'lawyer@example.com'])
+
+        # Чужая переписка и ответ на чужое письмо недоступны
+        self.client.force_authenticate(user=self.stranger)
+        self.assertEqual(self.client.get(self.threads_url).data['results'], [])
+        self.assertEqual(self.client.get(self.threads_url + f'{thread_id}/').status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.post(MAIL_API_URL, {
+            'to_user_id': str(self.user.id), 'subject': 'Re', 'content_encrypted': 'текст', 'in_reply_to': question['id'],
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.client.force_authenticate(user=self.user)
+
+        # Удаление писем пересчитывает переписку, пустая переписка удаляется
+        MailMessage.objects.filter(thread_id=thread_id).update(is_deleted_by_sender=True, is_deleted_by_recipient=True)
+        self.client.post(MAIL_API_URL + 'bulk/', {'action': 'purge', 'ids': [answer['id']]}, format='json')
+        thread.refresh_from_db()
+        self.assertEqual(thread.message_count, 2)
+        self.client.post(MAIL_API_URL + 'bulk/', {'action': 'purge', 'folder': 'trash'}, format='json')
+        self.assertFalse(MailThread.objects.filter(pk=thread_id).exists())
+        self.assertFalse(MailThreadParticipant.objects.filter(thread_id=thread_id).exists())
+
+    def test_invalid_cursor(self):
+        """Тест: подделанный курсор списка переписок дает 404, а не ошибку сервера"""
+        for payload in (
+            {'c': timezone.now().isoformat(), 'i': 'zzz'},
+            {'c': timezone.now().isoformat(), 'i': str(uuid.uuid4())},
+            {'c': '2026-01-01T10:00:00', 'i': 1},
+        ):
+            response = self.client.get(self.threads_url + f'?cursor={forge_cursor(payload)}')
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND, payload)
+
+    def test_backfill_groups_legacy_messages(self):
+        """Тест: старые письма объединяются по теме без префиксов и паре участников"""
+        first = self.create_message(subject='Договор')
+        reply = self.create_message(from_user=self.user, to_user=self.other, subject='RE: Fwd: договор')
+        attachment = self.create_attachment()
+        reply.attachments.add(attachment)
+        other_pair = self.create_message(from_user=self.stranger, subject='Договор')
+        untitled = [self.create_message(subject=''), self.create_message(subject='')]
+        self.assertEqual(threads.normalize_subject('Ответ: Re[2]: Договор'), 'Договор')
+
+        output = StringIO()
+        call_command('mail_thread_backfill', '--batch-size', '2', stdout=output)
+        self.assertIn('Писем с назначенной перепиской: 5', output.getvalue())
+
+        messages = MailMessage.objects.in_bulk()
+        thread = messages[first.pk].thread
+        self.assertEqual(messages[reply.pk].thread_id, thread.pk)
+        self.assertEqual((thread.message_count, thread.has_attachments), (2, True))
+        self.assertEqual(thread.last_activity_at, reply.created_at)
+        self.assertNotEqual(messages[other_pair.pk].thread_id, thread.pk)
+        self.assertNotEqual(messages[untitled[0].pk].thread_id, messages[untitled[1].pk].thread_id)
+        self.assertEqual(MailThread.objects.count(), 4)
+
+        # Ответ на старое письмо попадает в его переписку
+        answer = self.send(self.user, self.other, 'Re: Договор', in_reply_to=str(first.id))
+        self.assertEqual(answer['thread'], thread.pk)
+
+
+class PGPSessionDecryptTest(MailTestMixin, APITestCase):
+    """Тесты сессий расшифровки с разблокированным ключом в памяти воркера"""
+
+    passphrase = 'секретный пароль'
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        with override_settings(MAIL_KEYGEN={'KEY_LENGTH': 1024}):
+            cls.public_key, cls.private_key, _ = keygen.generate_key_material('Иван Иванов', 'lawyer@example.com', cls.passphrase)
+        gnupghome = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, gnupghome, ignore_errors=True)
+        gpg = gnupg.GPG(gnupghome=gnupghome)
+        gpg.encoding = 'utf-8'
+        cls.encrypted = PublicKeyCache(gpg).encrypt('Текст письма', cls.public_key).data.decode('utf-8')
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(keysessions.unlocked_keys.clear)
+        self.pgp_key = PGPKey.objects.create(
+            user=self.user,
+            public_key=self.public_key,
+            private_key_encrypted=utils.save_private_key_encrypted(self.private_key, self.passphrase)
+        )
+        self.message = self.create_message(content_encrypted=self.encrypted)
+        self.decrypt_url = MAIL_API_URL + f'{self.message.id}/decrypt/'
+
+    def create_session(self, passphrase):
+        return self.client.post(MAIL_API_URL + 'pgp-keys/create_session/', {'passphrase': passphrase}, format='json')
+
+    def test_wrong_passphrase_is_rejected(self):
+        """Тест: сессия с неверным паролем не создается"""
+        response = self.create_session('неверный пароль')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIsNone(keysessions.unlocked_keys.get(self.user.pk))
+        self.pgp_key.refresh_from_db()
+        self.assertIsNone(self.pgp_key.session_expires)
+
+    def test_session_decrypts_without_passphrase(self):
+        """Тест: в сессии расшифровка не требует пароля и не расшифровывает ключ заново"""
+        response = self.create_session(self.passphrase)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        unlocked = keysessions.unlocked_keys.get(self.user.pk)
+        self.assertIsNotNone(unlocked)
+
+        # Ключ в базе больше не нужен: расшифровка идет ключом из памяти
+        PGPKey.objects.filter(pk=self.pgp_key.pk).update(private_key_encrypted='испорчен')
+        for _ in range(2):
+            response = self.client.post(self.decrypt_url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data['content'], 'Текст письма')
+        self.assertIs(keysessions.unlocked_keys.get(self.user.pk), unlocked)
+
+        response = self.client.post(MAIL_API_URL + 'pgp-keys/end_session/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsNone(keysessions.unlocked_keys.get(self.user.pk))
+        self.assertFalse(os.path.exists(unlocked.home))
+        response = self.client.post(self.decrypt_url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_other_worker_unlocks_with_passphrase(self):
+        """Тест: воркер без ключа в памяти разблокирует его переданным паролем"""
+        self.create_session(self.passphrase)
+        # Имитация другого воркера: в его памяти ключа нет
+        keysessions.unlocked_keys.clear()
+
+        response = self.client.post(self.decrypt_url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(response.data['detail'].code, 'session_locked')
+
+        response = self.client.post(self.decrypt_url, {'passphrase': self.passphrase}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['content'], 'Текст письма')
+        self.assertIsNotNone(keysessions.unlocked_keys.get(self.user.pk))
+
+    def test_decrypt_batch(self):
+        """Тест: пачка писем расшифровывается одним запросом с ошибками по отдельным письмам"""
+        self.create_session(self.passphrase)
+        second = self.create_message(content_encrypted=self.encrypted)
+        broken = self.create_message(content_encrypted='-----BEGIN PGP MESSAGE-----\nповреждено')
+        stranger = User.objects.create_user(email='stranger@example.com', password='strangerpass123')
+        foreign = self.create_message(from_user=stranger, to_user=self.other, content_encrypted=self.encrypted)
+        missing = uuid.uuid4()
+        ids = [self.message.id, broken.id, foreign.id, missing, second.id, self.message.id]
+
+        response = self.client.post(
+            MAIL_API_URL + 'decrypt-batch/', {'ids': [str(message_id) for message_id in ids]}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'], [
+            {'id': str(self.message.id), 'content': 'Текст письма'},
+            {'id': str(broken.id), 'error': 'decryption_failed'},
+            {'id': str(foreign.id), 'error': 'not_found'},
+            {'id': str(missing), 'error': 'not_found'},
+            {'id': str(second.id), 'content': 'Текст письма'},
+        ])
+
+        too_many = [str(uuid.uuid4()) for _ in range(51)]
+        response = self.client.post(MAIL_API_URL + 'decrypt-batch/', {'ids': too_many}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+    def test_binary_body_storage(self):
+        """Тест: armor-тело хранится двоично, armor восстанавливается при выдаче, старые письма переводятся командой"""
+        self.create_session(self.passphrase)
+        self.client.force_authenticate(user=self.other)
+        response = self.client.post(MAIL_API_URL, {
+            'to_user_id': str(self.user.id), 'subject': 'Письмо', 'content_encrypted': self.encrypted,
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        message = MailMessage.objects.get(id=response.data['id'])
+        self.assertEqual(message.content_encrypted, '')
+        self.assertEqual(bytes(message.content_binary), armor.dearmor(self.encrypted))
+        self.assertLess(len(message.content_binary), len(self.encrypted) * 0.8)
+
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(MAIL_API_URL + f'{message.id}/')
+        self.assertTrue(armor.is_armored(response.data['content_encrypted']))
+        self.assertEqual(armor.dearmor(response.data['content_encrypted']), bytes(message.content_binary))
+        response = self.client.get(MAIL_API_URL + f'{message.id}/content/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.content, bytes(message.content_binary))
+        response = self.client.post(MAIL_API_URL + f'{message.id}/decrypt/')
+        self.assertEqual(response.data['content'], 'Текст письма')
+
+        # Письмо старого формата и поврежденный armor
+        broken = self.create_message(content_encrypted='-----BEGIN PGP MESSAGE-----\n\n@@@\n-----END PGP MESSAGE-----')
+        self.assertIsNone(self.message.content_binary)
+        output = StringIO()
+        call_command('mail_body_backfill', '--batch-size', '1', stdout=output)
+        self.assertIn('Переведено писем: 1, поврежденный armor: 1', output.getvalue())
+        self.message.refresh_from_db()
+        broken.refresh_from_db()
+        self.assertEqual(bytes(self.message.content_binary), armor.dearmor(self.encrypted))
+        self.assertIsNone(broken.content_binary)
+        response = self.client.post(self.decrypt_url)
+        self.assertEqual(response.data['content'], 'Текст письма')
+        self.assertEqual(self.client.get(MAIL_API_URL + f'{broken.id}/content/').status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_armor_format(self):
+        """Тест: заголовки и контрольная сумма armor пропускаются, gpg читает armor без контрольной суммы"""
+        data = armor.dearmor(self.encrypted)
+        lines = armor.armor(data).splitlines()
+        self.assertTrue(all(len(line) <= armor.LINE_LENGTH for line in lines))
+        with_headers = '\n'.join([lines[0], 'Version: openpgp.js', 'Comment: x', ''] + lines[2:-1] + ['=AbCd', lines[-1]])
+        self.assertEqual(armor.dearmor(with_headers), data)
+        self.assertEqual(armor.pack('Обычный текст'), ('Обычный текст', None))
+        with self.assertRaises(ValueError):
+            armor.dearmor('Обычный текст')
+
+
+class MailFanOutTest(MailTestMixin, APITestCase):
+    """Тесты отправки письма нескольким получателям"""
+
+    send_url = MAIL_API_URL + 'send-multiple/'
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        with override_settings(MAIL_KEYGEN={'KEY_LENGTH': 1024}):
+            cls.public_key, cls.private_key, _ = keygen.generate_key_material('Петр Петров', 'colleague@example.com')
+
+    def setUp(self):
+        super().setUp()
+        # Шифрование идет во временном keyring, а не в keyring почты
+        gnupghome = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, gnupghome, ignore_errors=True)
+        self.gpg = gnupg.GPG(gnupghome=gnupghome)
+        self.gpg.encoding = 'utf-8'
+        self.enterContext(mock.patch.object(utils, 'public_keys', PublicKeyCache(self.gpg)))
+        PGPKey.objects.create(user=self.other, public_key=self.public_key, private_key_encrypted='-')
+        self.third = User.objects.create_user(email='assistant@example.com', password='assistantpass123')
+
+    def test_encrypted_copy_per_recipient(self):
+        """Тест: каждый получатель с ключом получает свою зашифрованную копию, остальные - ошибку"""
+        attachment = self.create_attachment()
+        attachment.uploaded_by = self.user
+        attachment.save()
+        missing = uuid.uuid4()
+        response = self.client.post(self.send_url, {
+            'recipient_ids': [str(self.other.id), str(self.third.id), str(missing), str(self.other.id)],
+            'subject': 'Договор',
+            'content': 'Текст письма',
+            'attachment_ids': [str(attachment.id)],
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        results = response.data['results']
+        self.assertEqual(list(results), [str(self.other.id), str(self.third.id), str(missing)])
+        self.assertEqual(results[str(self.third.id)], {'error': 'no_public_key'})
+        self.assertEqual(results[str(missing)], {'error': 'not_found'})
+
+        message = MailMessage.objects.get(id=results[str(self.other.id)]['message_id'])
+        self.assertEqual((message.from_user, message.to_user), (self.user, self.other))
+        self.assertTrue(message.is_encrypted)
+        self.gpg.import_keys(self.private_key)
+        self.assertEqual(message.content_encrypted, '')
+        self.assertEqual(str(self.gpg.decrypt(bytes(message.content_binary))), 'Текст письма')
+        self.assertEqual(list(message.attachments.all()), [attachment])
+        self.assertEqual(message.attachments_meta[0]['id'], str(attachment.id))
+
+        self.assertEqual(MailboxCounters.objects.get(user=self.other).inbox_unread, 1)
+        self.assertEqual(MailboxCounters.objects.get(user=self.user).sent_total, 1)
+        self.assertTrue(MailChange.objects.filter(user=self.other, message_id=message.id, action='created').exists())
+
+    def test_plain_copies_in_one_insert(self):
+        """Тест: без шифрования копии создаются одной вставкой всем найденным получателям"""
+        recipients = [self.other, self.third]
+        response = self.client.post(self.send_url, {
+            'recipient_ids': [str(user.id) for user in recipients],
+            'subject': 'Совещание',
+            'content': 'В пятницу в 10:00',
+            'is_encrypted': False,
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        messages = MailMessage.objects.filter(from_user=self.user)
+        self.assertEqual(sorted(message.to_user_id for message in messages), sorted(user.id for user in recipients))
+        self.assertTrue(all(message.content_encrypted == 'В пятницу в 10:00' for message in messages))
+        self.assertTrue(all(message.content_binary is None for message in messages))
+
+    def test_no_recipient_reached(self):
+        """Тест: если письмо не ушло ни одному получателю, ответ 400 с ошибками"""
+        response = self.client.post(self.send_url, {
+            'recipient_ids': [str(self.third.id)], 'subject': 'Тема', 'content': 'Текст',
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['results'], {str(self.third.id): {'error': 'no_public_key'}})
+        self.assertFalse(MailMessage.objects.exists())
+
+        foreign = self.create_attachment()
+        response = self.client.post(self.send_url, {
+            'recipient_ids': [str(self.other.id)], 'subject': 'Тема', 'content': 'Текст',
+            'attachment_ids': [str(foreign.id)],
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('attachment_ids', response.data)
+
+
+class OutboundDeliveryTest(APITestCase):
+    """Тесты очереди исходящих писем и воркера SMTP"""
+
+    def setUp(self):
+        self.sink = SMTPSink().start()
+        self.addCleanup(self.sink.stop)
+        self.config = dict(outbox.get_config(), HOST=self.sink.host, PORT=self.sink.port, MAX_ATTEMPTS=3)
+        self.connection = outbox.SMTPConnection.from_config(self.config)
+        self.addCleanup(self.connection.close)
+
+    def enqueue(self, to_email, **kwargs):
+        return outbox.enqueue('lawyer@example.com', to_email, kwargs.pop('subject', 'Договор'), '<p>Текст письма</p>', **kwargs)
+
+    def test_batch_sent_over_one_connection(self):
+        """Тест: пачка писем уходит по одному соединению, у каждого письма сохраняется ID очереди"""
+        attachment = tempfile.NamedTemporaryFile(suffix='.pdf', delete=False)
+        self.addCleanup(os.remove, attachment.name)
+        attachment.write(b'%PDF-1.4')
+        attachment.close()
+        queued = utils.send_email_via_postfix('lawyer@example.com', 'client@example.com', 'Тема письма', '<p>Текст</p>', [attachment.name])
+        for index in range(4):
+            self.enqueue(f'client-{index}@example.com')
+
+        self.assertEqual(outbox.process_queue(self.connection, self.config), 5)
+        self.assertEqual(self.sink.connections, 1)
+        self.assertEqual(len(self.sink.messages), 5)
+        for outbound in OutboundEmail.objects.all():
+            self.assertEqual(outbound.status, 'sent')
+            self.assertEqual(outbound.attempts, 1)
+            self.assertIsNotNone(outbound.sent_at)
+        queued.refresh_from_db()
+        first = next(message for message in self.sink.messages if message.rcpt_tos == ['client@example.com'])
+        self.assertEqual(queued.queue_id, first.queue_id)
+        self.assertIn(os.path.basename(attachment.name).encode(), first.data)
+
+        # Следующая пачка идет по тому же соединению
+        self.enqueue('client-5@example.com')
+        outbox.process_queue(self.connection, self.config)
+        self.assertEqual(self.sink.connections, 1)
+
+    def test_temporary_and_permanent_errors(self):
+        """Тест: 4xx откладывается с растущей задержкой, 5xx завершается ошибкой, остальные письма уходят"""
+        self.sink.refuse('busy@example.com', '450 4.2.0 Mailbox busy')
+        self.sink.refuse('unknown@example.com', '550 5.1.1 User unknown')
+        busy = self.enqueue('busy@example.com')
+        unknown = self.enqueue('unknown@example.com')
+        delivered = self.enqueue('client@example.com')
+
+        outbox.process_queue(self.connection, self.config)
+        busy.refresh_from_db()
+        unknown.refresh_from_db()
+        delivered.refresh_from_db()
+        self.assertEqual((unknown.status, unknown.attempts), ('failed', 1))
+        self.assertIn('User unknown', unknown.last_error)
+        self.assertEqual(delivered.status, 'sent')
+        self.assertEqual((busy.status, busy.attempts), ('queued', 1))
+        self.assertGreater(busy.next_attempt_at, timezone.now() + timedelta(seconds=50))
+
+        # Отложенное письмо не берется раньше времени
+        self.assertEqual(outbox.process_queue(self.connection, self.config), 0)
+
+        for attempts, delay in ((2, 120), (3, None)):
+            OutboundEmail.objects.filter(pk=busy.pk).update(next_attempt_at=timezone.now())
+            outbox.process_queue(self.connection, self.config)
+            busy.refresh_from_db()
+            self.assertEqual(busy.attempts, attempts)
+            if delay:
+                self.assertEqual(busy.status, 'queued')
+                self.assertAlmostEqual((busy.next_attempt_at - timezone.now()).total_seconds(), delay, delta=10)
+        self.assertEqual(busy.status, 'failed')
+
+    def test_server_unavailable(self):
+        """Тест: если сервер недоступен, вся пачка откладывается и уходит после его запуска"""
+        self.sink.stop()
+        self.enqueue('client@example.com')
+        self.enqueue('partner@example.com')
+
+        outbox.process_queue(self.connection, self.config)
+        self.assertEqual(set(OutboundEmail.objects.values_list('status', 'attempts')), {('queued', 1)})
+
+        self.sink = SMTPSink(port=self.sink.port).start()
+        self.addCleanup(self.sink.stop)
+        OutboundEmail.objects.update(next_attempt_at=timezone.now())
+        with override_settings(MAIL_OUTBOX=self.config):
+            call_command('mail_outbox_worker', '--once', stdout=StringIO())
+        self.assertEqual(set(OutboundEmail.objects.values_list('status', flat=True)), {'sent'})
+        self.assertEqual(sorted(message.rcpt_tos[0] for message in self.sink.messages), ['client@example.com', 'partner@example.com'])
+
+    def test_claimed_once(self):
+        """Тест: письмо, взятое одним воркером, не достается другому, пока не устарело"""
+        outbound = self.enqueue('client@example.com')
+        self.assertEqual(outbox.claim_batch(10), [outbound])
+        self.assertEqual(outbox.claim_batch(10), [])
+        OutboundEmail.objects.filter(pk=outbound.pk).update(updated_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(outbox.claim_batch(10), [outbound])
+
+    def make_file(self, name, content=None, size=0):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        path = os.path.join(directory, name)
+        with open(path, 'wb') as file:
+            file.write(content if content is not None else os.urandom(size))
+        return path
+
+    def test_streamed_message_structure(self):
+        """Тест: письмо из потока разбирается почтовым парсером без потерь"""
+        contract = self.make_file('Договор №1.pdf', size=mime.READ_BLOCK * 2 + 100)
+        notes = self.make_file('notes.txt', b'.first line\r\n.second line\r\n')
+        raw = b''.join(mime.iter_message(
+            'lawyer@example.com', 'client@example.com', 'Тема письма', '<p>Текст</p>',
+            [contract, notes, '/nonexistent/file.pdf']
+        ))
+        self.assertTrue(all(len(line) <= 998 for line in raw.split(b'\r\n')))
+
+        parsed = message_from_bytes(raw, policy=policy.default)
+        self.assertEqual(parsed['Subject'], 'Тема письма')
+        body, *attachments = parsed.iter_parts()
+        self.assertEqual(body.get_content().strip(), '<p>Текст</p>')
+        self.assertEqual([part.get_filename() for part in attachments], ['Договор №1.pdf', 'notes.txt'])
+        with open(contract, 'rb') as file:
+            self.assertEqual(attachments[0].get_content(), file.read())
+        self.assertEqual(attachments[0].get_content_type(), 'application/pdf')
+
+        # Через SMTP письмо доходит тем же, включая строки с точкой в начале
+        outbound = self.enqueue('client@example.com', attachments=[contract, notes])
+        outbox.process_queue(self.connection, self.config)
+        outbound.refresh_from_db()
+        self.assertEqual(outbound.status, 'sent')
+        delivered = message_from_bytes(self.sink.messages[0].data, policy=policy.default)
+        self.assertEqual(list(delivered.iter_parts())[2].get_content(), '.first line\r\n.second line\r\n')
+
+    def test_large_attachment_constant_memory(self):
+        """Тест: память на отправку не зависит от размера вложения"""
+        self.sink.stop()
+        self.sink = SMTPSink(keep_data=False).start()
+        self.addCleanup(self.sink.stop)
+        connection = outbox.SMTPConnection(self.sink.host, self.sink.port)
+        self.addCleanup(connection.close)
+        size = 16 * 1024 * 1024
+        outbound = self.enqueue('client@example.com', attachments=[self.make_file('archive.zip', size=size)])
+
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        connection.send(outbound)
+        peak = tracemalloc.get_traced_memory()[1]
+        self.assertLess(peak, 2 * 1024 * 1024)
+        self.assertGreater(self.sink.messages[0].size, size * 4 // 3)
+
+
+class PostfixLogIndexTest(APITestCase):
+    """Тесты индексатора лога Postfix на образце лога из fixtures"""
+
+    fixture_log = os.path.join(os.path.dirname(__file__), 'fixtures', 'postfix_mail.log')
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.path = os.path.join(directory, 'mail.log')
+        with open(self.fixture_log, 'rb') as file:
+            self.lines = file.read().splitlines(keepends=True)
+
+    def write(self, lines, mode='ab', path=None):
+        with open(path or self.path, mode) as file:
+            file.writelines(lines)
+
+    def test_statuses_from_log(self):
+        """Тест: статусы разбираются из лога, поздняя строка перезаписывает раннюю"""
+        self.write(self.lines[:6])
+        self.assertEqual(postfixlog.index_log(self.path), 2)
+        self.assertEqual(utils.check_email_delivery_status('4F9D12A3B1'), 'deferred')
+
+        self.write(self.lines[6:])
+        self.assertEqual(postfixlog.index_log(self.path, batch_size=2), 3)
+        self.assertEqual(utils.check_email_delivery_status('4F9D12A3B1'), 'delivered')
+        self.assertEqual(utils.check_email_delivery_status('7C3E5F1A20'), 'bounced')
+        self.assertEqual(utils.check_email_delivery_status('3Vk9Qd1Zx2zBcDf'), 'deferred')
+        self.assertEqual(utils.check_email_delivery_status('0000000000'), 'unknown')
+
+        partner = PostfixDelivery.objects.get(queue_id='4F9D12A3B1', recipient='partner@example.org')
+        self.assertEqual((partner.status, partner.dsn), ('sent', '2.0.0'))
+        self.assertEqual(partner.relay, 'mx.example.org[93.184.216.35]:25')
+        self.assertEqual(partner.response, '250 2.0.0 Ok: queued as 1F2E3D4C5B')
+        self.assertEqual((partner.logged_at.month, partner.logged_at.day, partner.logged_at.minute), (5, 1, 25))
+        self.assertEqual(PostfixDelivery.objects.count(), 4)
+
+        # Повторный запуск не читает лог заново
+        with self.assertNumQueries(1):
+            self.assertEqual(postfixlog.index_log(self.path), 0)
+
+    def test_partial_line_and_rotation(self):
+        """Тест: незаконченная строка дочитывается позже, ротированный лог дочитывается до конца"""
+        self.write(self.lines[:5] + [self.lines[5][:40]])
+        self.assertEqual(postfixlog.index_log(self.path), 1)
+        self.write([self.lines[5][40:]] + self.lines[6:9])
+        self.assertEqual(postfixlog.index_log(self.path), 1)
+
+        # logrotate: mail.log -> mail.log.1, новый mail.log
+        self.write(self.lines[9:12])
+        os.rename(self.path, self.path + '.1')
+        self.write(self.lines[12:], mode='wb')
+        self.assertEqual(postfixlog.index_log(self.path), 3)
+        self.assertEqual(PostfixDelivery.objects.count(), 4)
+        self.assertEqual(utils.check_email_delivery_status('7C3E5F1A20'), 'bounced')
+        cursor = PostfixLogCursor.objects.get(path=self.path)
+        self.assertEqual((cursor.inode, cursor.offset), (os.stat(self.path).st_ino, os.path.getsize(self.path)))
+
+        # copytruncate: файл обрезан и пишется заново
+        self.write(self.lines[4:5], mode='wb')
+        PostfixDelivery.objects.all().delete()
+        out = StringIO()
+        call_command('mail_postfix_index', '--log', self.path, stdout=out)
+        self.assertIn('Статусов доставки: 1', out.getvalue())
+        self.assertEqual(utils.check_email_delivery_status('4F9D12A3B1'), 'delivered')
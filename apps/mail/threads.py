@@ -0,0 +1,173 @@
+"""
+Переписки: исходное письмо и ответы на него
+
+Письмо с in_reply_to попадает в переписку исходного письма, любое другое
+письмо начинает новую (assign). Переписка назначается в mailbox.track()
+вместе со счетчиками, там же пересчитываются агрегаты затронутых переписок
+(refresh): число писем, время последнего письма, наличие связанных
+вложений и участники. Агрегаты считаются по отправленным письмам -
+черновик ответа появляется в переписке только после отправки.
+
+Строки участников (MailThreadParticipant) повторяют время последнего письма,
+поэтому список переписок пользователя - keyset-страница по индексу
+(user, last_activity_at, id), а переписка целиком - одно чтение писем по
+индексу (thread, created_at, id), без поиска по теме.
+
+У писем, созданных до появления переписок, связей ответов нет; команда
+mail_thread_backfill группирует их по теме без префиксов Re:/Fwd: и паре
+участников (backfill).
+"""
+import re
+from collections import defaultdict
+
+from django.db import models, transaction
+
+from mail.models import MailMessage, MailThread, MailThreadParticipant
+
+# Префиксы ответов и пересылок, в том числе повторенные: "Re: Fwd: Re[2]:"
+subject_prefix_pattern = re.compile(r'^(?:\s*(?:re|fwd?|отв|ответ|пересл)(?:\[\d+\])?\s*:)+\s*', re.IGNORECASE)
+
+
+def normalize_subject(subject):
+    """
+    Тема переписки: тема письма без префиксов ответа и пересылки
+    """
+    return subject_prefix_pattern.sub('', subject or '').strip()[:255]
+
+
+def assign(messages):
+    """
+    Назначает переписки новым письмам без thread
+
+    Ответ попадает в переписку исходного письма. Исходное письмо без
+    переписки (созданное до их появления) сначала получает свою.
+    """
+    pending = [message for message in messages if message.thread_id is None]
+    if not pending:
+        return
+
+    parent_ids = {message.in_reply_to_id for message in pending if message.in_reply_to_id}
+    parents = MailMessage.objects.only('id', 'subject', 'thread_id').in_bulk(parent_ids) if parent_ids else {}
+    created = []
+    updated = list(pending)
+    for parent in parents.values():
+        if parent.thread_id is None:
+            parent.thread = MailThread(subject=normalize_subject(parent.subject))
+            created.append(parent.thread)
+            updated.append(parent)
+
+    for message in pending:
+        parent = parents.get(message.in_reply_to_id)
+        if parent is not None:
+            message.thread_id = parent.thread_id
+        else:
+            message.thread = MailThread(subject=normalize_subject(message.subject))
+            created.append(message.thread)
+
+    MailThread.objects.bulk_create(created)
+    MailMessage.objects.bulk_update(updated, ['thread'])
+
+
+def refresh(thread_ids):
+    """
+    Пересчитывает агрегаты и участников переписок thread_ids по их письмам
+
+    Письма всех переписок читаются одним запросом, агрегаты и участники
+    записываются через INSERT ... ON CONFLICT: число запросов не зависит
+    от числа переписок, а большой CASE WHEN, как у bulk_update, не строится.
+    Переписки, в которых не осталось писем, удаляются.
+    """
+    thread_ids = set(thread_ids)
+    if not thread_ids:
+        return
+
+    linked_attachments = MailMessage.attachments.through.objects.filter(mailmessage_id=models.OuterRef('pk'))
+    rows = (
+        MailMessage.objects.filter(thread_id__in=thread_ids, is_draft=False).order_by()
+        .annotate(has_linked_attachments=models.Exists(linked_attachments))
+        .values_list('thread_id', 'from_user_id', 'to_user_id', 'created_at', 'has_linked_attachments')
+    )
+    threads = {}
+    users = {}
+    for thread_id, from_user_id, to_user_id, created_at, has_linked_attachments in rows:
+        thread = threads.get(thread_id)
+        if thread is None:
+            thread = threads[thread_id] = MailThread(id=thread_id, last_activity_at=created_at)
+            users[thread_id] = set()
+        thread.message_count += 1
+        thread.has_attachments = thread.has_attachments or has_linked_attachments
+        thread.last_activity_at = max(thread.last_activity_at, created_at)
+        users[thread_id].update((from_user_id, to_user_id))
+
+    # Остальные переписки пусты или состоят из черновиков
+    idle = thread_ids - threads.keys()
+    if idle:
+        MailThread.objects.filter(pk__in=idle).exclude(
+            models.Exists(MailMessage.objects.filter(thread_id=models.OuterRef('pk')))
+        ).delete()
+        MailThread.objects.filter(pk__in=idle).update(message_count=0, has_attachments=False, last_activity_at=None)
+    # Переписки уже существуют, вставка только обновляет агрегаты
+    MailThread.objects.bulk_create(
+        threads.values(),
+        update_conflicts=True,
+        unique_fields=['id'],
+        update_fields=['message_count', 'has_attachments', 'last_activity_at'],
+    )
+
+    stale = [
+        pk for pk, thread_id, user_id in
+        MailThreadParticipant.objects.filter(thread_id__in=thread_ids).values_list('pk', 'thread_id', 'user_id')
+        if user_id not in users.get(thread_id, ())
+    ]
+    if stale:
+        MailThreadParticipant.objects.filter(pk__in=stale).delete()
+    MailThreadParticipant.objects.bulk_create(
+        [
+            MailThreadParticipant(thread_id=thread_id, user_id=user_id, last_activity_at=threads[thread_id].last_activity_at)
+            for thread_id, participants in users.items()
+            for user_id in participants
+        ],
+        update_conflicts=True,
+        unique_fields=['thread', 'user'],
+        update_fields=['last_activity_at'],
+    )
+
+
+def backfill(batch_size=1000):
+    """
+    Назначает переписки письмам, созданным до их появления; вернет число писем
+
+    Связей ответов у таких писем нет, поэтому письма объединяются, как в
+    почтовых клиентах, по теме без префиксов Re:/Fwd: и паре участников.
+    Письма с пустой темой получают каждое свою переписку.
+    """
+    keys = {}
+    count = 0
+    while True:
+        messages = list(
+            MailMessage.objects.filter(thread__isnull=True).order_by('created_at', 'id')
+            .only('id', 'subject', 'from_user_id', 'to_user_id', 'created_at')[:batch_size]
+        )
+        if not messages:
+            return count
+        created = []
+        for message in messages:
+            subject = normalize_subject(message.subject)
+            key = (subject.lower(), frozenset((message.from_user_id, message.to_user_id)))
+            thread = keys.get(key) if subject else None
+            if thread is None:
+                thread = MailThread(subject=subject)
+                created.append(thread)
+                if subject:
+                    keys[key] = thread
+            message.thread = thread
+        members = defaultdict(list)
+        for message in messages:
+            members[message.thread_id].append(message.pk)
+        with transaction.atomic():
+            MailThread.objects.bulk_create(created)
+            # UPDATE на переписку дешевле bulk_update с CASE WHEN на всю пачку
+            for thread_id, ids in members.items():
+                MailMessage.objects.filter(pk__in=ids).update(thread_id=thread_id)
+            refresh(members)
+        count += len(messages)
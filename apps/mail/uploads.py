@@ -0,0 +1,188 @@
+"""
+Загрузка вложений по частям с дозаписью в итоговый файл
+
+Клиент создает загрузку, затем отправляет части PUT-запросами с указанием
+смещения и завершает загрузку finalize. Тело запроса читается из потока
+блоками по CHUNK_SIZE и сразу пишется в файл по нужному смещению, поэтому
+расход памяти не зависит от размера файла. SHA-256 считается по мере записи;
+состояние хешера хранится в памяти процесса, а если следующая часть пришла в
+другой процесс (или после перезапуска), хеш досчитывается по уже записанному
+файлу один раз.
+"""
+import fcntl
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.core.files.storage import default_storage
+
+from mail.models import get_attachment_file_path
+
+# Размер блока чтения тела запроса и пересчета хеша
+CHUNK_SIZE = 64 * 1024
+
+
+class UploadConflict(Exception):
+    """
+    Часть пришла не с текущего смещения или загрузку параллельно пишет другой запрос
+    """
+
+
+class UploadTooLarge(Exception):
+    """
+    Часть выходит за объявленный размер файла
+    """
+
+
+class HasherCache:
+    """
+    Хешеры незавершенных загрузок процесса: {upload_id: (смещение, hashlib-объект)}
+
+    Объем ограничен: при вытеснении хеш при следующей части досчитывается с диска
+    """
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def pop(self, upload_id, offset):
+        with self.lock:
+            cached = self.items.pop(upload_id, None)
+        if cached is not None and cached[0] == offset:
+            return cached[1]
+        return None
+
+    def put(self, upload_id, offset, hasher):
+        with self.lock:
+            self.items[upload_id] = (offset, hasher)
+            self.items.move_to_end(upload_id)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def discard(self, upload_id):
+        with self.lock:
+            self.items.pop(upload_id, None)
+
+
+hashers = HasherCache()
+
+
+def storage_name(filename):
+    """
+    Имя итогового файла в хранилище по тем же правилам, что и у FileField вложения
+    """
+    return default_storage.generate_filename(get_attachment_file_path(None, filename))
+
+
+def create_upload_file(upload):
+    """
+    Создает пустой итоговый файл загрузки
+    """
+    path = default_storage.path(upload.file_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+
+
+def remove_upload_file(upload):
+    hashers.discard(upload.pk)
+    if upload.file_name and default_storage.exists(upload.file_name):
+        default_storage.delete(upload.file_name)
+
+
+@contextmanager
+def locked_file(upload):
+    """
+    Открывает файл загрузки с эксклюзивной блокировкой
+
+    Блокировка общая для всех процессов машины: вторая параллельная запись
+    той же загрузки сразу получает UploadConflict, а не ждет
+    """
+    fd = os.open(default_storage.path(upload.file_name), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadConflict('Загрузка уже выполняется другим запросом')
+        with os.fdopen(fd, 'r+b', closefd=False) as file:
+            yield file
+    finally:
+        os.close(fd)
+
+
+def rehash(file, length):
+    """
+    SHA-256 первых length байт файла, читается блоками
+    """
+    hasher = hashlib.sha256()
+    file.seek(0)
+    remaining = length
+    while remaining:
+        block = file.read(min(CHUNK_SIZE, remaining))
+        if not block:
+            break
+        hasher.update(block)
+        remaining -= len(block)
+    return hasher
+
+
+def get_hasher(upload, file):
+    hasher = hashers.pop(upload.pk, upload.received)
+    if hasher is None:
+        hasher = rehash(file, upload.received)
+    return hasher
+
+
+def append_chunk(upload, stream, offset, length=None):
+    """
+    Дописывает часть из потока stream в файл загрузки со смещения offset
+
+    Возвращает новое значение received. Если поток оборвался посреди части,
+    received все равно сохраняется по фактически записанным байтам, чтобы
+    клиент продолжил с этого места; исключение пробрасывается дальше.
+    """
+    if offset != upload.received:
+        raise UploadConflict(f'Ожидалось смещение {upload.received}')
+    remaining = upload.size - offset
+    if length is not None and length > remaining:
+        raise UploadTooLarge(f'Осталось загрузить {remaining} байт')
+
+    with locked_file(upload) as file:
+        # Между чтением загрузки и блокировкой файл мог дописать другой запрос
+        upload.refresh_from_db(fields=['received'])
+        if offset != upload.received:
+            raise UploadConflict(f'Ожидалось смещение {upload.received}')
+
+        hasher = get_hasher(upload, file)
+        file.seek(offset)
+        file.truncate()
+        written = 0
+        try:
+            while True:
+                block = stream.read(CHUNK_SIZE)
+                if not block:
+                    break
+                if written + len(block) > remaining:
+                    file.truncate(offset)
+                    written = 0
+                    raise UploadTooLarge(f'Осталось загрузить {remaining} байт')
+                file.write(block)
+                hasher.update(block)
+                written += len(block)
+        finally:
+            file.flush()
+            if written:
+                upload.received = offset + written
+                upload.save(update_fields=['received', 'updated_at'])
+                hashers.put(upload.pk, upload.received, hasher)
+    return upload.received
+
+
+def file_digest(upload):
+    """
+    SHA-256 полностью загруженного файла
+    """
+    with locked_file(upload) as file:
+        return get_hasher(upload, file).hexdigest()
@@ -1,16 +1,22 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from mail.views import MailViewSet, MailAttachmentViewSet, PGPKeyViewSet
+from mail.views import MailViewSet, MailThreadViewSet, MailAttachmentViewSet, AttachmentUploadViewSet, MailEventsView, PGPKeyViewSet
 
 # Создаем маршрутизатор для API
 router = DefaultRouter()
 router.register(r'pgp-keys', PGPKeyViewSet, basename='pgp-key')
+# Регистрируются до '' - иначе uploads и threads примет маршрут деталей письма
+router.register(r'attachments/uploads', AttachmentUploadViewSet, basename='mail-attachment-upload')
+router.register(r'threads', MailThreadViewSet, basename='mail-thread')
 router.register(r'', MailViewSet, basename='mail')
 router.register(r'attachments', MailAttachmentViewSet, basename='mail-attachment')
 
 
 # Определяем URL-маршруты для приложения
 urlpatterns = [
+    # Поток событий (SSE) - до маршрутов роутера, иначе events/ примет маршрут деталей письма
+    path('events/', MailEventsView.as_view(), name='mail-events'),
+
     # Добавляем все маршруты из роутера
     path('', include(router.urls)),
     
@@ -19,6 +25,13 @@ urlpatterns = [
     path('sent/', MailViewSet.as_view({'get': 'sent'}), name='mail-sent'),
     path('drafts/', MailViewSet.as_view({'get': 'drafts'}), name='mail-drafts'),
     path('trash/', MailViewSet.as_view({'get': 'trash'}), name='mail-trash'),
+    path('counters/', MailViewSet.as_view({'get': 'counters'}), name='mail-counters'),
+    path('sync/', MailViewSet.as_view({'get': 'sync'}), name='mail-sync'),
+    path('search/', MailViewSet.as_view({'get': 'search'}), name='mail-search'),
+    path('bulk/', MailViewSet.as_view({'post': 'bulk'}), name='mail-bulk'),
+    path('export/', MailViewSet.as_view({'get': 'export'}), name='mail-export'),
+    path('send-multiple/', MailViewSet.as_view({'post': 'send_multiple'}), name='mail-send-multiple'),
+    path('decrypt-batch/', MailViewSet.as_view({'post': 'decrypt_batch'}), name='mail-decrypt-batch'),
     
     # Пути для PGP-ключей
     path('pgp-keys/my_keys/', PGPKeyViewSet.as_view({'get': 'my_keys'}), name='pgp-key-my-keys'),
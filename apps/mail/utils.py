@@ -1,12 +1,7 @@
 import gnupg
 import os
-import subprocess
-import smtplib
 import logging
 import base64
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
 from django.conf import settings
 from django.core.mail import EmailMultiAlternatives
 from django.core.exceptions import ObjectDoesNotExist
@@ -16,12 +11,23 @@ from cryptography.hazmat.backends import default_backend
 from cryptography.fernet import Fernet
 import hashlib
 
+from mail.crypto import get_pool
+from mail.keygen import generate_key_material
+from mail.keyring import PublicKeyCache
+from mail.outbox import enqueue as enqueue_outbound
+from mail.postfixlog import delivery_status
+
 logger = logging.getLogger('mail_service')
 
 # Настраиваем GnuPG
 GPG_HOME = os.path.join(settings.BASE_DIR, 'gpg_home')
 os.makedirs(GPG_HOME, exist_ok=True)
 gpg = gnupg.GPG(gnupghome=GPG_HOME)
+# Тексты писем на русском: по умолчанию python-gnupg кодирует их в latin-1
+gpg.encoding = 'utf-8'
+
+# Отпечатки уже импортированных публичных ключей получателей
+public_keys = PublicKeyCache(gpg)
 
 
 def generate_pgp_key_pair(user_email, passphrase):
@@ -35,27 +41,15 @@ def generate_pgp_key_pair(user_email, passphrase):
     Returns:
         Tuple: (public_key, private_key_encrypted)
     """
-    input_data = gpg.gen_key_input(
-        name_real=user_email,
-        name_email=user_email,
-        passphrase=passphrase,
-        key_type="RSA",
-        key_length=4096,
-        expire_date=0  # Ключ не истекает
-    )
-    
-    key = gpg.gen_key(input_data)
-    
-    if not key:
+    # Ключи создаются во временном каталоге GnuPG, общий keyring не растет.
+    # В запросах используйте keygen.start_generation: создание RSA-4096 долгое
+    material = generate_key_material(user_email, user_email, passphrase)
+    
+    if material is None:
         logger.error(f"Не удалось создать ключи для {user_email}")
         return None, None
     
-    # Экспортируем публичный ключ
-    public_key = gpg.export_keys(key.fingerprint)
-    
-    # Экспортируем приватный ключ (зашифрованный парольной фразой)
-    private_key = gpg.export_keys(key.fingerprint, True, passphrase=passphrase)
-    
+    public_key, private_key, _ = material
     return public_key, private_key
 
 
@@ -152,45 +146,32 @@ def decrypt_private_key(private_key_encrypted, passphrase):
         raise ValueError("Неверный пароль или поврежденный ключ")
 
 
-def encrypt_message(content, recipient_public_key):
+def gpg_encrypt(content, recipient_public_key, binary=False):
     """
-    Шифрует сообщение с использованием публичного ключа получателя
-    
-    Args:
-        content: Содержимое сообщения для шифрования
-        recipient_public_key: Публичный ключ получателя
-        
-    Returns:
-        str: Зашифрованное сообщение
+    Шифрование в потоке пула GnuPG; см. encrypt_message
+
+    binary=True - вернуть двоичное сообщение (bytes) без armor, как оно
+    хранится в MailMessage.content_binary
     """
-    # Импортируем публичный ключ получателя
-    import_result = gpg.import_keys(recipient_public_key)
+    # Ключ импортируется в keyring только при первом шифровании в процессе
+    encrypted_data = public_keys.encrypt(content, recipient_public_key, armor=not binary)
     
-    if not import_result or not import_result.fingerprints:
+    if encrypted_data is None:
         logger.error("Не удалось импортировать ключ получателя")
         return None
     
-    # Шифруем сообщение
-    encrypted_data = gpg.encrypt(content, import_result.fingerprints[0], always_trust=True)
-    
     if not encrypted_data.ok:
         logger.error(f"Ошибка шифрования: {encrypted_data.status}")
         return None
     
+    if binary:
+        return encrypted_data.data
     return str(encrypted_data)
 
 
-def decrypt_message(encrypted_content, private_key, passphrase):
+def gpg_decrypt(encrypted_content, private_key, passphrase):
     """
-    Расшифровывает сообщение с использованием приватного ключа
-    
-    Args:
-        encrypted_content: Зашифрованное содержимое сообщения
-        private_key: Приватный ключ пользователя (зашифрованный)
-        passphrase: Пароль для расшифровки приватного ключа
-        
-    Returns:
-        str: Расшифрованное сообщение
+    Расшифровка в потоке пула GnuPG; см. decrypt_message
     """
     # Импортируем приватный ключ
     import_result = gpg.import_keys(private_key)
@@ -209,82 +190,95 @@ def decrypt_message(encrypted_content, private_key, passphrase):
     return str(decrypted_data)
 
 
-def send_email_via_postfix(from_email, to_email, subject, body, attachments=None):
+def encrypt_message(content, recipient_public_key):
+    """
+    Шифрует сообщение с использованием публичного ключа получателя
+    
+    Операция выполняется в пуле GnuPG; при перегрузке пула выбрасывается
+    CryptoBusy (HTTP 503), при превышении времени ожидания - CryptoTimeout
+    
+    Args:
+        content: Содержимое сообщения для шифрования
+        recipient_public_key: Публичный ключ получателя
+        
+    Returns:
+        str: Зашифрованное сообщение
+    """
+    return get_pool().call(gpg_encrypt, content, recipient_public_key)
+
+
+async def aencrypt_message(content, recipient_public_key):
+    """
+    Асинхронный вариант encrypt_message для ASGI view
+    """
+    return await get_pool().acall(gpg_encrypt, content, recipient_public_key)
+
+
+def decrypt_message(encrypted_content, private_key, passphrase):
+    """
+    Расшифровывает сообщение с использованием приватного ключа
+    
+    Операция выполняется в пуле GnuPG, как и encrypt_message
+    
+    Args:
+        encrypted_content: Зашифрованное содержимое сообщения
+        private_key: Приватный ключ пользователя (зашифрованный)
+        passphrase: Пароль для расшифровки приватного ключа
+        
+    Returns:
+        str: Расшифрованное сообщение
+    """
+    return get_pool().call(gpg_decrypt, encrypted_content, private_key, passphrase)
+
+
+async def adecrypt_message(encrypted_content, private_key, passphrase):
+    """
+    Асинхронный вариант decrypt_message для ASGI view
+    """
+    return await get_pool().acall(gpg_decrypt, encrypted_content, private_key, passphrase)
+
+
+def import_public_key(public_key):
+    """
+    Импортирует публичный ключ в keyring через пул; возвращает отпечаток или None
+    """
+    return get_pool().call(public_keys.fingerprint, public_key)
+
+
+def send_email_via_postfix(from_email, to_email, subject, body, attachments=None, message=None):
     """
     Отправка письма через Postfix
     
+    Письмо ставится в очередь (mail.outbox) и отправляется воркером
+    mail_outbox_worker; статус доставки - в записи OutboundEmail
+    
     Args:
         from_email: Email отправителя
         to_email: Email получателя
         subject: Тема письма
         body: Тело письма
         attachments: Список путей к файлам вложений
+        message: MailMessage, к которому относится письмо
         
     Returns:
-        bool: Успешность отправки
+        OutboundEmail: Запись в очереди отправки
     """
-    try:
-        msg = MIMEMultipart()
-        msg['From'] = from_email
-        msg['To'] = to_email
-        msg['Subject'] = subject
-        
-        # Добавляем тело письма
-        msg.attach(MIMEText(body, 'html'))
-        
-        # Добавляем вложения, если есть
-        if attachments:
-            for attachment_path in attachments:
-                if os.path.exists(attachment_path):
-                    with open(attachment_path, 'rb') as file:
-                        part = MIMEApplication(file.read(), Name=os.path.basename(attachment_path))
-                        part['Content-Disposition'] = f'attachment; filename="{os.path.basename(attachment_path)}"'
-                        msg.attach(part)
-        
-        # Отправляем через локальный Postfix
-        smtp = smtplib.SMTP('localhost')
-        smtp.send_message(msg)
-        smtp.quit()
-        
-        logger.info(f"Письмо успешно отправлено от {from_email} к {to_email}")
-        return True
-    except Exception as e:
-        logger.error(f"Ошибка отправки письма: {str(e)}")
-        return False
+    outbound = enqueue_outbound(from_email, to_email, subject, body, attachments, message)
+    logger.info(f"Письмо от {from_email} к {to_email} поставлено в очередь отправки: {outbound.pk}")
+    return outbound
 
 
 def check_email_delivery_status(message_id):
     """
     Проверка статуса доставки письма в логах Postfix
     
+    Статусы берутся из таблицы, которую заполняет индексатор лога
+    (команда mail_postfix_index), а не поиском по самому логу
+    
     Args:
         message_id: ID письма в Postfix
         
     Returns:
         str: Статус доставки (delivered, bounced, deferred, unknown)
     """
-    try:
-        # Ищем в логах Postfix информацию о письме
-        result = subprocess.run(
-            ["grep", message_id, "/var/log/mail.log"],
-            capture_output=True, text=True
-        )
-        
-        log_entries = result.stdout.strip().split('\n')
-        
-        if not log_entries or log_entries == ['']:
-            return "unknown"
-        
-        # Анализируем логи для определения статуса
-        for entry in log_entries:
-            if "status=sent" in entry:
-                return "delivered"
-            elif "status=bounced" in entry:
-                return "bounced"
-            elif "status=deferred" in entry:
-                return "deferred"
-        
-        return "unknown"
-    except Exception as e:
-        logger.error(f"Ошибка проверки статуса доставки: {str(e)}")
-        return "unknown" 
\ No newline at end of file
+    return delivery_status(message_id)
@@ -1,28 +1,55 @@
-from rest_framework import viewsets, permissions, status, filters, parsers
+from rest_framework import viewsets, mixins, permissions, status, filters, parsers
 from rest_framework.decorators import action
+from rest_framework.exceptions import APIException, ValidationError
+from rest_framework.generics import get_object_or_404
 from rest_framework.response import Response
 from django_filters.rest_framework import DjangoFilterBackend
-from mail.models import MailMessage, MailAttachment, PGPKey
+from mail import armor, blobs, bulk, crypto, downloads, events, export, keygen, keysessions, links, mailbox, uploads
+from mail.models import (
+    MailMessage, MailThread, MailThreadParticipant, MailAttachment, AttachmentUpload,
+    MailboxCounters, MailChange, PGPKey, PGPKeyJob
+)
+from mail.pagination import MailFolderPagination, MailSearchPagination, MailThreadPagination
+from mail.utils import gpg_encrypt
 from mail.serializers import (
     MailMessageSerializer, MailMessageListSerializer, 
-    MailAttachmentSerializer, MailAttachmentUploadSerializer,
-    PGPKeySerializer, PGPKeyCreateSerializer
+    MailAttachmentSerializer, MailAttachmentUploadSerializer, AttachmentUploadSerializer,
+    MailboxCountersSerializer, MailSyncMessageSerializer, MailDecryptBatchSerializer, MailFanOutSerializer, MailBulkSerializer,
+    MailSearchSerializer, MailExportSerializer, MailThreadSerializer, MailThreadDetailSerializer,
+    PGPKeySerializer, PGPKeyCreateSerializer, PGPKeyGenerateSerializer, PGPKeyJobSerializer
 )
-from django.db import models, transaction
+from django.db import transaction
+from django.db.models import Prefetch, prefetch_related_objects
 from django.contrib.auth import get_user_model
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.utils import timezone
+from django.views import View
+from asgiref.sync import sync_to_async
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+import asyncio
+import io
+import json
+import re
 
 
 class MailAttachmentViewSet(viewsets.ModelViewSet):
     """
     API endpoint для работы с вложениями писем
     """
-    queryset = MailAttachment.objects.all()
     serializer_class = MailAttachmentSerializer
     permission_classes = [permissions.IsAuthenticated]
     # Добавляем поддержку загрузки файлов через FormData
     parser_classes = [parsers.MultiPartParser, parsers.FormParser]
     
+    def get_queryset(self):
+        """
+        Только вложения, загруженные пользователем или из его писем
+        """
+        return MailAttachment.objects.accessible_to(self.request.user)
+    
     def get_serializer_class(self):
         """
         Использовать разные сериализаторы для списка и деталей
@@ -61,7 +88,7 @@ class MailAttachmentViewSet(viewsets.ModelViewSet):
         attachments = []
         with transaction.atomic():
             for file_obj in files:
-                serializer = MailAttachmentUploadSerializer(data={'file': file_obj})
+                serializer = MailAttachmentUploadSerializer(data={'file': file_obj}, context={'request': request})
                 serializer.is_valid(raise_exception=True)
                 attachment = serializer.save()
                 attachments.append(attachment)
@@ -74,6 +101,16 @@ class MailAttachmentViewSet(viewsets.ModelViewSet):
             status=status.HTTP_201_CREATED
         )
     
+    @action(detail=True, methods=['get'])
+    def download(self, request, pk=None):
+        """
+        Скачивание файла вложения участником письма или автором загрузки
+
+        Поддерживаются Range и If-None-Match; при настроенном
+        MAIL_ATTACHMENT_SENDFILE передачу выполняет nginx/Apache
+        """
+        return downloads.attachment_response(request, self.get_object())
+    
     def destroy(self, request, *args, **kwargs):
         """
         Удаление вложения
@@ -93,6 +130,186 @@ class MailAttachmentViewSet(viewsets.ModelViewSet):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+class AttachmentUploadViewSet(mixins.CreateModelMixin,
+                              mixins.RetrieveModelMixin,
+                              mixins.DestroyModelMixin,
+                              viewsets.GenericViewSet):
+    """
+    API endpoint для загрузки вложений по частям с возможностью продолжения
+
+    POST   uploads/                  - создать загрузку (filename, size, content_type, sha256)
+    PUT    uploads/{id}/             - дописать часть; смещение в заголовке Upload-Offset
+                                       или Content-Range: bytes start-end/total, тело - байты файла
+    GET    uploads/{id}/             - текущее смещение, чтобы продолжить прерванную загрузку
+    POST   uploads/{id}/finalize/    - проверить размер и SHA-256 и создать вложение
+    DELETE uploads/{id}/             - отменить загрузку
+    """
+    serializer_class = AttachmentUploadSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    content_range_pattern = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+    def get_queryset(self):
+        return AttachmentUpload.objects.filter(user=self.request.user)
+
+    def perform_create(self, serializer):
+        upload = serializer.save(
+            user=self.request.user,
+            file_name=uploads.storage_name(serializer.validated_data['filename'])
+        )
+        uploads.create_upload_file(upload)
+
+    def get_chunk_position(self, request):
+        """
+        Смещение и длина части из заголовков Upload-Offset / Content-Range
+        """
+        length = request.headers.get('Content-Length')
+        length = int(length) if length and length.isdigit() else None
+
+        content_range = request.headers.get('Content-Range')
+        if content_range:
+            match = self.content_range_pattern.match(content_range)
+            if not match:
+                return None, length
+            start, end = int(match.group(1)), int(match.group(2))
+            return start, end - start + 1
+
+        offset = request.headers.get('Upload-Offset')
+        if offset is None or not offset.isdigit():
+            return None, length
+        return int(offset), length
+
+    def update(self, request, pk=None):
+        """
+        Дописывает часть файла из тела запроса
+        """
+        upload = self.get_object()
+        if upload.status != 'uploading':
+            return Response({"error": "Загрузка уже завершена"}, status=status.HTTP_400_BAD_REQUEST)
+
+        offset, length = self.get_chunk_position(request)
+        if offset is None:
+            return Response(
+                {"error": "Укажите смещение в заголовке Upload-Offset или Content-Range"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            received = uploads.append_chunk(upload, request.stream or io.BytesIO(), offset, length)
+        except uploads.UploadConflict as error:
+            return self.offset_response(upload, {"error": str(error)}, status.HTTP_409_CONFLICT)
+        except uploads.UploadTooLarge as error:
+            return self.offset_response(upload, {"error": str(error)}, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        return self.offset_response(upload, {"offset": received, "size": upload.size})
+
+    def offset_response(self, upload, data, status_code=status.HTTP_200_OK):
+        response = Response(data, status=status_code)
+        response['Upload-Offset'] = str(upload.received)
+        return response
+
+    def retrieve(self, request, *args, **kwargs):
+        upload = self.get_object()
+        return self.offset_response(upload, self.get_serializer(upload).data)
+
+    @action(detail=True, methods=['post'])
+    def finalize(self, request, pk=None):
+        """
+        Завершает загрузку: проверяет размер и контрольную сумму и создает MailAttachment
+        """
+        upload = self.get_object()
+        if upload.status == 'complete':
+            return Response(
+                MailAttachmentSerializer(upload.attachment, context={'request': request}).data
+            )
+        if upload.received != upload.size:
+            return self.offset_response(
+                upload,
+                {"error": f"Загружено {upload.received} из {upload.size} байт"},
+                status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            digest = uploads.file_digest(upload)
+        except uploads.UploadConflict as error:
+            return self.offset_response(upload, {"error": str(error)}, status.HTTP_409_CONFLICT)
+        if upload.sha256 and digest != upload.sha256:
+            return Response(
+                {"error": "Контрольная сумма файла не совпадает", "sha256": digest},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        with transaction.atomic():
+            # Одинаковое содержимое хранится один раз: дубликат заменяется ссылкой на блоб
+            blob = blobs.store_file(upload.file_name, digest, upload.size)
+            attachment = MailAttachment.objects.create(
+                file=blob.file.name,
+                blob=blob,
+                filename=upload.filename,
+                file_size=upload.size,
+                content_type=upload.content_type,
+                uploaded_by=request.user
+            )
+            upload.attachment = attachment
+            upload.status = 'complete'
+            upload.sha256 = digest
+            upload.file_name = blob.file.name
+            upload.save(update_fields=['attachment', 'status', 'sha256', 'file_name', 'updated_at'])
+        uploads.hashers.discard(upload.pk)
+
+        return Response(
+            MailAttachmentSerializer(attachment, context={'request': request}).data,
+            status=status.HTTP_201_CREATED
+        )
+
+    def perform_destroy(self, instance):
+        # Файл завершенной загрузки принадлежит вложению
+        if instance.status == 'uploading':
+            uploads.remove_upload_file(instance)
+        instance.delete()
+
+
+class MailThreadViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    API endpoint для переписок пользователя
+
+    GET threads/       - переписки по убыванию последней активности, страницы по курсору
+                         (?cursor=..., ?page_size=...) прямо по строкам участников
+    GET threads/{id}/  - переписка с письмами, которые видит пользователь, от старых к новым
+    """
+    serializer_class = MailThreadSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    pagination_class = MailThreadPagination
+
+    def get_participants_prefetch(self):
+        return Prefetch('participants', queryset=MailThreadParticipant.objects.select_related('user'))
+
+    def get_queryset(self):
+        return MailThread.objects.filter(participants__user=self.request.user).prefetch_related(
+            self.get_participants_prefetch()
+        )
+
+    def get_serializer_class(self):
+        if self.action == 'retrieve':
+            return MailThreadDetailSerializer
+        return MailThreadSerializer
+
+    def list(self, request, *args, **kwargs):
+        """
+        Страница переписок: строки участника по индексу (user, last_activity_at, id)
+        вместе с переписками через JOIN и участники одним запросом prefetch
+        """
+        rows = MailThreadParticipant.objects.filter(user=request.user).select_related('thread')
+        page = self.paginate_queryset(rows)
+        threads = [row.thread for row in page]
+        prefetch_related_objects(threads, self.get_participants_prefetch())
+        return self.get_paginated_response(self.get_serializer(threads, many=True).data)
+
+    def retrieve(self, request, *args, **kwargs):
+        thread = self.get_object()
+        thread.conversation_messages = list(MailMessage.objects.conversation(thread, request.user).for_listing())
+        return Response(self.get_serializer(thread).data)
+
+
 class MailViewSet(viewsets.ModelViewSet):
     """
     API endpoint для управления почтовыми сообщениями
@@ -103,95 +320,157 @@ class MailViewSet(viewsets.ModelViewSet):
     ordering_fields = ['created_at']
     ordering = ['-created_at']
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = MailFolderPagination
+
+    # Действия, которые отдают списки сообщений через MailMessageListSerializer
+    list_actions = ['list', 'inbox', 'sent', 'drafts', 'trash']
+    # Действия, поддерживающие keyset-пагинацию (?cursor=... или ?pagination=cursor)
+    cursor_actions = ['list', 'inbox', 'sent', 'drafts', 'trash']
+    # Размер страницы журнала изменений в sync по умолчанию и максимальный
+    sync_limit = 200
+    sync_max_limit = 1000
 
     def get_queryset(self):
         """
         Возвращает сообщения в зависимости от типа запроса (входящие/исходящие/черновики/корзина)
+
+        Для папок inbox/sent/drafts/trash берется условие одноименной папки,
+        изменять можно только свои черновики, для остальных действий - все
+        сообщения, связанные с пользователем
         """
-        user = self.request.user
-        
-        # Проверяем, является ли действие получением отдельного элемента
-        if self.action == 'retrieve':
-            # Для получения отдельного сообщения используем простой фильтр без union()
-            return MailMessage.objects.filter(
-                models.Q(from_user=user) | models.Q(to_user=user)
-            )
-        
-        # Определяем базовый queryset для текущего действия
-        if self.action == 'inbox':
-            # Входящие сообщения: получатель - текущий пользователь, не черновик, не в корзине
-            return MailMessage.objects.filter(
-                to_user=user, 
-                is_draft=False,
-                is_deleted_by_recipient=False
-            )
-        elif self.action == 'sent':
-            # Отправленные: отправитель - текущий пользователь, не черновик, не в корзине
-            return MailMessage.objects.filter(
-                from_user=user, 
-                is_draft=False,
-                is_deleted_by_sender=False
-            )
-        elif self.action == 'drafts':
-            # Черновики: отправитель - текущий пользователь, черновик, не в корзине
-            return MailMessage.objects.filter(
-                from_user=user, 
-                is_draft=True,
-                is_deleted_by_sender=False
-            )
-        elif self.action == 'trash':
-            # Корзина: сообщения, удаленные пользователем (отправленные или полученные)
-            sent_deleted = MailMessage.objects.filter(
-                from_user=user, 
-                is_deleted_by_sender=True
-            )
-            received_deleted = MailMessage.objects.filter(
-                to_user=user, 
-                is_deleted_by_recipient=True
-            )
-            return sent_deleted.union(received_deleted)
-        else:
-            # По умолчанию: все сообщения, связанные с пользователем
-            sent = MailMessage.objects.filter(from_user=user)
-            received = MailMessage.objects.filter(to_user=user)
-            return sent.union(received)
+        if self.action in ('update', 'partial_update'):
+            return MailMessage.objects.filter(from_user=self.request.user, is_draft=True)
+        messages = MailMessage.objects.folder(self.action, self.request.user)
+
+        # Для списков сразу подгружаем участников и признак вложений,
+        # чтобы страница папки читалась фиксированным числом запросов
+        if self.action in self.list_actions:
+            messages = messages.for_listing()
+        elif self.action == 'retrieve':
+            messages = messages.select_related('from_user', 'to_user').prefetch_related('attachments')
+        return messages
 
     def get_serializer_class(self):
         """
         Использовать разные сериализаторы для списка и деталей
         """
-        if self.action in ['list', 'inbox', 'sent', 'drafts', 'trash']:
+        if self.action in self.list_actions:
             return MailMessageListSerializer
         return MailMessageSerializer
 
     def perform_create(self, serializer):
         """
         Автоматически установить отправителя как текущего пользователя
+
+        Вложения из attachments_meta связываются с письмом одной вставкой;
+        связать можно только вложения, доступные отправителю
         """
-        message = serializer.save(from_user=self.request.user)
-        
-        # Обработка вложений, если они были переданы
-        attachments_meta = serializer.validated_data.get('attachments_meta', [])
-        if attachments_meta:
-            print(f"Обрабатываем вложения для сообщения {message.id}: {attachments_meta}")
-            
-            # Прикрепляем вложения к сообщению по их ID, если они существуют
-            for attachment_data in attachments_meta:
-                attachment_id = attachment_data.get('id')
-                if attachment_id:
-                    try:
-                        attachment = MailAttachment.objects.get(id=attachment_id)
-                        message.attachments.add(attachment)
-                        print(f"Вложение {attachment_id} успешно прикреплено к сообщению {message.id}")
-                    except MailAttachment.DoesNotExist:
-                        print(f"Вложение с ID {attachment_id} не найдено")
-                    except Exception as e:
-                        print(f"Ошибка при прикреплении вложения {attachment_id}: {str(e)}")
+        with mailbox.track() as transition:
+            message = serializer.save(from_user=self.request.user)
+            links.link([message], MailAttachment.objects.accessible_to(self.request.user))
+            transition.add(message)
+
+    @action(detail=False, methods=['post'], url_path='send-multiple')
+    def send_multiple(self, request):
+        """
+        Отправка письма нескольким получателям одним запросом
+
+        Получатели и их ключи читаются одним запросом, текст шифруется ключом
+        каждого получателя параллельно в пуле crypto, копии письма создаются
+        одним bulk_create, а общие вложения связываются одной вставкой в M2M.
+        Ответ - результат по каждому получателю: message_id или error
+        (not_found, no_public_key, encryption_failed, timeout).
+        """
+        serializer = MailFanOutSerializer(data=request.data, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        recipient_ids = data['recipient_ids']
+        attachments = data['attachment_ids']
+
+        recipients = {
+            recipient.id: recipient
+            for recipient in get_user_model().objects.filter(id__in=recipient_ids).select_related('pgp_key')
+        }
+        results = {}
+        contents = {}
+        for recipient_id in recipient_ids:
+            recipient = recipients.get(recipient_id)
+            if recipient is None:
+                results[str(recipient_id)] = {"error": "not_found"}
+            elif not data['is_encrypted']:
+                contents[recipient_id] = data['content']
+            elif not hasattr(recipient, 'pgp_key'):
+                results[str(recipient_id)] = {"error": "no_public_key"}
+
+        if data['is_encrypted']:
+            encrypt_for = [recipient_id for recipient_id in recipient_ids if str(recipient_id) not in results]
+            outcomes = crypto.get_pool().map(
+                lambda recipient_id: gpg_encrypt(data['content'], recipients[recipient_id].pgp_key.public_key, binary=True),
+                encrypt_for
+            )
+            for recipient_id, (encrypted, error) in zip(encrypt_for, outcomes):
+                if error is not None and not isinstance(error, crypto.CryptoTimeout):
+                    raise error
+                if error is not None:
+                    results[str(recipient_id)] = {"error": "timeout"}
+                elif encrypted is None:
+                    results[str(recipient_id)] = {"error": "encryption_failed"}
                 else:
-                    print(f"Отсутствует ID вложения в данных: {attachment_data}")
-            
-            # Сохраняем сообщение еще раз после связывания вложений
-            message.save()
+                    contents[recipient_id] = encrypted
+
+        attachments_meta = [
+            {
+                'id': str(attachment.id),
+                'name': attachment.filename,
+                'size': attachment.file_size,
+                'type': attachment.content_type,
+            }
+            for attachment in attachments
+        ]
+        messages = [
+            MailMessage(
+                from_user=request.user,
+                to_user=recipients[recipient_id],
+                subject=data['subject'],
+                # Зашифрованное тело хранится двоично, без armor
+                content_encrypted='' if data['is_encrypted'] else contents[recipient_id],
+                content_binary=contents[recipient_id] if data['is_encrypted'] else None,
+                is_encrypted=data['is_encrypted'],
+                attachments_meta=attachments_meta,
+            )
+            for recipient_id in recipient_ids if recipient_id in contents
+        ]
+        if messages:
+            with mailbox.track() as transition:
+                MailMessage.objects.bulk_create(messages)
+                transition.add(*messages)
+                MailMessage.attachments.through.objects.bulk_create([
+                    MailMessage.attachments.through(mailmessage_id=message.id, mailattachment_id=attachment.id)
+                    for message in messages
+                    for attachment in attachments
+                ])
+        for message in messages:
+            results[str(message.to_user_id)] = {"message_id": str(message.id)}
+
+        response_status = status.HTTP_201_CREATED if messages else status.HTTP_400_BAD_REQUEST
+        return Response(
+            {"results": {str(recipient_id): results[str(recipient_id)] for recipient_id in recipient_ids}},
+            status=response_status
+        )
+
+    def perform_update(self, serializer):
+        """
+        Изменение черновика (в том числе его отправка) учитывается в счетчиках папок
+
+        get_queryset отдает для изменения только черновики отправителя, поэтому
+        счетчики меняются только у его папок и у получателя при отправке, а
+        вложения связываются из доступных отправителю
+        """
+        with mailbox.track([serializer.instance], action='updated'):
+            message = serializer.save()
+            # Черновик мог получить новые вложения
+            if 'attachments_meta' in serializer.validated_data:
+                links.link([message], MailAttachment.objects.accessible_to(self.request.user))
     
     @action(detail=False, methods=['get'])
     def inbox(self, request):
@@ -265,12 +544,13 @@ class MailViewSet(viewsets.ModelViewSet):
         user = request.user
         
         # Помечаем сообщение как удаленное для текущего пользователя
-        if message.from_user.id == user.id:
-            message.is_deleted_by_sender = True
-            message.save()
-        elif message.to_user.id == user.id:
-            message.is_deleted_by_recipient = True
-            message.save()
+        with mailbox.track([message]):
+            if message.from_user_id == user.id:
+                message.is_deleted_by_sender = True
+                message.save()
+            elif message.to_user_id == user.id:
+                message.is_deleted_by_recipient = True
+                message.save()
         
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -283,12 +563,13 @@ class MailViewSet(viewsets.ModelViewSet):
         user = request.user
         
         # Восстанавливаем сообщение для текущего пользователя
-        if message.from_user.id == user.id:
-            message.is_deleted_by_sender = False
-            message.save()
-        elif message.to_user.id == user.id:
-            message.is_deleted_by_recipient = False
-            message.save()
+        with mailbox.track([message]):
+            if message.from_user_id == user.id:
+                message.is_deleted_by_sender = False
+                message.save()
+            elif message.to_user_id == user.id:
+                message.is_deleted_by_recipient = False
+                message.save()
         
         return Response({"message": "Сообщение восстановлено"}, status=status.HTTP_200_OK)
 
@@ -301,14 +582,15 @@ class MailViewSet(viewsets.ModelViewSet):
         user = request.user
         
         # Проверяем, находится ли сообщение в корзине
-        if (message.from_user.id == user.id and message.is_deleted_by_sender) or \
-           (message.to_user.id == user.id and message.is_deleted_by_recipient):
+        if (message.from_user_id == user.id and message.is_deleted_by_sender) or \
+           (message.to_user_id == user.id and message.is_deleted_by_recipient):
             # Если удалено и отправителем и получателем, или одно из них не существует
             if (message.is_deleted_by_sender and message.is_deleted_by_recipient) or \
-               (message.is_deleted_by_sender and not message.to_user) or \
-               (message.is_deleted_by_recipient and not message.from_user):
+               (message.is_deleted_by_sender and not message.to_user_id) or \
+               (message.is_deleted_by_recipient and not message.from_user_id):
                 # Удаляем сообщение полностью
-                message.delete()
+                with mailbox.track([message]):
+                    message.delete()
                 return Response(status=status.HTTP_204_NO_CONTENT)
         
         return Response(
@@ -316,33 +598,263 @@ class MailViewSet(viewsets.ModelViewSet):
             status=status.HTTP_400_BAD_REQUEST
         )
 
-    def retrieve(self, request, *args, **kwargs):
+    @action(detail=False, methods=['get'])
+    def search(self, request):
         """
-        Получение отдельного сообщения с подробной информацией о вложениях
+        Поиск писем пользователя по теме и участникам (?q=...)
+
+        Результаты упорядочены по релевантности и отдаются страницами по курсору
+        (?cursor=..., ?page_size=...), как папки в режиме ?pagination=cursor
         """
-        instance = self.get_object()
-        
-        # Логируем информацию о вложениях для отладки
-        print(f"ID сообщения: {instance.id}")
-        print(f"Число вложений (attachments): {instance.attachments.count()}")
-        print(f"Вложения (attachments_meta): {instance.attachments_meta}")
+        serializer = MailSearchSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        paginator = MailSearchPagination()
+        page = paginator.paginate_search(request, request.user, serializer.validated_data['q'])
+        data = MailMessageListSerializer(page, many=True, context=self.get_serializer_context()).data
+        return paginator.get_paginated_response(data)
+
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        """
+        Выгрузка писем пользователя в mbox или zip (?archive=mbox|zip, ?folder=, ?since=, ?until=)
+
+        Ответ отдается потоком: письма читаются keyset-страницами, тела - как
+        хранятся (зашифрованные остаются OpenPGP), вложения - с диска блоками
+        """
+        serializer = MailExportSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        messages = export.iter_export_messages(
+            request.user, data.get('folder'), data.get('since'), data.get('until')
+        )
+        domain = request.get_host().split(':')[0]
+        name = f"mail-{data.get('folder', 'all')}-{timezone.localdate():%Y-%m-%d}"
+        if data['archive'] == 'zip':
+            response = StreamingHttpResponse(export.iter_zip(messages, request.user, domain), content_type='application/zip')
+            name += '.zip'
+        else:
+            response = StreamingHttpResponse(export.iter_mbox(messages, domain), content_type='application/mbox')
+            name += '.mbox'
+        response['Content-Disposition'] = f'attachment; filename="{name}"'
+        return response
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """
+        Массовое действие над письмами: trash, restore, purge, read, unread
+
+        Письма задаются списком ids или целой папкой (folder). Действие
+        выполняется несколькими UPDATE/DELETE по тем же правилам, что и
+        одиночные destroy, restore, permanent_delete, read и unread; письма,
+        которые действие не меняет, пропускаются. Чужие и несуществующие id
+        возвращаются в not_found.
+        """
+        serializer = MailBulkSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+
+        if 'folder' in data:
+            messages = MailMessage.objects.folder(data['folder'], request.user)
+            not_found = []
+        else:
+            messages = MailMessage.objects.visible_to(request.user).filter(id__in=data['ids'])
+            found = set(messages.values_list('id', flat=True))
+            not_found = [str(message_id) for message_id in data['ids'] if message_id not in found]
+
+        result = bulk.apply(data['action'], messages, request.user)
+        return Response({"action": data['action'], **result, "not_found": not_found})
+
+    @action(detail=True, methods=['post'])
+    def read(self, request, pk=None):
+        """
+        Отметить полученное сообщение как прочитанное
+        """
+        return self.set_read_state(self.get_object(), True)
+
+    @action(detail=True, methods=['post'])
+    def unread(self, request, pk=None):
+        """
+        Отметить полученное сообщение как непрочитанное
+        """
+        return self.set_read_state(self.get_object(), False)
+
+    def set_read_state(self, message, is_read):
+        """
+        Меняет отметку о прочтении; доступно только получателю сообщения
+        """
+        if message.to_user_id != self.request.user.id:
+            return Response(
+                {"error": "Отметка о прочтении доступна только получателю"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
         
-        # Загружаем связанные вложения, если они есть
-        if not instance.attachments.exists() and instance.attachments_meta:
-            # Если у сообщения есть мета-информация о вложениях, но нет связей с моделями MailAttachment
-            # Попробуем восстановить связи по ID в attachments_meta
-            for attachment_data in instance.attachments_meta:
-                attachment_id = attachment_data.get('id')
-                if attachment_id:
-                    try:
-                        attachment = MailAttachment.objects.get(id=attachment_id)
-                        instance.attachments.add(attachment)
-                        print(f"Восстановлена связь с вложением: {attachment_id}")
-                    except MailAttachment.DoesNotExist:
-                        print(f"Вложение не найдено: {attachment_id}")
+        if message.is_read != is_read:
+            with mailbox.track([message]):
+                message.is_read = is_read
+                message.read_at = timezone.now() if is_read else None
+                message.save(update_fields=['is_read', 'read_at'])
         
-        serializer = self.get_serializer(instance)
-        return Response(serializer.data)
+        return Response({"is_read": message.is_read, "read_at": message.read_at})
+
+    @action(detail=True, methods=['get'])
+    def content(self, request, pk=None):
+        """
+        Зашифрованное тело письма двоичным OpenPGP-сообщением, без armor
+
+        Для клиентов, которые читают двоичные сообщения (openpgp.readMessage
+        с binaryMessage): ответ на треть меньше content_encrypted из деталей письма
+        """
+        message = self.get_object()
+        if not message.is_encrypted:
+            return Response({"error": "Письмо не зашифровано"}, status=status.HTTP_400_BAD_REQUEST)
+        payload = message.encrypted_payload()
+        if isinstance(payload, str):
+            # Письмо старого формата, еще не перенесенное mail_body_backfill
+            try:
+                payload = armor.dearmor(payload)
+            except ValueError:
+                return Response({"error": "Тело письма повреждено"}, status=status.HTTP_400_BAD_REQUEST)
+        return HttpResponse(payload, content_type='application/octet-stream')
+
+    @action(detail=True, methods=['post'])
+    def decrypt(self, request, pk=None):
+        """
+        Расшифровка сообщения ключом активной PGP сессии пользователя
+
+        Если этот воркер еще не разблокировал ключ сессии, можно передать
+        passphrase - ключ разблокируется и останется в памяти до конца сессии
+        """
+        message = self.get_object()
+        unlocked = self.get_unlocked_key(request)
+        try:
+            content = crypto.get_pool().call(unlocked.decrypt, message.encrypted_payload())
+        except keysessions.DecryptionFailed as e:
+            return Response(
+                {"error": f"Не удалось расшифровать сообщение: {e}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response({"id": str(message.id), "content": content})
+
+    @action(detail=False, methods=['post'], url_path='decrypt-batch')
+    def decrypt_batch(self, request):
+        """
+        Расшифровка пачки писем (например, страницы папки) одним запросом
+
+        Письма расшифровываются параллельно в пуле crypto ключом сессии.
+        Ошибка одного письма не прерывает пачку: в results у него вместо
+        content будет error. Письма, где пользователь не участник, - not_found.
+        """
+        serializer = MailDecryptBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids = serializer.validated_data['ids']
+        unlocked = self.get_unlocked_key(request)
+
+        contents = {
+            message.id: message.encrypted_payload()
+            for message in self.get_queryset().filter(id__in=ids).only('id', 'content_encrypted', 'content_binary')
+        }
+        found = [message_id for message_id in ids if message_id in contents]
+        outcomes = crypto.get_pool().map(unlocked.decrypt, [contents[message_id] for message_id in found])
+        decrypted = dict(zip(found, outcomes))
+
+        results = []
+        for message_id in ids:
+            item = {"id": str(message_id)}
+            if message_id not in decrypted:
+                item["error"] = "not_found"
+            else:
+                content, error = decrypted[message_id]
+                if error is None:
+                    item["content"] = content
+                elif isinstance(error, keysessions.DecryptionFailed):
+                    item["error"] = "decryption_failed"
+                elif isinstance(error, crypto.CryptoTimeout):
+                    item["error"] = "timeout"
+                else:
+                    raise error
+            results.append(item)
+        return Response({"results": results})
+
+    def get_unlocked_key(self, request):
+        """
+        Разблокированный ключ пользователя; без активной сессии - 403 session_locked
+        """
+        try:
+            pgp_key = PGPKey.objects.get(user=request.user)
+        except PGPKey.DoesNotExist:
+            raise keysessions.SessionLocked()
+        try:
+            return keysessions.get_unlocked_key(pgp_key, request.data.get('passphrase'))
+        except ValueError:
+            raise ValidationError({"passphrase": "Неверный пароль от приватного ключа"})
+
+    @action(detail=False, methods=['get'])
+    def counters(self, request):
+        """
+        Счетчики писем и непрочитанных по папкам без подсчета по таблице сообщений
+        """
+        counters = MailboxCounters.objects.filter(user=request.user).first()
+        if counters is None:
+            # Строка создается при первом письме пользователя
+            counters = MailboxCounters(user=request.user)
+        return Response(MailboxCountersSerializer(counters).data)
+
+    @action(detail=False, methods=['get'])
+    def sync(self, request):
+        """
+        Дельта-синхронизация: изменения писем пользователя после ?since=<seq>
+
+        Без since возвращается только текущий курсор - клиент загружает папки
+        обычными запросами и дальше запрашивает изменения от этого курсора.
+        Несколько изменений одного письма схлопываются в последнее. Письма,
+        которых больше нет ни в одной папке пользователя, попадают в removed.
+        """
+        user = request.user
+        changes = MailChange.objects.filter(user=user)
+
+        since = request.query_params.get('since')
+        if since in (None, ''):
+            latest = changes.order_by('-seq').values_list('seq', flat=True).first()
+            return Response({'cursor': latest or 0, 'has_more': False, 'changes': [], 'removed': []})
+
+        try:
+            since = int(since)
+            limit = int(request.query_params.get('limit', self.sync_limit))
+        except ValueError:
+            return Response(
+                {"error": "since и limit должны быть целыми числами"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        limit = min(max(limit, 1), self.sync_max_limit)
+
+        page = list(changes.filter(seq__gt=since).order_by('seq').values_list('seq', 'message_id', 'action')[:limit + 1])
+        has_more = len(page) > limit
+        page = page[:limit]
+
+        # Последнее изменение каждого письма в пределах страницы
+        latest = {message_id: (seq, change) for seq, message_id, change in page}
+        messages = MailMessage.objects.visible_to(user).for_listing().filter(id__in=latest)
+
+        changed = []
+        for message in messages:
+            folders = mailbox.folders_of(mailbox.message_contributions(mailbox.get_state(message)).get(user.id, ()))
+            if not folders:
+                continue
+            message.seq, message.change = latest.pop(message.id)
+            message.folders = folders
+            changed.append(message)
+        changed.sort(key=lambda message: message.seq)
+
+        removed = [
+            {'id': str(message_id), 'seq': seq}
+            for message_id, (seq, change) in sorted(latest.items(), key=lambda item: item[1][0])
+        ]
+        return Response({
+            'cursor': page[-1][0] if page else since,
+            'has_more': has_more,
+            'changes': MailSyncMessageSerializer(changed, many=True, context=self.get_serializer_context()).data,
+            'removed': removed,
+        })
 
 
 class PGPKeyViewSet(viewsets.ModelViewSet):
@@ -369,6 +881,10 @@ class PGPKeyViewSet(viewsets.ModelViewSet):
         """
         if self.action in ['create', 'update', 'partial_update']:
             return PGPKeyCreateSerializer
+        if self.action == 'generate':
+            return PGPKeyGenerateSerializer
+        if self.action == 'job':
+            return PGPKeyJobSerializer
         return PGPKeySerializer
     
     def create(self, request, *args, **kwargs):
@@ -379,6 +895,32 @@ class PGPKeyViewSet(viewsets.ModelViewSet):
         serializer.is_valid(raise_exception=True)
         serializer.save(user=self.request.user)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['post'])
+    def generate(self, request):
+        """
+        Создание пары ключей на сервере
+
+        Если в запасе есть готовая пара, она выдается сразу (201). Иначе
+        ставится задание для mail_keyworker (202), статус - GET jobs/{id}/
+        """
+        active = PGPKeyJob.objects.filter(user=request.user, status__in=['pending', 'running']).first()
+        if active is not None:
+            return Response(PGPKeyJobSerializer(active).data, status=status.HTTP_202_ACCEPTED)
+
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        job = keygen.start_generation(request.user, serializer.validated_data['passphrase'])
+        response_status = status.HTTP_201_CREATED if job.status == 'done' else status.HTTP_202_ACCEPTED
+        return Response(PGPKeyJobSerializer(job).data, status=response_status)
+
+    @action(detail=False, methods=['get'], url_path=r'jobs/(?P<job_id>[^/.]+)')
+    def job(self, request, job_id=None):
+        """
+        Статус задания на создание ключей
+        """
+        job = get_object_or_404(PGPKeyJob, pk=job_id, user=request.user)
+        return Response(PGPKeyJobSerializer(job).data)
     
     @action(detail=False, methods=['get'])
     def my_keys(self, request):
@@ -413,12 +955,6 @@ class PGPKeyViewSet(viewsets.ModelViewSet):
                     status=status.HTTP_400_BAD_REQUEST
                 )
             
-            # Проверка пароля можно сделать через опциональный вызов библиотеки gnupg
-            # В реальном проекте нужна проверка корректности пароля
-                
-            # Генерируем случайный ключ сессии и шифруем его AES-256
-            import secrets
-            import base64
             from cryptography.fernet import Fernet
             from datetime import timedelta
             
@@ -426,6 +962,16 @@ class PGPKeyViewSet(viewsets.ModelViewSet):
             session_key = Fernet.generate_key().decode('utf-8')
             pgp_key.session_key = session_key
             pgp_key.session_expires = timezone.now() + timedelta(hours=24)
+
+            # Пароль проверяется разблокировкой ключа; разблокированный ключ
+            # остается в памяти воркера до конца сессии
+            try:
+                keysessions.start_session(pgp_key, passphrase)
+            except ValueError:
+                return Response(
+                    {"detail": "Неверный пароль от приватного ключа"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
             pgp_key.save()
             
             return Response({
@@ -438,6 +984,9 @@ class PGPKeyViewSet(viewsets.ModelViewSet):
                 {"detail": "PGP ключи не найдены для текущего пользователя"},
                 status=status.HTTP_404_NOT_FOUND
             )
+        except APIException:
+            # Пул шифрования перегружен - ответ 503 с Retry-After
+            raise
         except Exception as e:
             return Response(
                 {"detail": f"Ошибка создания сессии: {str(e)}"},
@@ -454,6 +1003,7 @@ class PGPKeyViewSet(viewsets.ModelViewSet):
             pgp_key.session_key = None
             pgp_key.session_expires = None
             pgp_key.save()
+            keysessions.unlocked_keys.discard(request.user.pk)
             
             return Response({"detail": "Сессия успешно завершена"})
         except PGPKey.DoesNotExist:
@@ -508,4 +1058,113 @@ class PGPKeyViewSet(viewsets.ModelViewSet):
             return Response(
                 {"detail": "Публичный ключ не найден"},
                 status=status.HTTP_404_NOT_FOUND
-            ) 
\ No newline at end of file
+            )
+
+
+class MailEventsView(View):
+    """
+    Поток событий почты (Server-Sent Events): новые, перемещенные и удаленные письма
+
+    Асинхронный view: ожидающее подключение не занимает поток, поэтому под
+    ASGI-сервером воркер держит тысячи простаивающих клиентов. EventSource
+    в браузере не умеет передавать заголовки, поэтому JWT принимается и
+    в параметре ?token=. Каждое событие несет id = seq журнала MailChange:
+    при переподключении браузер передает Last-Event-ID, и пропущенные
+    изменения досылаются из журнала.
+
+    Под WSGI (manage.py runserver, gunicorn без ASGI-воркера) бесконечный
+    поток не отдается клиенту и навсегда занимает поток сервера, поэтому
+    там view отвечает 501.
+    """
+    # Максимум изменений, досылаемых при переподключении; больше - событие resync
+    replay_limit = 500
+
+    async def get(self, request):
+        if not isinstance(request, ASGIRequest):
+            return JsonResponse(
+                {"detail": "Поток событий доступен только под ASGI-сервером, например uvicorn core.asgi:application"},
+                status=status.HTTP_501_NOT_IMPLEMENTED
+            )
+        user = await self.authenticate(request)
+        if user is None:
+            return JsonResponse(
+                {"detail": "Учетные данные не были предоставлены или неверны"},
+                status=status.HTTP_401_UNAUTHORIZED
+            )
+
+        last_event_id = request.headers.get('Last-Event-ID') or request.GET.get('last_event_id')
+        try:
+            last_seq = int(last_event_id) if last_event_id else None
+        except ValueError:
+            last_seq = None
+
+        response = StreamingHttpResponse(self.stream(user, last_seq), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # Отключаем буферизацию ответа в nginx
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    async def authenticate(self, request):
+        """
+        Пользователь по JWT из заголовка Authorization или параметра ?token=
+        """
+        authentication = JWTAuthentication()
+        raw_token = None
+        header = authentication.get_header(request)
+        if header is not None:
+            raw_token = authentication.get_raw_token(header)
+        if raw_token is None:
+            raw_token = request.GET.get('token')
+        if not raw_token:
+            return None
+        try:
+            validated_token = authentication.get_validated_token(raw_token)
+            return await sync_to_async(authentication.get_user)(validated_token)
+        except (InvalidToken, TokenError):
+            return None
+
+    def get_replay(self, user, last_seq):
+        changes = list(
+            MailChange.objects.filter(user=user, seq__gt=last_seq).order_by('seq')[:self.replay_limit + 1]
+        )
+        if len(changes) > self.replay_limit:
+            return [events.RESYNC_EVENT]
+        return [events.make_event(change) for change in changes]
+
+    async def stream(self, user, last_seq):
+        heartbeat = getattr(settings, 'MAIL_EVENTS', {}).get('HEARTBEAT', 15)
+        broker = events.get_broker()
+        # Подписываемся до чтения журнала, чтобы не потерять изменения между ними
+        subscription = await broker.subscribe(user.id)
+        try:
+            replay = []
+            if last_seq is not None:
+                replay = await sync_to_async(self.get_replay)(user, last_seq)
+            last_seq = last_seq or 0
+
+            # Интервал переподключения EventSource
+            yield 'retry: 5000\n\n'
+            for event in replay:
+                last_seq = event.get('seq', last_seq)
+                yield self.format_event(event)
+            while True:
+                try:
+                    event = await subscription.get(heartbeat)
+                except asyncio.TimeoutError:
+                    # Комментарий SSE держит соединение живым через прокси
+                    yield ': ping\n\n'
+                    continue
+                # Событие уже отправлено из журнала при переподключении
+                if event.get('seq') is not None and event['seq'] <= last_seq:
+                    continue
+                yield self.format_event(event)
+        finally:
+            broker.unsubscribe(subscription)
+
+    def format_event(self, event):
+        lines = []
+        if event.get('seq') is not None:
+            lines.append(f"id: {event['seq']}")
+        lines.append(f"event: {event['action']}")
+        lines.append(f"data: {json.dumps(event)}")
+        return '\n'.join(lines) + '\n\n'
@@ -15,6 +15,7 @@ import os
 import datetime
 import sys
 from decouple import config, Csv
+from corsheaders.defaults import default_headers
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -146,6 +147,62 @@ CACHES = {
     }
 }
 
+# События почты для потока /api/v1/mail/events/ (SSE).
+# LocalBackend работает в пределах одного процесса; для нескольких воркеров
+# нужен общий бэкенд:
+#   mail.events.SQLiteBackend, LOCATION - путь к файлу (одна машина)
+#   mail.events.RedisBackend, LOCATION - 'redis://127.0.0.1:6379/2'
+MAIL_EVENTS = {
+    'BACKEND': config('MAIL_EVENTS_BACKEND', default='mail.events.LocalBackend'),
+    'LOCATION': config('MAIL_EVENTS_LOCATION', default=''),
+    'HEARTBEAT': 15,
+}
+
+# Пул операций GnuPG (mail.crypto): число одновременных процессов gpg, длина
+# очереди ожидающих операций, время ожидания результата в запросе и значение
+# Retry-After для ответа 503, когда очередь заполнена
+MAIL_CRYPTO = {
+    'WORKERS': config('MAIL_CRYPTO_WORKERS', default=4, cast=int),
+    'QUEUE_SIZE': config('MAIL_CRYPTO_QUEUE_SIZE', default=16, cast=int),
+    'TIMEOUT': config('MAIL_CRYPTO_TIMEOUT', default=30, cast=int),
+    'RETRY_AFTER': 5,
+}
+
+# Создание PGP ключей на сервере (mail.keygen, воркер mail_keyworker).
+# POOL_SIZE > 0 - держать запас готовых пар, чтобы новый пользователь
+# получал ключи сразу, без ожидания генерации
+MAIL_KEYGEN = {
+    'KEY_LENGTH': 4096,
+    'POOL_SIZE': config('MAIL_KEYGEN_POOL_SIZE', default=0, cast=int),
+    'POOL_EMAIL': config('MAIL_KEYGEN_POOL_EMAIL', default='keys@localhost'),
+}
+
+# Очередь исходящих писем (mail.outbox, воркер mail_outbox_worker): SMTP-сервер,
+# размер пачки, число попыток и экспоненциальная задержка между ними (секунды),
+# сколько писем отправлять по одному соединению и через сколько секунд простоя
+# проверять или закрывать соединение
+MAIL_OUTBOX = {
+    'HOST': config('MAIL_SMTP_HOST', default='localhost'),
+    'PORT': config('MAIL_SMTP_PORT', default=25, cast=int),
+    'TIMEOUT': 30,
+    'BATCH_SIZE': 50,
+    'MAX_ATTEMPTS': 10,
+    'RETRY_BASE': 60,
+    'RETRY_MAX': 3600,
+    'MESSAGES_PER_CONNECTION': 100,
+    'IDLE_TIMEOUT': 60,
+}
+
+# Лог Postfix, из которого mail_postfix_index берет статусы доставки
+MAIL_POSTFIX_LOG = config('MAIL_POSTFIX_LOG', default='/var/log/mail.log')
+
+# Сессии расшифровки (mail.keysessions): сколько разблокированных ключей держит
+# в памяти один воркер и где создаются их каталоги GnuPG (None - /dev/shm, если есть)
+MAIL_KEY_SESSIONS = {
+    'MAX_SIZE': config('MAIL_KEY_SESSIONS_MAX_SIZE', default=64, cast=int),
+    'DIRECTORY': None,
+}
+
 # DRF Configuration
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
@@ -218,6 +275,9 @@ AUTH_PASSWORD_VALIDATORS = [
 
 # CORS settings
 CORS_ALLOW_ALL_ORIGINS = True  # For development only, restrict in production
+# Заголовки загрузки вложений по частям
+CORS_ALLOW_HEADERS = (*default_headers, 'upload-offset', 'content-range')
+CORS_EXPOSE_HEADERS = ['Upload-Offset', 'Retry-After']
 
 # Получаем путь к файлу логов из переменной окружения
 LOG_FILE_PATH = config('LOG_FILE_PATH', default='logs/dom_advokatov.log')
@@ -272,6 +332,15 @@ LOGGING = {
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Максимальный размер вложения письма, загружаемого по частям
+MAIL_ATTACHMENT_MAX_SIZE = config('MAIL_ATTACHMENT_MAX_SIZE', default=500 * 1024 * 1024, cast=int)
+
+# Отдача файлов вложений фронт-прокси после проверки доступа:
+# '' - из Django, 'nginx' - X-Accel-Redirect, 'apache' - X-Sendfile (mod_xsendfile).
+# Для nginx MAIL_ATTACHMENT_ACCEL_PREFIX - internal location с alias на MEDIA_ROOT
+MAIL_ATTACHMENT_SENDFILE = config('MAIL_ATTACHMENT_SENDFILE', default='')
+MAIL_ATTACHMENT_ACCEL_PREFIX = config('MAIL_ATTACHMENT_ACCEL_PREFIX', default='/protected-media/')
+
 # Internationalization
 # https://docs.djangoproject.com/en/5.1/topics/i18n/
 
@@ -24,6 +24,16 @@ const filesService = {
     return uploadClient.get(`/api/mail/attachments/${fileId}/`);
   },
   
+  /**
+   * Скачать содержимое файла вложения
+   * 
+   * @param {string} fileId - ID файла
+   * @returns {Promise} - Промис с ответом сервера (data - Blob)
+   */
+  downloadAttachment(fileId) {
+    return uploadClient.get(`/api/mail/attachments/${fileId}/download/`, { responseType: 'blob' });
+  },
+  
   /**
    * Удалить файл по его ID
    * 
@@ -32,6 +42,44 @@ const filesService = {
    */
   deleteAttachment(fileId) {
     return uploadClient.delete(`/api/mail/attachments/${fileId}/`);
+  },
+  
+  /**
+   * Загрузить большой файл по частям с продолжением после обрыва
+   * 
+   * Если передан uploadId прерванной загрузки, сервер сообщит, сколько байт
+   * уже получено, и отправка продолжится с этого места.
+   * 
+   * @param {File} file - Файл для загрузки
+   * @param {Object} [options] - Параметры загрузки
+   * @param {string} [options.uploadId] - ID прерванной загрузки
+   * @param {number} [options.chunkSize] - Размер части в байтах (по умолчанию 5 МБ)
+   * @param {Function} [options.onProgress] - Обработчик прогресса: (loaded, total) => void
+   * @returns {Promise} - Промис с данными созданного вложения
+   */
+  async uploadAttachmentChunked(file, { uploadId, chunkSize = 5 * 1024 * 1024, onProgress } = {}) {
+    let upload;
+    if (uploadId) {
+      upload = (await uploadClient.get(`/api/mail/attachments/uploads/${uploadId}/`)).data;
+    } else {
+      upload = (await uploadClient.post('/api/mail/attachments/uploads/', {
+        filename: file.name,
+        size: file.size,
+        content_type: file.type || 'application/octet-stream',
+      })).data;
+    }
+    
+    let offset = upload.offset;
+    while (offset < file.size) {
+      const chunk = file.slice(offset, offset + chunkSize);
+      const response = await uploadClient.put(`/api/mail/attachments/uploads/${upload.id}/`, chunk, {
+        headers: { 'Content-Type': 'application/octet-stream', 'Upload-Offset': String(offset) },
+      });
+      offset = response.data.offset;
+      if (onProgress) onProgress(offset, file.size);
+    }
+    
+    return uploadClient.post(`/api/mail/attachments/uploads/${upload.id}/finalize/`);
   }
 };
 
@@ -109,6 +109,191 @@ const mailService = {
    */
   permanentDeleteMessage(id) {
     return apiClient.post(`/api/mail/${id}/permanent_delete/`);
+  },
+  
+  /**
+   * Массовое действие над сообщениями
+   * 
+   * Ответ: { action, matched, updated, not_found }
+   * 
+   * @param {string} action - trash, restore, purge, read или unread
+   * @param {Object} selector - { ids: [...] } или { folder: 'trash' } для всей папки
+   * @returns {Promise} - Промис с ответом сервера
+   */
+  bulkAction(action, selector) {
+    return apiClient.post('/api/mail/bulk/', { action, ...selector });
+  },
+  
+  /**
+   * Отметить сообщение как прочитанное
+   * 
+   * @param {string} id - ID сообщения
+   * @returns {Promise} - Промис с ответом сервера
+   */
+  markAsRead(id) {
+    return apiClient.post(`/api/mail/${id}/read/`);
+  },
+  
+  /**
+   * Отметить сообщение как непрочитанное
+   * 
+   * @param {string} id - ID сообщения
+   * @returns {Promise} - Промис с ответом сервера
+   */
+  markAsUnread(id) {
+    return apiClient.post(`/api/mail/${id}/unread/`);
+  },
+  
+  /**
+   * Получить количество писем и непрочитанных по папкам
+   * 
+   * @returns {Promise} - Промис с ответом сервера
+   */
+  getCounters() {
+    return apiClient.get('/api/mail/counters/');
+  },
+  
+  /**
+   * Найти письма по теме и участникам (email, имя)
+   * 
+   * Ответ: { next, results } - результаты по убыванию релевантности;
+   * следующая страница запрашивается с cursor из ссылки next.
+   * 
+   * @param {string} query - Слова запроса
+   * @param {string} [cursor] - Курсор следующей страницы
+   * @param {number} [pageSize] - Размер страницы (до 100)
+   * @returns {Promise} - Промис с ответом сервера
+   */
+  searchMessages(query, cursor, pageSize) {
+    const params = { q: query };
+    if (cursor) params.cursor = cursor;
+    if (pageSize) params.page_size = pageSize;
+    return apiClient.get('/api/mail/search/', { params });
+  },
+  
+  /**
+   * Получить переписки по убыванию последней активности
+   * 
+   * Ответ: { next, results } - переписки с числом писем, участниками и
+   * признаком вложений; следующая страница запрашивается с cursor из next.
+   * 
+   * @param {string} [cursor] - Курсор следующей страницы
+   * @param {number} [pageSize] - Размер страницы (до 100)
+   * @returns {Promise} - Промис с ответом сервера
+   */
+  getThreads(cursor, pageSize) {
+    const params = {};
+    if (cursor) params.cursor = cursor;
+    if (pageSize) params.page_size = pageSize;
+    return apiClient.get('/api/mail/threads/', { params });
+  },
+  
+  /**
+   * Получить переписку с письмами от старых к новым
+   * 
+   * @param {string} threadId - ID переписки
+   * @returns {Promise} - Промис с ответом сервера
+   */
+  getThread(threadId) {
+    return apiClient.get(`/api/mail/threads/${threadId}/`);
+  },
+  
+  /**
+   * Выгрузить письма в mbox или zip (файл .eml на письмо)
+   * 
+   * Зашифрованные тела выгружаются armor-блоками OpenPGP без расшифровки.
+   * 
+   * @param {Object} [params] - Параметры выгрузки
+   * @param {string} [params.archive] - mbox (по умолчанию) или zip
+   * @param {string} [params.folder] - inbox, sent, drafts или trash; без папки - все письма
+   * @param {string} [params.since] - Начало периода (ISO 8601)
+   * @param {string} [params.until] - Конец периода, не включается (ISO 8601)
+   * @returns {Promise} - Промис с ответом сервера (Blob)
+   */
+  exportMailbox(params = {}) {
+    return apiClient.get('/api/mail/export/', { params, responseType: 'blob' });
+  },
+  
+  /**
+   * Получить изменения писем после курсора синхронизации
+   * 
+   * Без since сервер вернет только текущий курсор. Ответ содержит
+   * changes (измененные письма с папками), removed (удаленные письма),
+   * cursor для следующего запроса и has_more, если изменений больше limit.
+   * 
+   * @param {number} [since] - Курсор из предыдущего ответа
+   * @param {number} [limit] - Максимальное число записей журнала
+   * @returns {Promise} - Промис с ответом сервера
+   */
+  sync(since, limit) {
+    const params = {};
+    if (since !== undefined && since !== null) params.since = since;
+    if (limit) params.limit = limit;
+    return apiClient.get('/api/mail/sync/', { params });
+  },
+  
+  /**
+   * Получить зашифрованное тело письма двоичным OpenPGP-сообщением
+   * 
+   * Ответ на треть меньше armor-текста content_encrypted; читается через
+   * openpgp.readMessage({ binaryMessage: new Uint8Array(response.data) }).
+   * 
+   * @param {string} id - ID письма
+   * @returns {Promise} - Промис с ответом сервера (ArrayBuffer)
+   */
+  getMessageContent(id) {
+    return apiClient.get(`/api/mail/${id}/content/`, { responseType: 'arraybuffer' });
+  },
+  
+  /**
+   * Расшифровать пачку писем ключом PGP сессии одним запросом
+   * 
+   * Ответ: { results: [{ id, content } | { id, error }] } в порядке ids;
+   * error - not_found, decryption_failed или timeout.
+   * 
+   * @param {Array<string>} ids - ID писем (не больше 50)
+   * @param {string} [passphrase] - Пароль, если воркер ответил 403 session_locked
+   * @returns {Promise} - Промис с ответом сервера
+   */
+  decryptBatch(ids, passphrase) {
+    const data = { ids };
+    if (passphrase) data.passphrase = passphrase;
+    return apiClient.post('/api/mail/decrypt-batch/', data);
+  },
+  
+  /**
+   * Отправить письмо нескольким получателям одним запросом
+   * 
+   * Каждый получатель получает свою копию, зашифрованную его ключом.
+   * Ответ: { results: { [recipientId]: { message_id } | { error } } };
+   * error - not_found, no_public_key, encryption_failed или timeout.
+   * 
+   * @param {Object} mailData - { recipient_ids, subject, content, is_encrypted, attachment_ids }
+   * @returns {Promise} - Промис с ответом сервера
+   */
+  sendMultiple(mailData) {
+    return apiClient.post('/api/mail/send-multiple/', mailData);
+  },
+  
+  /**
+   * Подписаться на события почты (Server-Sent Events)
+   * 
+   * Браузер сам переподключается и передает Last-Event-ID, пропущенные
+   * изменения сервер досылает. Событие resync означает, что часть событий
+   * потеряна и состояние нужно догнать через sync().
+   * 
+   * @param {Function} onEvent - Обработчик события: ({ seq, message_id, action }) => void
+   * @returns {EventSource} - Источник событий; для отписки вызовите close()
+   */
+  subscribeEvents(onEvent) {
+    const token = localStorage.getItem('token');
+    const url = `${apiClient.defaults.baseURL}/api/mail/events/?token=${encodeURIComponent(token)}`;
+    const source = new EventSource(url);
+    const actions = ['created', 'updated', 'moved', 'trashed', 'restored', 'read', 'unread', 'deleted', 'resync'];
+    actions.forEach((action) => {
+      source.addEventListener(action, (event) => onEvent(JSON.parse(event.data)));
+    });
+    return source;
   }
 };
 
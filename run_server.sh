@@ -23,6 +23,8 @@ echo "Применение миграций..."
 python manage.py migrate
 
 # Запуск сервера разработки
+# runserver - WSGI: поток событий почты (/api/v1/mail/events/) под ним отвечает 501.
+# Для событий запустите ASGI-сервер: pip install uvicorn && uvicorn core.asgi:application
 echo "Запуск сервера Django..."
 python manage.py runserver
 